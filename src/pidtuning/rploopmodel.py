@@ -0,0 +1,130 @@
+from dataclasses import dataclass, field, asdict
+
+import numpy as np
+
+
+@dataclass
+class LoopResult:
+    # fraction of the runs that lost the lock, RMS of the error signal while locked relative to the PDH peak and
+    # RMS of the detuning while locked in linewidths; the error is regulated to the setpoint, so only the detuning
+    # tells how far from resonance the lock sits
+    loss_rate: float
+    rms: float
+    detuning: float
+    lost: np.ndarray = field(repr=False)
+
+
+@dataclass
+class LoopModel:
+    # Discrete time model of the pid0 lock: the PID drives the piezo through a first order low-pass and a loop
+    # delay, the resonance moves with a slow random walk (thermal drift) and a band limited acoustic noise, and
+    # the PID sees the PDH error signal A 2 g d / (d^2 + g^2) of the detuning d plus sensor noise, A being
+    # error_amplitude volts (the default makes the slope 1 V per piezo V). The gains follow pyrpl: p is
+    # dimensionless, i and d are unity gain frequencies in Hz (d=0 turns the derivative off), and the output
+    # saturates at +-output_limit V. A run loses the lock when |d| leaves the capture range of `capture`
+    # linewidths. sensor_noise, error_offset and setpoint offsets are relative to A; times are seconds.
+    linewidth: float = 0.004
+    error_amplitude: float = 0.002
+    piezo_bandwidth: float = 2e3
+    delay: float = 3e-5
+    drift: float = 0.02
+    acoustic_rms: float = 0.002
+    acoustic_bandwidth: float = 200.
+    sensor_noise: float = 0.02
+    error_offset: float = 0.
+    output_limit: float = 1.
+    capture: float = 3.
+    dt: float = 1e-5
+    duration: float = 0.1
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def error(self, detuning):
+        g = self.linewidth
+        return self.error_amplitude * 2 * g * detuning / (detuning ** 2 + g ** 2)
+
+    def _disturbance(self, rng, n_runs: int, n_steps: int):
+        # resonance position per step: random walk plus Ornstein-Uhlenbeck acoustic noise
+        a = np.exp(-2 * np.pi * self.acoustic_bandwidth * self.dt)
+        kicks = rng.standard_normal((n_steps, n_runs))
+        walk = np.cumsum(self.drift * np.sqrt(self.dt) * rng.standard_normal((n_steps, n_runs)), axis=0)
+        acoustic = np.empty((n_steps, n_runs))
+        x = self.acoustic_rms * rng.standard_normal(n_runs)
+        scale = self.acoustic_rms * np.sqrt(1 - a ** 2)
+        for k in range(n_steps):
+            x = a * x + scale * kicks[k]
+            acoustic[k] = x
+        return walk + acoustic
+
+    def simulate(self, p: float, i: float, d: float = 0., setpoint_offset: float = 0., seeds=range(8)) -> LoopResult:
+        # one run per seed, all runs start on resonance with a cleared integrator
+        seeds = list(seeds)
+        n_runs, n_steps = len(seeds), int(round(self.duration / self.dt))
+        rng = np.random.default_rng(seeds)
+        resonance = self._disturbance(rng, n_runs, n_steps)
+        noise = self.sensor_noise * self.error_amplitude * rng.standard_normal((n_steps, n_runs))
+        lag = max(int(round(self.delay / self.dt)), 1)
+        pipeline = np.zeros((lag, n_runs))
+        a_pzt = 1 - np.exp(-2 * np.pi * self.piezo_bandwidth * self.dt)
+        ki = 2 * np.pi * i * self.dt
+        kd = 1 / (2 * np.pi * d * self.dt) if d > 0 else 0.
+        piezo = np.zeros(n_runs)
+        ival = np.zeros(n_runs)
+        previous = np.zeros(n_runs)
+        lost = np.zeros(n_runs, dtype=bool)
+        square_sum = np.zeros(n_runs)
+        detuning_sum = np.zeros(n_runs)
+        count = np.zeros(n_runs)
+        limit = self.output_limit
+        setpoint_offset = setpoint_offset * self.error_amplitude
+        for k in range(n_steps):
+            detuning = piezo - resonance[k]
+            lost |= np.abs(detuning) > self.capture * self.linewidth
+            e = self.error(detuning) + self.error_offset * self.error_amplitude + noise[k] - setpoint_offset
+            locked = ~lost
+            square_sum += np.where(locked, e ** 2, 0.)
+            detuning_sum += np.where(locked, detuning ** 2, 0.)
+            count += locked
+            ival = np.clip(ival + ki * e, -limit, limit)
+            u = np.clip(p * e + ival + kd * (e - previous), -limit, limit)
+            previous = e
+            # the output reaches the piezo `delay` later, the piezo follows it with its bandwidth; the sign
+            # convention makes positive gains stabilizing
+            delayed = pipeline[k % lag].copy()
+            pipeline[k % lag] = -u
+            piezo = piezo + a_pzt * (delayed - piezo)
+        if not count.sum():
+            return LoopResult(float(lost.mean()), np.inf, np.inf, lost)
+        rms = float(np.sqrt(square_sum.sum() / count.sum())) / self.error_amplitude
+        detuning = float(np.sqrt(detuning_sum.sum() / count.sum())) / self.linewidth
+        return LoopResult(float(lost.mean()), rms, detuning, lost)
+
+    def relay(self, amplitude: float = 0.001, hysteresis: float = 0.02, duration: float = 0.02):
+        # relay feedback u = amplitude * sign(e), hysteresis relative to the PDH peak, on the noiseless loop;
+        # returns the amplitude (V) of the error signal oscillation and its period, the limit cycle of the loop
+        # at its phase crossover
+        n_steps = int(round(duration / self.dt))
+        lag = max(int(round(self.delay / self.dt)), 1)
+        pipeline = np.zeros(lag)
+        a_pzt = 1 - np.exp(-2 * np.pi * self.piezo_bandwidth * self.dt)
+        piezo, state = 0., 1.
+        hysteresis = hysteresis * self.error_amplitude
+        errors = np.empty(n_steps)
+        for k in range(n_steps):
+            e = self.error(piezo)
+            if e > hysteresis:
+                state = 1.
+            elif e < -hysteresis:
+                state = -1.
+            errors[k] = e
+            pipeline[k % lag], u = -amplitude * state, pipeline[k % lag]
+            piezo = piezo + a_pzt * (u - piezo)
+        # skip the transient, then measure between upward zero crossings
+        tail = errors[n_steps // 2:]
+        crossings = np.flatnonzero((tail[:-1] < 0) & (tail[1:] >= 0))
+        if crossings.shape[0] < 2:
+            raise RuntimeError('the relay did not start a limit cycle, increase amplitude or duration')
+        period = float(np.mean(np.diff(crossings))) * self.dt
+        oscillation = (tail.max() - tail.min()) / 2
+        return float(oscillation), period
@@ -0,0 +1,251 @@
+import json
+import math
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+from rploopmodel import LoopModel
+
+# the gains RedPitayaPID.set_pid0 uses by default
+DEFAULT_GAINS = {'p': 0., 'i': 1e3, 'd': 0., 'setpoint_offset': 0.}
+# lower and upper bounds of the searched gains
+BOUNDS = {'p': (1e-3, 1e2), 'i': (1., 1e6), 'd': (1., 1e7)}
+
+
+@dataclass
+class RelayResult:
+    # ultimate gain and period of the loop and the Tyreus-Luyben PI gains derived from them
+    ku: float
+    tu: float
+    p: float
+    i: float
+
+
+def relay_identification(model: LoopModel, amplitude: float = 0.001, hysteresis: float = 0.02) -> RelayResult:
+    # Astrom-Hagglund relay experiment: a relay of amplitude h makes the loop oscillate at its phase crossover,
+    # the error amplitude a gives the ultimate gain 4 h / (pi a)
+    oscillation, tu = model.relay(amplitude, hysteresis)
+    ku = 4 * amplitude / (math.pi * oscillation)
+    p = ku / 3.2
+    ti = 2.2 * tu
+    # pyrpl's integral gain is the unity gain frequency of p / ti
+    return RelayResult(ku, tu, p, p / (2 * math.pi * ti))
+
+
+def cost(loss_rate: float, detuning: float, loss_weight: float = 10.) -> float:
+    return loss_weight * loss_rate + detuning
+
+
+def evaluate(model: dict, gains: dict, seeds, loss_weight: float = 10.):
+    # runs in the worker processes: (cost, loss_rate, detuning) of one set of gains
+    result = LoopModel(**model).simulate(seeds=seeds, **gains)
+    return cost(result.loss_rate, result.detuning, loss_weight), result.loss_rate, result.detuning
+
+
+class CMAES:
+    # (mu/mu_w, lambda) covariance matrix adaptation evolution strategy (Hansen's tutorial parameters).
+    # ask() returns the population, tell() takes the costs in the same order; lower is better.
+    def __init__(self, mean, sigma: float = 0.5, population: int = None, seed=None):
+        self.mean = np.asarray(mean, dtype=float)
+        n = self.n = self.mean.shape[0]
+        self.sigma = sigma
+        self.population = population or 4 + int(3 * math.log(n))
+        self.mu = self.population // 2
+        weights = math.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mu_eff = 1 / np.sum(self.weights ** 2)
+        self.cc = (4 + self.mu_eff / n) / (n + 4 + 2 * self.mu_eff / n)
+        self.cs = (self.mu_eff + 2) / (n + self.mu_eff + 5)
+        self.c1 = 2 / ((n + 1.3) ** 2 + self.mu_eff)
+        self.cmu = min(1 - self.c1, 2 * (self.mu_eff - 2 + 1 / self.mu_eff) / ((n + 2) ** 2 + self.mu_eff))
+        self.damps = 1 + 2 * max(0., math.sqrt((self.mu_eff - 1) / (n + 1)) - 1) + self.cs
+        self.chi_n = math.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+        self.pc = np.zeros(n)
+        self.ps = np.zeros(n)
+        self.C = np.eye(n)
+        self.generation = 0
+        self.rng = np.random.default_rng(seed)
+        self._samples = None
+
+    def ask(self):
+        eigenvalues, B = np.linalg.eigh(self.C)
+        D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+        z = self.rng.standard_normal((self.population, self.n))
+        y = z * D @ B.T
+        self._samples = (y, B, D)
+        return self.mean + self.sigma * y
+
+    def tell(self, costs) -> None:
+        y, B, D = self._samples
+        order = np.argsort(costs)[:self.mu]
+        y_w = self.weights @ y[order]
+        self.mean = self.mean + self.sigma * y_w
+        n = self.n
+        inv_sqrt_C = B @ np.diag(1 / D) @ B.T
+        self.ps = (1 - self.cs) * self.ps + math.sqrt(self.cs * (2 - self.cs) * self.mu_eff) * inv_sqrt_C @ y_w
+        self.generation += 1
+        h_sigma = np.linalg.norm(self.ps) / math.sqrt(1 - (1 - self.cs) ** (2 * self.generation)) < \
+            (1.4 + 2 / (n + 1)) * self.chi_n
+        self.pc = (1 - self.cc) * self.pc + h_sigma * math.sqrt(self.cc * (2 - self.cc) * self.mu_eff) * y_w
+        rank_mu = (self.weights[:, None] * y[order]).T @ y[order]
+        self.C = (1 - self.c1 - self.cmu) * self.C + self.c1 * (np.outer(self.pc, self.pc) + (not h_sigma) *
+                                                                self.cc * (2 - self.cc) * self.C) + self.cmu * rank_mu
+        self.sigma *= math.exp(self.cs / self.damps * (np.linalg.norm(self.ps) / self.chi_n - 1))
+
+
+@dataclass
+class TuningResult:
+    p: float
+    i: float
+    d: float
+    # relative to the PDH peak, like LoopModel.error_offset
+    setpoint_offset: float
+    cost: float
+    loss_rate: float
+    # RMS detuning while locked, in linewidths
+    detuning: float
+    # the same metrics for DEFAULT_GAINS, on the same validation runs
+    default_cost: float
+    default_loss_rate: float
+    default_detuning: float
+    relay: RelayResult
+    generations: int
+    evaluations: int
+    duration: float
+
+    @property
+    def gains(self) -> dict:
+        return {'p': self.p, 'i': self.i, 'd': self.d, 'setpoint_offset': self.setpoint_offset}
+
+
+class Tuner:
+    # Searches the pid0 gains and setpoint offset that minimise loss_weight * lock loss rate + RMS detuning (in
+    # linewidths) on a LoopModel. The relay experiment gives the starting point, CMA-ES searches log10 p, log10 i
+    # (log10 d with tune_d) and the setpoint offset in units of the PDH peak; the offset is only searched
+    # (tune_offset=None) when the model has an error_offset to compensate. Every generation is evaluated in
+    # parallel on a process pool with common random numbers (new seeds per generation); the best mean is
+    # validated on `validation_seeds` unseen runs next to the default gains.
+    def __init__(self, model: LoopModel = None, processes: int = None, seeds: int = 8, validation_seeds: int = 32,
+                 loss_weight: float = 10., tune_d: bool = False, tune_offset: bool = None, seed: int = 0):
+        self.model = LoopModel() if model is None else model
+        self.processes = processes
+        self.seeds = seeds
+        self.validation_seeds = validation_seeds
+        self.loss_weight = loss_weight
+        self.tune_d = tune_d
+        self.tune_offset = self.model.error_offset != 0 if tune_offset is None else tune_offset
+        self.seed = seed
+        self.history = []
+
+    def decode(self, x) -> dict:
+        gains = dict(DEFAULT_GAINS)
+        gains['p'] = float(np.clip(10 ** x[0], *BOUNDS['p']))
+        gains['i'] = float(np.clip(10 ** x[1], *BOUNDS['i']))
+        k = 2
+        if self.tune_d:
+            gains['d'] = float(np.clip(10 ** x[k], *BOUNDS['d']))
+            k += 1
+        if self.tune_offset:
+            gains['setpoint_offset'] = float(x[k])
+        return gains
+
+    def encode(self, p: float, i: float, d: float = 1e4, setpoint_offset: float = 0.):
+        x = [math.log10(np.clip(p, *BOUNDS['p'])), math.log10(np.clip(i, *BOUNDS['i']))]
+        if self.tune_d:
+            x.append(math.log10(np.clip(d, *BOUNDS['d'])))
+        if self.tune_offset:
+            x.append(setpoint_offset)
+        return np.array(x)
+
+    def _evaluate(self, executor, candidates, seeds):
+        model = self.model.to_dict()
+        futures = [executor.submit(evaluate, model, gains, seeds, self.loss_weight) for gains in candidates]
+        return [future.result() for future in futures]
+
+    def tune(self, generations: int = 15, population: int = None, sigma: float = 0.5) -> TuningResult:
+        t0 = time.perf_counter()
+        relay = relay_identification(self.model)
+        strategy = CMAES(self.encode(relay.p, relay.i), sigma, population, self.seed)
+        evaluations = 0
+        with ProcessPoolExecutor(self.processes) as executor:
+            for generation in range(generations):
+                xs = strategy.ask()
+                candidates = [self.decode(x) for x in xs]
+                seeds = range(self.seed + generation * self.seeds, self.seed + (generation + 1) * self.seeds)
+                results = self._evaluate(executor, candidates, seeds)
+                evaluations += len(candidates)
+                strategy.tell([r[0] for r in results])
+                best = int(np.argmin([r[0] for r in results]))
+                self.history.append({'generation': generation, 'sigma': strategy.sigma, 'cost': results[best][0],
+                                     **candidates[best]})
+            # validation on runs the search never saw
+            seeds = range(10 ** 6 + self.seed, 10 ** 6 + self.seed + self.validation_seeds)
+            (c, loss_rate, detuning), (default_c, default_loss_rate, default_detuning) = \
+                self._evaluate(executor, [self.decode(strategy.mean), DEFAULT_GAINS], seeds)
+        gains = self.decode(strategy.mean)
+        return TuningResult(**gains, cost=c, loss_rate=loss_rate, detuning=detuning, default_cost=default_c,
+                            default_loss_rate=default_loss_rate, default_detuning=default_detuning, relay=relay,
+                            generations=generations, evaluations=evaluations, duration=time.perf_counter() - t0)
+
+
+def save_gains(path: str, result: TuningResult, model: LoopModel = None) -> None:
+    # the gains at the top level are what RedPitayaPID.load_pid_gains reads, the rest documents the tuning
+    metrics = asdict(result)
+    for name in ('p', 'i', 'd', 'setpoint_offset'):
+        metrics.pop(name)
+    config = {**result.gains, 'tuning': metrics, 'model': None if model is None else model.to_dict(),
+              'timestamp': time.time()}
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def confirm(controller, path: str, duration: float = 60., interval: float = 1.) -> dict:
+    # locks a RedPitayaPID with the tuned gains of `path` and monitors it for `duration` seconds: lock losses,
+    # transmission and the RMS of the iq0 error signal around the setpoint
+    controller.load_pid_gains(path)
+    supervisor = controller.supervisor
+    if not supervisor.acquire():
+        return {'locked': False}
+    transmissions, errors = [], []
+
+    def check(check):
+        transmissions.append(check.max)
+        _, error = controller.scope(input2='iq0')
+        errors.append(float(np.sqrt(np.mean((error - controller.registers.read('pid0', 'setpoint')) ** 2))))
+    monitor_interval, supervisor.monitor_interval = supervisor.monitor_interval, interval
+    losses = 0
+    deadline = time.time() + duration
+    try:
+        while time.time() < deadline:
+            # a failing check loses the lock without returning one
+            lost = supervisor.losses
+            supervisor.monitor(check, deadline)
+            if supervisor.losses == lost:
+                break
+            losses += 1
+            if not supervisor.acquire():
+                break
+    finally:
+        supervisor.monitor_interval = monitor_interval
+    return {'locked': True, 'losses': losses, 'loss_rate': losses / duration,
+            'transmission': float(np.mean(transmissions)) if transmissions else 0.,
+            'error_rms': float(np.mean(errors)) if errors else 0.}
+
+
+if __name__ == '__main__':
+    # python rptuner.py [pid_gains.json]
+    path = sys.argv[1] if len(sys.argv) > 1 else 'pid_gains.json'
+    tuner = Tuner()
+    result = tuner.tune()
+    print(f'relay: ku={result.relay.ku:.3g} tu={1e6 * result.relay.tu:.0f} us, start p={result.relay.p:.3g} '
+          f'i={result.relay.i:.3g} Hz')
+    print(f'tuned: p={result.p:.3g} i={result.i:.3g} Hz d={result.d:.3g} '
+          f'setpoint offset={result.setpoint_offset:.3f} of the PDH peak')
+    print(f'cost {result.cost:.3f} (loss rate {result.loss_rate:.2f}, detuning {result.detuning:.3f}), defaults '
+          f'{result.default_cost:.3f} (loss rate {result.default_loss_rate:.2f}, '
+          f'detuning {result.default_detuning:.3f}), '
+          f'{result.evaluations} evaluations in {result.duration:.0f} s')
+    save_gains(path, result, tuner.model)
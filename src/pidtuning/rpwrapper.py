@@ -6,9 +6,15 @@ from gymnasium.core import WrapperActType, WrapperObsType
 
 
 class SkipSteps(Wrapper):
-    def __init__(self, env, skip=10):
+    # Repeats an action for `skip` sub-steps at `rate` sub-steps per second. Envs with a RateScheduler
+    # (RedPitayaEnv) are paced by it at that rate; others sleep a period after each sub-step.
+    def __init__(self, env, skip=10, rate=10.):
         super().__init__(env)
         self._skip = skip
+        self._rate = rate
+        self._scheduler = getattr(env.unwrapped, 'scheduler', None)
+        if self._scheduler is not None:
+            self._scheduler.set_rate(rate)
 
     def step(
         self, action: WrapperActType
@@ -17,7 +23,8 @@ class SkipSteps(Wrapper):
         for i in range(self._skip):
             obs, reward, done, trunk, info = self.env.step(action)
             total_reward += reward
-            time.sleep(0.1)
+            if self._scheduler is None:
+                time.sleep(1 / self._rate)
             if done:
                 break
         return obs, total_reward, done, trunk, info
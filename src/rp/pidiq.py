@@ -1,49 +1,79 @@
 import time
-import numpy as np
 from rppid import RedPitayaPID
+from rpcodec import TraceCodec
+from rprecorder import TraceRecorder
+from rpbus import TraceBus, monitor_traces, record_traces, start_subscriber
+from rptelemetry import DEBUG
 
 
 class PIDIQ(RedPitayaPID):
-    def __init__(self, hostname: str):
+    def __init__(self, hostname: str, bus: str = None, out1_traces: int = 99):
         super().__init__(hostname)
         self.init_time = time.time()
         self.counter = 1
+        # asg0 is recorded under its historical dataset name iq0
+        # traces are stored as 14 bit scope codes
+        self.lock_recorder = TraceRecorder('dataset/locks', ('out1', 'iq0'), codec=TraceCodec())
+        # iq0 is recorded with every trace and out1 (the piezo drive) to dataset/out1 with the first
+        # `out1_traces` only, as in the original dataset; None records out1 with every trace instead
+        self.out1_traces = out1_traces
+        channels = ('out1', 'iq0') if out1_traces is None else ('iq0',)
+        # with a bus name the traces are published once to shared memory, recorded and monitored by subscriber
+        # processes; otherwise they are recorded from the control loop
+        self.bus = None
+        self.recorder = None
+        self.out1_recorder = None
+        self.subscribers = []
+        if bus is None:
+            self.recorder = TraceRecorder('dataset/traces', channels, codec=TraceCodec())
+            if out1_traces is not None:
+                self.out1_recorder = TraceRecorder('dataset/out1', ('out1',), codec=TraceCodec())
+        else:
+            self.bus = TraceBus(bus, self.redpitaya.scope.data_length)
+            self.subscribers = [start_subscriber(record_traces, self.bus.name, 'dataset/traces', channels,
+                                                 TraceCodec(), indices=None if out1_traces is None else (1,)),
+                                start_subscriber(monitor_traces, self.bus.name)]
+            if out1_traces is not None:
+                self.subscribers.append(start_subscriber(record_traces, self.bus.name, 'dataset/out1', ('out1',),
+                                                         TraceCodec(), indices=(0,), count=out1_traces))
 
     def analyze(self):
-        if self.init_time + 480 < time.time():
-            return
-        self.reset()
-        self.ramp_piezo()
-        if self.scan_temperature(500):
-            time.sleep(10)
-            try:
-                self.lock_cavity()
-            except:
-                self.analyze()
-            starting_time = time.time()
-            print(f'Locked at: {starting_time}')
-            while True:
-                time.sleep(10)
-                print(f'Seconds after start: {time.time() - starting_time}')
-                out1, iq0 = self.scope(input2='asg0')
-                _, in2 = self.scope()
-
-                if in2.max() < 0.95:
-                    end_time = time.time()
-                    print(f'Lost lock at: {end_time}. Took {end_time-starting_time} ({self.counter})')
-                    break
-                else:
-                    np.save(f'dataset/iq0/{self.counter}.npy', iq0)
-                    if self.counter < 100:
-                        np.save(f'dataset/out1/{self.counter}.npy', out1)
-                    self.counter += 1
-                    print(f'purple (fast) signal mean: {out1.mean()}')
-                    print(f'blue signal mean: {in2.mean()}')
-        else:
-            print('Could not find temperature')
-        self.analyze()
+        def record(check):
+            out1, iq0 = self.scope(input2='asg0')
+            dac2 = self.get_dac2()
+            locked = check.max >= self.supervisor.lock_threshold
+            if self.bus is not None:
+                self.bus.publish((out1, iq0), dac2, locked, self.counter, transmission=check.max)
+            else:
+                traces = (out1, iq0) if self.out1_traces is None else (iq0,)
+                self.recorder.record(traces, dac2, locked, self.counter, transmission=check.max)
+                if self.out1_recorder is not None and self.counter <= self.out1_traces:
+                    self.out1_recorder.record((out1,), dac2, locked, self.counter, transmission=check.max)
+            self.counter += 1
+            # transmission: max of the blue signal, signal_max and value: max and mean of the purple (fast) signal
+            if self.telemetry.enabled(DEBUG):
+                self.telemetry.debug('monitor', dac2=dac2, transmission=check.max, signal_max=check.ch1['max'],
+                                     value=check.ch1['mean'])
+        try:
+            self.supervisor.run(record, until=self.init_time + 480)
+        finally:
+            for recorder in (self.recorder, self.out1_recorder, self.lock_recorder):
+                if recorder is not None:
+                    recorder.flush()
 
+    def close(self):
+        # closing the bus lets the subscribers drain the ring and exit, the block is freed once they have
+        for recorder in (self.recorder, self.out1_recorder, self.lock_recorder):
+            if recorder is not None:
+                recorder.close()
+        if self.bus is not None:
+            self.bus.close()
+            for process in self.subscribers:
+                process.join()
+            self.bus.unlink()
+        super().close()
 
 if __name__ == "__main__":
     pid = PIDIQ('169.254.167.128')
     pid.analyze()
+    pid.close()
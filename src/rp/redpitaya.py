@@ -1,15 +1,24 @@
 from abc import ABC, abstractmethod
-import pyrpl
+
+from rpsession import sessions
 
 
 class RedPitaya(ABC):
     @abstractmethod
     def __init__(self, hostname: str, user: str = 'root', password: str = 'root', config: str = 'fermi',
                  gui: bool = False):
-        try:
-            self.redpitaya = pyrpl.RedPitaya(hostname=hostname, config=config, user=user, password=password)
-        except Exception as e:
-            print(e)
+        self.hostname = hostname
+        # one connection per board and process, shared with the other objects of the same board until close()
+        # ('sim' or 'sim:<seed>' runs against an in-process cavity simulator of this object's own instead)
+        self.session = sessions.get(hostname, user, password, config)
+        self.redpitaya = self.session
+        self._released = False
+
+    def close(self) -> None:
+        # gives the session back to the pool, once
+        if not self._released:
+            self._released = True
+            sessions.release(self.session)
 
     @abstractmethod
     def reset(self) -> None:
@@ -40,4 +49,3 @@ class RedPitaya(ABC):
     def set_pid0(self, ival: float = 0, integrator: float = 1e3, proportional: float = 0,
                  differantiator: float = 0, input='iq0', output_direct: str = 'out1') -> None:
         pass
-
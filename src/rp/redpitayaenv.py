@@ -1,18 +1,38 @@
-import time
 from typing import Any, SupportsFloat, Union
 
 import gymnasium as gym
 from gymnasium import spaces
 import numpy as np
 from gymnasium.core import ObsType, ActType, RenderFrame
-import scipy
 
 from rpscope import RedPitayaScope
+from rptempsearch import TemperatureSearch
+from rplockcache import LockPoint, LockPointCache
+from rpfit import PDHFitter
+from rpscheduler import RateScheduler
+from rpsupervisor import LockSupervisor
+from rpsession import simulated
 
 
 class RedPitayaEnv(gym.Env):
-    def __init__(self, rp):
+    def __init__(self, rp, rate: float = 20., stream: bool = None):
         self.rp = rp
+        # steps per second, one decimation 256 trace takes 34 ms
+        self.scheduler = RateScheduler(rate)
+        # while locked, traces are acquired in the background and step() reads the first one acquired after its
+        # action. Off by default on the simulator, whose clock advances by a trace per acquisition: a free-running
+        # stream would fast-forward the cavity drift
+        self.stream = not simulated(rp.hostname) if stream is None else stream
+        self.temperature_search = TemperatureSearch()
+        self.lock_cache = LockPointCache()
+        self.fitter = PDHFitter()
+        # the steps are looked up on every call, so instrumentation attached later sees them
+        self.supervisor = LockSupervisor(lambda: self.rp.reset(), lambda: self.ramp_piezo(),
+                                         lambda: self.scan_temperature(500), lambda: self.lock_cavity(),
+                                         lambda: self.rp.lock_check(),
+                                         settle=self.rp.settle_detector.wait,
+                                         on_locked=lambda point: self.lock_cache.store(self.rp.hostname, point),
+                                         telemetry=self.rp.telemetry)
         self.action_space = spaces.Box(low=-0.3, high=0.3, shape=(1,), dtype=np.float32)
         self.observation_space = spaces.Box(low=0, high=1, shape=(1,), dtype=np.float32)
         self.reward_range = (-0.95, 0.04)
@@ -26,55 +46,52 @@ class RedPitayaEnv(gym.Env):
             self.rp.set_asg1(waveform='halframp', output_direct=output_direct, amp=amp, offset=offset, freq=freq)
 
     def ramp_piezo(self, phase=15):
-        self.reset()
-        self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
-        self.rp.set_iq0(phase=phase)
+        with self.rp.transaction():
+            self.rp.reset()
+            self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
+            self.rp.set_iq0(phase=phase)
 
     def scan_temperature(self, epsilon=1000) -> bool:
-        for i in np.arange(0, 0.3, 0.00025):
-            # set temperature
-            self.set_dac2(i)
-            # take scope
-            _, blue_signal = self.scope(ordered=True)
-            half_scope_trace = int(blue_signal.shape[0]/2)
-
-            blue_signal_peak_index = np.where(blue_signal == blue_signal.max())[0][0]
-            if half_scope_trace - epsilon < blue_signal_peak_index < half_scope_trace + epsilon and \
-                    blue_signal.max() > .95:
-                print('Temperature: :', i)
-                return True
-        return False
-
-    def lock_cavity(self, phase=20):
+        result = self.lock_cache.scan(self.rp.hostname, self.temperature_search, self.rp.measure_temperature, epsilon)
+        if result.found:
+            print('Temperature: :', result.temperature, f'({result.acquisitions} acquisitions)')
+        return result.found
+
+    def lock_cavity(self, phase=None):
+        cached = self.lock_cache.get(self.rp.hostname)
+        if phase is None:
+            phase = cached.phase if cached is not None else 20
         #####
         #   RAMP PIEZO
-        print("Scan Piezo")
-        self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
-        print("Run on Modulation")
-        self.rp.set_iq0(phase=phase)
+        with self.rp.transaction():
+            print("Scan Piezo")
+            self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
+            print("Run on Modulation")
+            self.rp.set_iq0(phase=phase)
         ######
         print("Take a scope trace")
         scope_trace = self.rp.scope('out1', 'iq0', trigger_source='ch1_positive_edge')
         print("Done taking scope trace")
-        np.save('scope_trace.npy', scope_trace)
+        self.rp.save_lock_trace(scope_trace)
         print("Saved scope trace")
         ch1, ch2 = scope_trace
 
-        # Guess Initial Parameters
+        # Curve Fit, warm started from the last lock of this board
         print("Curve fit")
-        offs = np.mean(ch2)
-        gamma = (np.max(ch1) - np.min(ch1)) / 10
-        x0 = (np.max(ch1) - np.min(ch1)) / 2
-        amp = (np.max(ch2) - np.mean(ch2)) * (x0 ** 3)  # guessed,but don't guess the correct sign
-
-        # Curve Fit
-        poptLine, pcovLine = scipy.optimize.curve_fit(self.lorantian_derivative, ch1, ch2, p0=[amp, offs, gamma, x0])
+        fit_result = self.fitter.fit(ch1, ch2, None if cached is None else cached.fit)
+        print(f'Fit: {fit_result}')
+        if not fit_result.success:
+            raise RuntimeError(f'PDH fit failed: {fit_result}')
+        poptLine = fit_result.params
+        # stored by the supervisor once the lock is confirmed
+        point = LockPoint(self.rp.get_dac2(), *poptLine, phase)
         fit = self.lorantian_derivative(ch1, poptLine[0], poptLine[1], poptLine[2], poptLine[3])
 
         print("Go back to resonance")
         # Go to resonance (CONSTANT PIEZO)
         # self.constantPzt(V=poptLine[3])
         self.rp.set_asg0(waveform='dc', output_direct='out1', offset=poptLine[3])
+        return point
 
 
     @staticmethod
@@ -87,36 +104,28 @@ class RedPitayaEnv(gym.Env):
         seed=None,
         options=None,
     ):
-        # Reset Red Pitaya
-        self.rp.reset()
-        # set temperature
-        self.ramp_piezo()
-        if not self.scan_temperature(500):
-            print('ERR: could not find TEM00 mode, resetting')
-            self.reset()
-        # lock
-        time.sleep(10)
-        try:
-            self.lock_cavity()
-        except:
-            print('ERR: could not lock the cavity, resetting')
-            self.reset()
-        _, phcav = self.rp.scope()
-        return phcav.max(), {}
+        # reset, set temperature and lock, retried by the supervisor; the stream only runs while locked
+        self.rp.stop_stream()
+        if not self.supervisor.acquire():
+            raise RuntimeError(f'could not lock the cavity in {self.supervisor.max_retries} attempts')
+        if self.stream:
+            self.rp.start_stream()
+        # the first step is timed from the end of the reset
+        self.scheduler.reset()
+        return self.supervisor.last_check.max, {}
 
     def step(
         self, action: ActType
     ):
-        time.sleep(0.001)
+        self.scheduler.wait()
         # change temperature
-        self.rp.set_dac2(self.rp.redpitaya.ams.dac2 + action)
-        time.sleep(0.0001)  # TODO: is it too much?
-        # get state
-        _, phcav = self.rp.scope()
-        next_state = phcav.max()
+        self.rp.set_dac2(self.rp.get_dac2() + action)
+        # get state, only the transmission maximum of the first streamed trace after the action, or read back
+        # from a fresh one
+        next_state = self.rp.lock_check().max
         reward = next_state - 0.95
         done = False
-        if phcav.max() < 0.95:
+        if next_state < 0.95:
             done = True
         return next_state, reward, done, False, {}  # next_obs, reward, terminated (bool), truncated (bool), info (dict)
 
@@ -124,4 +133,7 @@ class RedPitayaEnv(gym.Env):
         return None
 
     def close(self):
-        self.rp.reset()
\ No newline at end of file
+        # the env owns its controller
+        self.rp.stop_stream()
+        self.rp.reset()
+        self.rp.close()
\ No newline at end of file
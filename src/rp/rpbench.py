@@ -0,0 +1,322 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from rplockcache import LockPointCache
+from rptelemetry import ERROR
+from rpinstrument import Instrumentation
+from rpscope import RedPitayaScope
+from rppid import RedPitayaPID
+from rpqlnopid import RedPitayaQLearningNoPID
+from redpitayaenv import RedPitayaEnv
+
+# SkipSteps lives in the sibling pidtuning directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'pidtuning'))
+from rpwrapper import SkipSteps
+
+# scope memory and acquisition calls of pyrpl that are network round-trips, setup() is one per attribute
+ROUND_TRIP_METHODS = {'single': 3, '_start_trace_acquisition': 1, '_data_ready': 1, '_reads': 1}
+# private scope attributes that are registers on the board
+ROUND_TRIP_ATTRIBUTES = {'_write_pointer_trigger', '_trigger_delay_register'}
+
+
+class Link:
+    # the network between the controller and a simulated board: every round-trip takes `latency` seconds
+    def __init__(self, latency: float = 0.):
+        self.latency = latency
+        self.round_trips = 0
+
+    def round_trip(self, n: int = 1) -> None:
+        self.round_trips += n
+        if self.latency:
+            deadline = time.perf_counter() + n * self.latency
+            if n * self.latency > 0.002:
+                time.sleep(n * self.latency - 0.001)
+            while time.perf_counter() < deadline:
+                pass
+
+
+class RemoteModule:
+    # a module of the simulated board seen through a Link: public attribute reads and writes, register
+    # attributes and the scope memory calls are round-trips, as they are with pyrpl
+    def __init__(self, module, link: Link):
+        vars(self).update(_module=module, _link=link)
+
+    def __getattr__(self, name):
+        value = getattr(self._module, name)
+        if callable(value):
+            if name == 'setup':
+                def setup(**kwargs):
+                    self._link.round_trip(len(kwargs))
+                    return value(**kwargs)
+                return setup
+            n = ROUND_TRIP_METHODS.get(name)
+            if n is None:
+                return value
+
+            def call(*args, **kwargs):
+                self._link.round_trip(n)
+                return value(*args, **kwargs)
+            return call
+        if not name.startswith('_') or name in ROUND_TRIP_ATTRIBUTES:
+            self._link.round_trip()
+        return value
+
+    def __setattr__(self, name, value):
+        self._link.round_trip()
+        setattr(self._module, name, value)
+
+
+class RemoteBoard:
+    def __init__(self, board, link: Link):
+        self._board = board
+        self._link = link
+        self.modules = {name: RemoteModule(module, link) for name, module in board.modules.items()}
+
+    def __getattr__(self, name):
+        modules = vars(self).get('modules', {})
+        if name in modules:
+            return modules[name]
+        return getattr(self._board, name)
+
+
+def controller(cls, hostname: str, register_latency: float, acquisition_latency: float, **kwargs):
+    # a controller of a fresh simulated board (sim sessions are not pooled) behind a Link, quiet and without files
+    with contextlib.redirect_stdout(io.StringIO()):
+        rp = cls(hostname, **kwargs)
+    board = rp.session.board
+    board.latency = acquisition_latency
+    link = Link(register_latency)
+    rp.session.board = RemoteBoard(board, link)
+    rp.link = link
+    rp.telemetry.echo = ERROR + 1
+    if hasattr(rp, 'lock_cache'):
+        rp.lock_cache = LockPointCache(None)
+    return rp
+
+
+class Measurement:
+    # wall time and link round-trips of a block
+    def __init__(self, link: Link):
+        self.link = link
+
+    def __enter__(self):
+        self._round_trips = self.link.round_trips
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.time = time.perf_counter() - self._t0
+        self.round_trips = self.link.round_trips - self._round_trips
+
+
+def bench_scope(n: int, **latency) -> dict:
+    rp = controller(RedPitayaScope, 'sim:101', **latency)
+    rp.scope(ordered=True)
+    times = []
+    with Measurement(rp.link) as total:
+        for _ in range(n):
+            t0 = time.perf_counter()
+            rp.scope(ordered=True)
+            times.append(time.perf_counter() - t0)
+    return {'scope_ms': 1e3 * float(np.median(times)), 'scopes_per_s': n / total.time,
+            'round_trips_per_scope': total.round_trips / n}
+
+
+def bench_scan_temperature(n: int, **latency) -> dict:
+    rp = controller(RedPitayaPID, 'sim:102', **latency)
+    times, round_trips = [], 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(n):
+            rp.lock_cache.invalidate()
+            rp.ramp_piezo()
+            with Measurement(rp.link) as m:
+                found = rp.scan_temperature(500)
+            times.append(m.time)
+            round_trips += m.round_trips
+    return {'scan_s': float(np.median(times)), 'scan_round_trips': round_trips / n, 'found': found}
+
+
+def bench_lock_cavity(n: int, **latency) -> dict:
+    rp = controller(RedPitayaPID, 'sim:103', **latency)
+    fits = Instrumentation().attach(rp.fitter, ('fit',), 'fitter').histogram('fitter.fit')
+    times, round_trips = [], 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        rp.ramp_piezo()
+        rp.scan_temperature(500)
+        # the first lock imports scipy, its point warm starts the others as a confirmed lock would
+        rp.lock_cache.store(rp.hostname, rp.lock_cavity())
+        fits.clear()
+        for _ in range(n):
+            rp.ramp_piezo()
+            with Measurement(rp.link) as m:
+                rp.lock_cavity()
+            times.append(m.time)
+            round_trips += m.round_trips
+    return {'lock_cavity_ms': 1e3 * float(np.median(times)), 'lock_cavity_round_trips': round_trips / n,
+            'fit_ms': 1e3 * fits.mean}
+
+
+def bench_time_to_lock(n: int, **latency) -> dict:
+    # full supervisor acquisition: cold (full temperature scan) then warm (cached lock point)
+    rp = controller(RedPitayaPID, 'sim:104', **latency)
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(n + 1):
+            with Measurement(rp.link) as m:
+                locked = rp.supervisor.acquire()
+            times.append(m.time)
+    return {'time_to_lock_cold_s': times[0], 'time_to_lock_warm_s': float(np.median(times[1:])),
+            'settle_s': rp.settle_detector.stats()['mean'], 'locked': locked}
+
+
+def bench_env_step(n: int, **latency) -> dict:
+    rp = controller(RedPitayaScope, 'sim:105', **latency)
+    with contextlib.redirect_stdout(io.StringIO()):
+        env = RedPitayaEnv(rp, rate=None)
+        steps = 0
+        with Measurement(rp.link) as m:
+            while steps < n:
+                _, _, done, _, _ = env.step(np.zeros(1, dtype=np.float32))
+                steps += 1
+                if done:
+                    break
+    return {'env_steps_per_s': steps / m.time, 'round_trips_per_step': m.round_trips / steps}
+
+
+def bench_skip_steps(n: int, **latency) -> dict:
+    rp = controller(RedPitayaScope, 'sim:106', **latency)
+    with contextlib.redirect_stdout(io.StringIO()):
+        env = SkipSteps(RedPitayaEnv(rp, rate=None), skip=10, rate=None)
+        steps = 0
+        with Measurement(rp.link) as m:
+            while steps < n:
+                _, _, done, _, _ = env.step(np.zeros(1, dtype=np.float32))
+                steps += 1
+                if done:
+                    break
+    return {'skip_steps_per_s': steps / m.time, 'round_trips_per_skip_step': m.round_trips / steps}
+
+
+def bench_qlearning(n: int, **latency) -> dict:
+    # n episodes of an untrained agent, each from reset and lock to lock loss, without pacing; the Q table
+    # checkpoints go to the scratch directory
+    rp = controller(RedPitayaQLearningNoPID, 'sim:107', num_episodes=n, rate=None, **latency)
+    rp.engine.rng = np.random.default_rng(0)
+    instrumentation = Instrumentation().attach(rp.supervisor, ('acquire',), 'supervisor').attach(rp.engine, ('act',),
+                                                                                                'engine')
+    with contextlib.redirect_stdout(io.StringIO()):
+        with Measurement(rp.link) as m:
+            rp.qlearning(0)
+    steps = instrumentation.histogram('engine.act').count
+    control = m.time - instrumentation.histogram('supervisor.acquire').total
+    return {'episode_s': m.time / n, 'steps_per_episode': steps / n,
+            'control_steps_per_s': steps / control if control > 0 else 0.,
+            'round_trips_per_episode': m.round_trips / n}
+
+
+# scenario: (function, repetitions, repetitions of the memory pass)
+SCENARIOS = {
+    'scope_ordered': (bench_scope, 50, 5),
+    'scan_temperature': (bench_scan_temperature, 3, 1),
+    'lock_cavity': (bench_lock_cavity, 10, 1),
+    'time_to_lock': (bench_time_to_lock, 3, 1),
+    'env_step': (bench_env_step, 300, 20),
+    'skip_steps': (bench_skip_steps, 30, 2),
+    'qlearning_episode': (bench_qlearning, 3, 1),
+}
+# metrics compared against a baseline: +1 higher is better, -1 lower is better
+DIRECTIONS = {'scope_ms': -1, 'scopes_per_s': 1, 'round_trips_per_scope': -1, 'scan_s': -1,
+              'scan_round_trips': -1, 'lock_cavity_ms': -1, 'lock_cavity_round_trips': -1, 'fit_ms': -1,
+              'time_to_lock_cold_s': -1, 'time_to_lock_warm_s': -1, 'env_steps_per_s': 1,
+              'round_trips_per_step': -1, 'skip_steps_per_s': 1, 'round_trips_per_skip_step': -1,
+              'episode_s': -1, 'control_steps_per_s': 1,
+              'round_trips_per_episode': -1, 'peak_memory_mb': -1}
+
+
+def run(scenarios=None, register_latency: float = 0., acquisition_latency: float = 0., memory: bool = True,
+        scale: float = 1.) -> dict:
+    latency = {'register_latency': register_latency, 'acquisition_latency': acquisition_latency}
+    results = {}
+    cwd = os.getcwd()
+    # the lock caches and lock traces the controllers write go to a scratch directory
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            for name in scenarios or SCENARIOS:
+                fn, n, n_memory = SCENARIOS[name]
+                results[name] = fn(max(1, int(n * scale)), **latency)
+                if memory:
+                    tracemalloc.start()
+                    fn(n_memory, **latency)
+                    results[name]['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                    tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+    return {'meta': {'python': platform.python_version(), 'machine': platform.machine(), 'time': time.time(),
+                     **latency}, 'results': results}
+
+
+def compare(current: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    # metrics that got worse than the baseline by more than `tolerance` (relative)
+    regressions = []
+    for name, metrics in current['results'].items():
+        for metric, value in metrics.items():
+            direction = DIRECTIONS.get(metric)
+            base = baseline['results'].get(name, {}).get(metric)
+            if direction is None or base is None or base == 0:
+                continue
+            change = (value - base) / abs(base)
+            if -direction * change > tolerance:
+                regressions.append((name, metric, base, value, change))
+    return regressions
+
+
+def report(current: dict, baseline: dict = None) -> str:
+    lines = [f'{"scenario":18s} {"metric":26s} {"value":>12s} {"baseline":>12s} {"change":>8s}']
+    for name, metrics in current['results'].items():
+        for metric, value in metrics.items():
+            base = None if baseline is None else baseline['results'].get(name, {}).get(metric)
+            change = '' if base in (None, 0) or isinstance(value, bool) else f'{100 * (value - base) / abs(base):+.0f}%'
+            lines.append(f'{name:18s} {metric:26s} {float(value):12.4g} '
+                         f'{"" if base is None else f"{float(base):12.4g}":>12s} {change:>8s}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='lock and control loop benchmarks on the cavity simulator')
+    parser.add_argument('scenarios', nargs='*', help=f'any of {", ".join(SCENARIOS)}, all when none given')
+    parser.add_argument('--register-latency', type=float, default=0., help='seconds per register round-trip')
+    parser.add_argument('--acquisition-latency', type=float, default=0., help='seconds per scope acquisition')
+    parser.add_argument('--scale', type=float, default=1., help='multiplies the repetitions')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory pass')
+    parser.add_argument('--save', help='write the results as a json baseline')
+    parser.add_argument('--compare', help='json baseline to flag regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change counted as a regression')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios {", ".join(sorted(unknown))}')
+    current = run(args.scenarios, args.register_latency, args.acquisition_latency, not args.no_memory, args.scale)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(report(current, baseline))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2)
+    if baseline is not None:
+        regressions = compare(current, baseline, args.tolerance)
+        for name, metric, base, value, change in regressions:
+            print(f'REGRESSION {name}.{metric}: {base:.4g} -> {value:.4g} ({100 * change:+.0f}%)')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,294 @@
+import multiprocessing
+import time
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from rprecorder import INDEX_DTYPE, TraceRecorder
+
+# header words of the shared memory block, followed by the dtype string, the slot versions, the slot metadata
+# (rprecorder.INDEX_DTYPE) and the (n_slots, channels, length) samples
+MAGIC = 0x52504255530001
+HEAD, N_SLOTS, CHANNELS, LENGTH, CLOSED = 1, 2, 3, 4, 5
+HEADER_WORDS = 8
+DTYPE_SIZE = 16
+ALIGNMENT = 64
+
+
+def _layout(n_slots: int, channels: int, length: int, dtype: np.dtype):
+    # byte offsets of the versions, metadata and samples, and the total size
+    def align(n):
+        return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    versions = align(8 * HEADER_WORDS + DTYPE_SIZE)
+    meta = align(versions + 8 * n_slots)
+    data = align(meta + INDEX_DTYPE.itemsize * n_slots)
+    return versions, meta, data, data + n_slots * channels * length * dtype.itemsize
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # Attach without registering the block with this process' resource tracker, which would unlink it when a
+    # subscriber exits (track=False from Python 3.13 on).
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+    register = resource_tracker.register
+    resource_tracker.register = lambda n, rtype: None if rtype == 'shared_memory' else register(n, rtype)
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+
+class _Ring:
+    # numpy views of a bus block
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.header = np.ndarray(HEADER_WORDS, np.int64, shm.buf)
+        if self.header[0] != MAGIC:
+            raise ValueError(f'{shm.name} is not a trace bus')
+        n_slots, channels, length = (int(self.header[k]) for k in (N_SLOTS, CHANNELS, LENGTH))
+        self.dtype = np.dtype(bytes(shm.buf[8 * HEADER_WORDS:8 * HEADER_WORDS + DTYPE_SIZE]).rstrip(b'\0').decode())
+        versions, meta, data, _ = _layout(n_slots, channels, length, self.dtype)
+        self.versions = np.ndarray(n_slots, np.int64, shm.buf, versions)
+        self.meta = np.ndarray(n_slots, INDEX_DTYPE, shm.buf, meta)
+        self.data = np.ndarray((n_slots, channels, length), self.dtype, shm.buf, data)
+        self.n_slots = n_slots
+
+    def release(self):
+        # the views must go before the block can be closed
+        self.header = self.versions = self.meta = self.data = None
+
+
+@dataclass
+class BusTrace:
+    # data is (channels, length); for a zero copy subscriber it is a view of the ring slot, valid until
+    # TraceSubscriber.valid() says the slot was overwritten
+    sequence: int
+    data: np.ndarray
+    counter: int
+    timestamp: float
+    dac2: float
+    locked: bool
+    transmission: float
+
+
+class TraceBus:
+    # Publishing side of a shared memory ring of scope traces. publish() writes each trace once into the next
+    # of `n_slots` slots and never waits for subscribers: TraceSubscribers in any process read the slots in
+    # place and detect themselves when the publisher lapped them. Every slot is a seqlock, its version is odd
+    # while the slot is written and 2 * sequence + 2 once trace `sequence` is complete. close() ends the
+    # stream, unlink() (or leaving a with block) frees the block after the subscribers are done with it.
+    def __init__(self, name: str = None, length: int = 2 ** 14, channels: int = 2, n_slots: int = 64,
+                 dtype: str = 'float32'):
+        dtype = np.dtype(dtype)
+        size = _layout(n_slots, channels, length, dtype)[3]
+        self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.name = self.shm.name
+        header = np.ndarray(HEADER_WORDS, np.int64, self.shm.buf)
+        header[:] = 0
+        header[HEAD] = -1
+        header[N_SLOTS], header[CHANNELS], header[LENGTH] = n_slots, channels, length
+        self.shm.buf[8 * HEADER_WORDS:8 * HEADER_WORDS + DTYPE_SIZE] = dtype.str.encode().ljust(DTYPE_SIZE, b'\0')
+        header[0] = MAGIC
+        del header
+        self._ring = _Ring(self.shm)
+        self._ring.versions[:] = 0
+        self.n_slots = n_slots
+        self.published = 0
+
+    @property
+    def head(self) -> int:
+        return int(self._ring.header[HEAD])
+
+    def publish(self, traces, dac2: float = np.nan, locked: bool = False, counter: int = -1,
+                timestamp: float = None, transmission: float = np.nan) -> int:
+        # traces: one array per channel; returns the sequence number of the trace
+        ring = self._ring
+        seq = int(ring.header[HEAD]) + 1
+        slot = seq % self.n_slots
+        ring.versions[slot] = 2 * seq + 1
+        for channel, trace in enumerate(traces):
+            ring.data[slot, channel] = trace
+        ring.meta[slot] = (counter, time.time() if timestamp is None else timestamp, dac2, locked, transmission)
+        ring.versions[slot] = 2 * seq + 2
+        ring.header[HEAD] = seq
+        self.published += 1
+        return seq
+
+    def close(self) -> None:
+        # subscribers finish the traces still in the ring and stop; the block stays until unlink(), so a
+        # subscriber process that is still starting can attach and drain it
+        if self._ring is None:
+            return
+        self._ring.header[CLOSED] = 1
+        self._ring.release()
+        self._ring = None
+        self.shm.close()
+
+    def unlink(self) -> None:
+        # removes the block, once the subscriber processes have exited
+        self.close()
+        if self.shm is not None:
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.unlink()
+        return False
+
+
+class TraceSubscriber:
+    # Reading side of a TraceBus, attached by name from any process. Traces come in order from `start` (the
+    # next published trace by default, 0 for the oldest still in the ring). With copy=False the data of a
+    # BusTrace is a view of its slot: check valid() after using it, a False means the publisher overwrote the
+    # slot meanwhile. With copy=True the copy is checked before it is returned. A subscriber lapped by the
+    # publisher skips to the oldest trace still in the ring; skipped and torn traces are counted as dropped.
+    def __init__(self, name: str, start: int = None, copy: bool = False, interval: float = 1e-4):
+        self.shm = _attach(name)
+        self._ring = _Ring(self.shm)
+        self.name = name
+        self.n_slots = self._ring.n_slots
+        self.copy = copy
+        self.interval = interval
+        self.sequence = self.head + 1 if start is None else start
+        self.received = 0
+        self.dropped = 0
+        self.overruns = 0
+
+    @property
+    def head(self) -> int:
+        return int(self._ring.header[HEAD])
+
+    @property
+    def closed(self) -> bool:
+        return bool(self._ring.header[CLOSED])
+
+    def _read(self, seq: int):
+        ring = self._ring
+        slot = seq % self.n_slots
+        if ring.versions[slot] != 2 * seq + 2:
+            return None
+        data = ring.data[slot].copy() if self.copy else ring.data[slot]
+        counter, timestamp, dac2, locked, transmission = ring.meta[slot].item()
+        if ring.versions[slot] != 2 * seq + 2:
+            return None
+        return BusTrace(seq, data, counter, timestamp, dac2, locked, transmission)
+
+    def valid(self, trace: BusTrace) -> bool:
+        return self._ring.versions[trace.sequence % self.n_slots] == 2 * trace.sequence + 2
+
+    def poll(self):
+        # the next trace, None when there is no new one
+        while self.sequence <= self.head:
+            oldest = self.head - self.n_slots + 1
+            if self.sequence < oldest:
+                self.dropped += oldest - self.sequence
+                self.overruns += 1
+                self.sequence = oldest
+            trace = self._read(self.sequence)
+            self.sequence += 1
+            if trace is not None:
+                self.received += 1
+                return trace
+            # overwritten while it was read
+            self.dropped += 1
+            self.overruns += 1
+        return None
+
+    def next(self, timeout: float = None):
+        # the next trace, waiting for it; None on timeout or once the bus is closed and drained
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            trace = self.poll()
+            if trace is not None:
+                return trace
+            if self.closed:
+                # the last traces may have been published between the poll and the close
+                return self.poll()
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(self.interval)
+
+    def latest(self):
+        # the newest trace, skipping (and counting as dropped) everything before it
+        head = self.head
+        if head >= self.sequence:
+            self.dropped += head - self.sequence
+            self.sequence = head
+        return self.poll()
+
+    def traces(self, timeout: float = None):
+        # yields every trace until the bus is closed, or until nothing arrives for `timeout` seconds
+        while True:
+            trace = self.next(timeout)
+            if trace is None:
+                return
+            yield trace
+
+    def __iter__(self):
+        return self.traces()
+
+    def stats(self) -> dict:
+        return {'received': self.received, 'dropped': self.dropped, 'overruns': self.overruns,
+                'lag': max(self.head - self.sequence + 1, 0)}
+
+    def close(self) -> None:
+        if self._ring is None:
+            return
+        self._ring.release()
+        self._ring = None
+        self.shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+
+def record_traces(name: str, path: str, channels=('ch1', 'ch2'), codec=None, timeout: float = None,
+                  indices=None, count: int = None) -> dict:
+    # subscriber process writing the traces of the bus to a TraceRecorder at `path`: the bus channels at
+    # `indices` (all by default) of the first `count` traces (all by default)
+    with TraceSubscriber(name, start=0, copy=True) as subscriber, \
+            TraceRecorder(path, channels, codec=codec) as recorder:
+        for trace in subscriber.traces(timeout):
+            recorder.record(trace.data if indices is None else trace.data[list(indices)], trace.dac2, trace.locked,
+                            trace.counter, trace.timestamp, trace.transmission)
+            if count is not None and subscriber.received >= count:
+                break
+        return subscriber.stats()
+
+
+def monitor_traces(name: str, interval: float = 1., timeout: float = None, sink=print) -> dict:
+    # subscriber process reporting the channel means of the newest trace every `interval` seconds, until the
+    # bus is closed or nothing arrives for `timeout` seconds
+    with TraceSubscriber(name) as subscriber:
+        last = time.monotonic()
+        while not subscriber.closed:
+            time.sleep(interval)
+            trace = subscriber.latest()
+            if trace is None:
+                if timeout is not None and time.monotonic() - last > timeout:
+                    break
+                continue
+            last = time.monotonic()
+            means = trace.data.mean(axis=1)
+            if subscriber.valid(trace):
+                sink(f'#{trace.counter} dac2={trace.dac2:.4f} transmission={trace.transmission:.4f} '
+                     f'means={np.array2string(means, precision=4)}')
+        return subscriber.stats()
+
+
+def start_subscriber(target, *args, **kwargs) -> multiprocessing.Process:
+    # runs record_traces, monitor_traces or any other subscriber function in its own (spawned) process
+    process = multiprocessing.get_context('spawn').Process(target=target, args=args, kwargs=kwargs,
+                                                           name=f'bus-{target.__name__}', daemon=True)
+    process.start()
+    return process
@@ -0,0 +1,216 @@
+import json
+import lzma
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = b'RPTRACE1'
+# payload offset alignment, so the samples of uncompressed files can be memory mapped
+ALIGN = 64
+INT14_MIN, INT14_MAX = -2 ** 13, 2 ** 13 - 1
+
+
+class TraceCodec:
+    # Sample encoding of scope traces.
+    # int14: the ADC code, value = code * scale + offset, stored as int16 (exact for scope data, 4x smaller
+    #        than float64); float16: half precision for derived signals; float32: no loss.
+    # compression: None (memory mappable), 'zlib' or 'lzma' of the sample deltas, with the bytes of each
+    # sample split into planes so the mostly constant high bytes compress well.
+    kinds = {'int14': np.int16, 'float16': np.float16, 'float32': np.float32}
+    compressions = (None, 'zlib', 'lzma')
+
+    def __init__(self, kind: str = 'int14', scale: float = 2. ** -13, offset: float = 0., compression: str = None,
+                 level: int = 1):
+        if kind not in self.kinds:
+            raise ValueError(f'unknown codec kind {kind}, expected one of {list(self.kinds)}')
+        if compression not in self.compressions:
+            raise ValueError(f'unknown compression {compression}, expected one of {self.compressions}')
+        self.kind = kind
+        self.scale = scale
+        self.offset = offset
+        self.compression = compression
+        self.level = level
+
+    @property
+    def dtype(self):
+        return np.dtype(self.kinds[self.kind])
+
+    def encode(self, x):
+        x = np.asarray(x)
+        if self.kind != 'int14':
+            return x.astype(self.dtype)
+        q = np.multiply(x - self.offset if self.offset else x, 1 / self.scale, dtype=np.float64)
+        np.rint(q, out=q)
+        np.clip(q, INT14_MIN, INT14_MAX, out=q)
+        return q.astype(np.int16)
+
+    def decode(self, q, dtype=np.float64):
+        if self.kind != 'int14':
+            return np.asarray(q, dtype=dtype)
+        x = np.multiply(q, self.scale, dtype=dtype)
+        if self.offset:
+            x += self.offset
+        return x
+
+    def compress(self, q) -> bytes:
+        q = np.ascontiguousarray(q, dtype=self.dtype)
+        if self.kind == 'int14':
+            # int16 deltas wrap around consistently and the cumulative sum undoes them exactly
+            d = q.copy()
+            d[..., 1:] = q[..., 1:] - q[..., :-1]
+            q = d
+        planes = q.view(np.uint8).reshape(-1, q.dtype.itemsize).T.tobytes()
+        if self.compression == 'lzma':
+            return lzma.compress(planes, preset=self.level)
+        return zlib.compress(planes, self.level)
+
+    def decompress(self, blob: bytes, shape):
+        planes = lzma.decompress(blob) if self.compression == 'lzma' else zlib.decompress(blob)
+        size = self.dtype.itemsize
+        q = np.frombuffer(planes, dtype=np.uint8).reshape(size, -1).T.copy().view(self.dtype).reshape(shape)
+        if self.kind == 'int14':
+            q = np.cumsum(q, axis=-1, dtype=np.int16)
+        return q
+
+    def to_dict(self) -> dict:
+        return {'kind': self.kind, 'scale': self.scale, 'offset': self.offset, 'compression': self.compression,
+                'level': self.level}
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(**d)
+
+    def __repr__(self):
+        return f'TraceCodec({", ".join(f"{k}={v!r}" for k, v in self.to_dict().items())})'
+
+
+def save_traces(path: str, traces, codec: TraceCodec = None, chunk_size: int = 16) -> int:
+    # Store an array of traces (first axis = trace) as a magic, a json header and the encoded samples, either
+    # raw or as compressed chunks of chunk_size traces. Returns the file size.
+    codec = TraceCodec() if codec is None else codec
+    traces = np.asarray(traces)
+    q = codec.encode(traces)
+    header = {'codec': codec.to_dict(), 'shape': list(q.shape), 'chunk_size': chunk_size, 'chunks': []}
+    if codec.compression is None:
+        payload = [q.tobytes()]
+    else:
+        payload = [codec.compress(q[i:i + chunk_size]) for i in range(0, q.shape[0], chunk_size)]
+        header['chunks'] = [len(blob) for blob in payload]
+    encoded = json.dumps(header).encode()
+    start = len(MAGIC) + 4 + len(encoded)
+    padding = b' ' * (-start % ALIGN)
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(encoded) + len(padding)) + encoded + padding)
+        for blob in payload:
+            f.write(blob)
+        return f.tell()
+
+
+def load_traces(path: str):
+    return EncodedTraces(path)
+
+
+class EncodedTraces:
+    # Lazy view of a save_traces file: indexing decodes only the selected traces. Uncompressed files are
+    # memory mapped (`raw` holds the codes without copying), compressed ones decode the chunks they touch and
+    # keep the last one.
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a trace file')
+            size, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(size))
+        self.codec = TraceCodec.from_dict(header['codec'])
+        self.shape = tuple(header['shape'])
+        self.chunk_size = header['chunk_size']
+        self.offset = len(MAGIC) + 4 + size
+        self.raw = None
+        if self.codec.compression is None:
+            self.raw = np.memmap(path, dtype=self.codec.dtype, mode='r', offset=self.offset, shape=self.shape)
+        else:
+            self._chunk_offsets = np.concatenate(([0], np.cumsum(header['chunks']))) + self.offset
+        self._cached = (None, None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self, i):
+        if self._cached[0] != i:
+            with open(self.path, 'rb') as f:
+                f.seek(self._chunk_offsets[i])
+                blob = f.read(self._chunk_offsets[i + 1] - self._chunk_offsets[i])
+            n = min(self.chunk_size, self.shape[0] - i * self.chunk_size)
+            self._cached = (i, self.codec.decompress(blob, (n,) + self.shape[1:]))
+        return self._cached[1]
+
+    def encoded(self, key):
+        # the stored codes of the selected traces
+        if self.raw is not None:
+            return self.raw[key]
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        rows = np.arange(self.shape[0])[key]
+        scalar = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+        out = np.empty((rows.shape[0],) + self.shape[1:], dtype=self.codec.dtype)
+        for chunk in np.unique(rows // self.chunk_size):
+            mask = rows // self.chunk_size == chunk
+            out[mask] = self._chunk(chunk)[rows[mask] - chunk * self.chunk_size]
+        out = out[0] if scalar else out
+        return out[(slice(None),) * (not scalar) + rest] if rest else out
+
+    def __getitem__(self, key):
+        return self.codec.decode(self.encoded(key))
+
+
+def _benchmark(n: int = 256):
+    # write/read throughput against np.save of float64 traces from the simulator
+    from rpsim import SimulatedRedPitaya
+    board = SimulatedRedPitaya('sim', seed=0)
+    board.asg0.setup(waveform='halframp', output_direct='out1', amplitude=0.5, offset=0.5,
+                     frequency=1 / (8e-9 * 2 ** 14 * 256))
+    board.scope.setup(decimation=256, input1='out1', input2='in2')
+    board.ams.dac2 = 0.2
+    traces = np.array([board.scope.single() for _ in range(n)])
+    mb = traces.nbytes / 1e6
+
+    codec = TraceCodec()
+    half = TraceCodec('float16')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rows = []
+        path = os.path.join(tmp, 'traces.npy')
+        t0 = time.perf_counter()
+        np.save(path, traces)
+        t1 = time.perf_counter()
+        loaded = np.load(path)
+        t2 = time.perf_counter()
+        rows.append(('np.save float64', os.path.getsize(path), t1 - t0, t2 - t1, np.abs(loaded - traces).max()))
+        for name, c in [('int14', codec), ('int14 zlib', TraceCodec(compression='zlib')),
+                        ('int14 lzma', TraceCodec(compression='lzma', level=0)), ('float16', half)]:
+            path = os.path.join(tmp, name.replace(' ', '_') + '.rpt')
+            t0 = time.perf_counter()
+            size = save_traces(path, traces, c)
+            t1 = time.perf_counter()
+            loaded = load_traces(path)[:]
+            t2 = time.perf_counter()
+            rows.append((name, size, t1 - t0, t2 - t1, np.abs(loaded - traces).max()))
+        for name, size, write, read, error in rows:
+            print(f'{name:16s} {size / 1e6:7.2f} MB ({traces.nbytes / size:4.1f}x)  write {mb / write:7.0f} MB/s  '
+                  f'read {mb / read:7.0f} MB/s  max error {error:.1e}')
+        # lazy access decodes a single trace
+        path = os.path.join(tmp, 'int14_zlib.rpt')
+        t0 = time.perf_counter()
+        trace = load_traces(path)[n // 2, 1]
+        print(f'single trace from int14 zlib: {1e3 * (time.perf_counter() - t0):.2f} ms, '
+              f'max error {np.abs(trace - traces[n // 2, 1]).max():.1e}')
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -1,56 +1,88 @@
 from redpitaya import RedPitaya
+from rpmonitor import RegisterTransaction
+from rptelemetry import Telemetry
 
 
 class RedPitayaController(RedPitaya):
     def __init__(self, hostname: str, user: str = 'root', password: str = 'root', config: str = 'fermi',
                  gui: bool = False):
         super().__init__(hostname, user, password, config, gui)
+        # every register access goes through the cache so unchanged values are not sent again; the cache, the lock
+        # and the transaction belong to the session, so all objects of a board share them
+        self.registers = self.session.registers
+        # serialises access to the board between the threads that share its session
+        self.io_lock = self.session.lock
+        self._transaction = self.session.transaction
+        # control loop events, lock events are printed and per-step events only recorded at DEBUG level
+        self.telemetry = Telemetry()
+        self.telemetry.debug('session', f'{hostname}: {self.session.refs} users, connected in '
+                                        f'{self.session.setup_times[-1]:.2f} s', value=self.session.setup_times[-1])
+
+    def close(self) -> None:
+        self.telemetry.close()
+        super().close()
+
+    def transaction(self) -> RegisterTransaction:
+        # `with self.transaction():` sends all register writes of the block in one network round-trip
+        return self._transaction
 
     def reset(self) -> None:
-        # Turn off arbitrary signal generator channel 0
-        self.set_asg0(output_direct='off', amp=0, offset=0)
-        # Turn off arbitrary signal generator channel 1
-        self.set_asg1(output_direct='off', amp=0, offset=0)
-        # Turn off I+Q quadrature demodulation/modulation modules
-        self.redpitaya.iq0.output = 'off'
-        self.set_iq0(output_direct='off')
-        # Turn off PID module 0
-        self.set_pid0(0, 0, 0, 0, 'off')
-        # Turn off dac2
-        self.set_dac2(0)
+        # a dropped connection is reopened before the board is reset
+        self.session.ensure()
+        with self.transaction():
+            # Turn off arbitrary signal generator channel 0
+            self.set_asg0(output_direct='off', amp=0, offset=0)
+            # Turn off arbitrary signal generator channel 1
+            self.set_asg1(output_direct='off', amp=0, offset=0)
+            # Turn off I+Q quadrature demodulation/modulation modules
+            self.registers.write('iq0', 'output', 'off')
+            self.set_iq0(output_direct='off')
+            # Turn off PID module 0
+            self.set_pid0(0, 0, 0, 0, 'off')
+            # Turn off dac2
+            self.set_dac2(0)
 
     def set_asg0(self, waveform: str = 'halframp', output_direct: str = 'out1', amp: float = 0.5,
                  offset: float = 0.5, freq: float = 1e2) -> None:
-        self.redpitaya.asg0.setup(waveform=waveform, output_direct=output_direct, trigger_source='immediately',
-                                  offset=offset, amplitude=amp, frequency=freq)
+        with self.transaction():
+            self.registers.setup('asg0', waveform=waveform, output_direct=output_direct, trigger_source='immediately',
+                                 offset=offset, amplitude=amp, frequency=freq)
 
     def set_asg1(self, waveform: str = 'halframp', output_direct: str = 'out1', amp: float = 0.5,
                  offset: float = 0.5, freq: float = 1e2) -> None:
-        self.redpitaya.asg1.setup(waveform=waveform, output_direct=output_direct, trigger_source='immediately',
-                                  offset=offset, amplitude=amp, frequency=freq)
+        with self.transaction():
+            self.registers.setup('asg1', waveform=waveform, output_direct=output_direct, trigger_source='immediately',
+                                 offset=offset, amplitude=amp, frequency=freq)
 
     def set_iq0(self, frequency: float = 25e6, bandwidth: list = [2e6, 2e6], gain: float = 0.5, phase: int = 0,
                 acbandwidth: float = 5e6, amplitude: float = 1., input: str = 'in1', output_direct: str = 'out2',
                 output_signal: str = 'quadrature', quadrature_factor: int = 1) -> None:
-        self.redpitaya.iq0.setup(frequency=frequency, bandwidth=bandwidth, gain=gain, phase=phase,
-                                 acbandwidth=acbandwidth, amplitude=amplitude, input=input, output_direct=output_direct,
-                                 output_signal=output_signal, quadrature_factor=quadrature_factor)
+        with self.transaction():
+            self.registers.setup('iq0', frequency=frequency, bandwidth=bandwidth, gain=gain, phase=phase,
+                                 acbandwidth=acbandwidth, amplitude=amplitude, input=input,
+                                 output_direct=output_direct, output_signal=output_signal,
+                                 quadrature_factor=quadrature_factor)
 
     def set_dac2(self, voltage: float = 0.) -> None:
-        self.redpitaya.ams.dac2 = voltage   # pin 17 output 0
+        # a single write, batched only when called inside a transaction
+        with self.io_lock:
+            self.registers.write('ams', 'dac2', voltage)   # pin 17 output 0
+
+    def get_dac2(self) -> float:
+        return self.registers.read('ams', 'dac2')
 
     def set_pid0(self, ival: float = 0, integrator: float = 1e3, proportional: float = 0,
                  differantiator: float = 0, input='iq0', output_direct: str = 'out1') -> None:
-        # Clear integrator
-        self.redpitaya.pid0.ival = ival
-        # Proportinal
-        self.redpitaya.pid0.p = proportional
-        # Integrator
-        self.redpitaya.pid0.i = integrator
-        # differentiator
-        self.redpitaya.pid0.d = differantiator
-        # input or output
-        self.redpitaya.pid0.input = input
-        self.redpitaya.pid0.output_direct = output_direct
-
+        with self.transaction():
+            # Clear integrator
+            self.registers.write('pid0', 'ival', ival)
+            # Proportinal
+            self.registers.write('pid0', 'p', proportional)
+            # Integrator
+            self.registers.write('pid0', 'i', integrator)
+            # differentiator
+            self.registers.write('pid0', 'd', differantiator)
+            # input or output
+            self.registers.write('pid0', 'input', input)
+            self.registers.write('pid0', 'output_direct', output_direct)
 
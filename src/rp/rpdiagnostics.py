@@ -0,0 +1,74 @@
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class FigureSink:
+    # Optional diagnostics of the lock loops: pdh_fit() queues the scope trace and fitted curve of a lock and a
+    # background thread draws it into a single reused Agg figure, saved as <path>/pdh_<hostname>_<n>.png (only
+    # the latest per board when keep=1). Nothing goes through pyplot, so no figures pile up and the lock loop
+    # never waits for matplotlib, which is imported on the first plot. A full queue drops the plot.
+    def __init__(self, path: str = 'plots', keep: int = 1, queue_size: int = 8, dpi: int = 100):
+        self.path = path
+        self.keep = keep
+        self.dpi = dpi
+        self.plotted = 0
+        self.dropped = 0
+        self._counts = {}
+        self._figure = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name='diagnostics', daemon=True)
+        self._thread.start()
+
+    def pdh_fit(self, hostname: str, ch1, ch2, fit) -> None:
+        try:
+            self._queue.put_nowait((hostname, np.array(ch1), np.array(ch2), np.array(fit), time.time()))
+        except queue.Full:
+            self.dropped += 1
+
+    def _axes(self):
+        if self._figure is None:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self._figure = Figure()
+            FigureCanvasAgg(self._figure)
+        self._figure.clear()
+        return self._figure.add_subplot()
+
+    def _draw(self, hostname, ch1, ch2, fit, timestamp):
+        axes = self._axes()
+        axes.set_title(f'PDH Error Signal, {hostname} {time.strftime("%H:%M:%S", time.localtime(timestamp))}')
+        axes.set_xlabel('PZT Drive Voltage (V)')
+        axes.set_ylabel('Error Signal (V)')
+        axes.grid(True)
+        axes.plot(ch1, ch2)
+        axes.plot(ch1, fit)
+        n = self._counts.get(hostname, 0)
+        self._counts[hostname] = n + 1
+        os.makedirs(self.path, exist_ok=True)
+        name = hostname.replace(':', '_').replace('/', '_')
+        self._figure.savefig(os.path.join(self.path, f'pdh_{name}_{n % self.keep}.png'), dpi=self.dpi)
+        self.plotted += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is not None:
+                    self._draw(*item)
+            except Exception as e:
+                print(f'Could not plot the PDH fit: {e}')
+            finally:
+                self._queue.task_done()
+            if item is None:
+                return
+
+    def flush(self) -> None:
+        self._queue.join()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
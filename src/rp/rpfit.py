@@ -0,0 +1,112 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class FitResult:
+    # params follow lorantian_derivative(x, A, B, g, x0)
+    params: np.ndarray
+    success: bool
+    rms: float
+    r_squared: float
+    nfev: int
+    n_points: int
+    latency: float
+
+    @property
+    def peak(self) -> float:
+        # height of the error signal extrema above the offset, 3 sqrt(3) / 8 A / g^3 at x0 -+ g / sqrt(3)
+        A, _, g, _ = self.params
+        return float(3 * np.sqrt(3) / 8 * abs(A) / g ** 3)
+
+    def __str__(self):
+        return (f'x0={self.params[3]:.5f} offset={self.params[1]:.5f} gamma={self.params[2]:.5f} '
+                f'rms={self.rms:.2e} r2={self.r_squared:.3f} nfev={self.nfev} points={self.n_points} '
+                f'latency={1e3 * self.latency:.1f} ms')
+
+
+class PDHFitter:
+    # Least squares fit of the derivative of a Lorentzian to a PDH error signal.
+    # The amplitude is fitted as a = A / g^3 so all four parameters are of order one, the initial guess comes
+    # from the extrema and the zero crossing, and only the samples within `window` linewidths of the
+    # resonance (at most `max_points` of them) are used.
+    def __init__(self, window: float = 8., max_points: int = 2000, smooth: int = 16, max_nfev: int = 200,
+                 min_r_squared: float = 0.5):
+        self.window = window
+        self.max_points = max_points
+        self.smooth = smooth
+        self.max_nfev = max_nfev
+        self.min_r_squared = min_r_squared
+
+    @staticmethod
+    def model(x, a, B, g, x0):
+        u = x - x0
+        return -2 * a * g ** 3 * u / (u ** 2 + g ** 2) ** 2 + B
+
+    @staticmethod
+    def jacobian(x, a, B, g, x0):
+        u = x - x0
+        d = u ** 2 + g ** 2
+        d3 = d ** 3
+        jac = np.empty((x.shape[0], 4))
+        jac[:, 0] = -2 * g ** 3 * u * d / d3
+        jac[:, 1] = 1.
+        jac[:, 2] = -2 * a * g ** 2 * u * (3 * d - 4 * g ** 2) / d3
+        jac[:, 3] = 2 * a * g ** 3 * (d - 4 * u ** 2) / d3
+        return jac
+
+    def initial_guess(self, x, y):
+        offset = np.median(y)
+        smooth = np.convolve(y, np.ones(self.smooth) / self.smooth, mode='same') if self.smooth > 1 else y
+        x_max, x_min = x[np.argmax(smooth)], x[np.argmin(smooth)]
+        # the extrema sit at x0 -+ g / sqrt(3)
+        g = np.sqrt(3) / 2 * abs(x_max - x_min)
+        x0 = (x_max + x_min) / 2
+        # refine x0 with the zero crossing of a line through the slope between the extrema
+        between = (x > min(x_max, x_min)) & (x < max(x_max, x_min))
+        if between.sum() > 2:
+            slope, intercept = np.polyfit(x[between], y[between] - offset, 1)
+            if slope != 0 and abs(-intercept / slope - x0) < g:
+                x0 = -intercept / slope
+        peak = smooth.max() - offset if x_max < x_min else smooth.min() - offset
+        a = peak * 8 * np.sqrt(3) / 9
+        return np.array([a, offset, g, x0])
+
+    def fit(self, x, y, warm_start=None) -> FitResult:
+        t0 = time.perf_counter()
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        p0 = self.initial_guess(x, y)
+        if warm_start is not None:
+            A, B, g, x0 = warm_start
+            warm = np.array([A / g ** 3, B, g, x0])
+            if x.min() < x0 < x.max() and self._cost(x, y, warm) < self._cost(x, y, p0):
+                p0 = warm
+
+        # keep the samples around the resonance, decimated to at most max_points
+        g, x0 = abs(p0[2]), p0[3]
+        mask = np.abs(x - x0) < self.window * g
+        xs, ys = (x[mask], y[mask]) if mask.sum() >= 8 else (x, y)
+        step = max(1, xs.shape[0] // self.max_points)
+        xs, ys = xs[::step], ys[::step]
+
+        # scipy is imported by the first fit rather than with the controllers
+        from scipy.optimize import least_squares
+        solution = least_squares(lambda p: self.model(xs, *p) - ys, p0, jac=lambda p: self.jacobian(xs, *p),
+                                 method='lm', max_nfev=self.max_nfev)
+        a, B, g, x0 = solution.x
+        # the model only depends on a g^3 and g^2, so A keeps its sign when the fit converges to a negative g
+        A = a * g ** 3
+        g = abs(g)
+        residuals = solution.fun
+        rms = float(np.sqrt(np.mean(residuals ** 2)))
+        total = np.sum((ys - ys.mean()) ** 2)
+        r_squared = float(1 - np.sum(residuals ** 2) / total) if total > 0 else 0.
+        success = bool(solution.status > 0 and g > 0 and x.min() < x0 < x.max() and r_squared >= self.min_r_squared)
+        return FitResult(np.array([A, B, g, x0]), success, rms, r_squared, int(solution.nfev),
+                         int(xs.shape[0]), time.perf_counter() - t0)
+
+    def _cost(self, x, y, p):
+        return np.sum((self.model(x, *p) - y) ** 2)
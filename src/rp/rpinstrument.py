@@ -0,0 +1,173 @@
+import functools
+import math
+import threading
+import time
+
+import numpy as np
+
+# latency histogram bins: 10 per decade from 1 us to 100 s
+BINS_PER_DECADE = 10
+MIN_EXPONENT, MAX_EXPONENT = -6, 2
+N_BINS = (MAX_EXPONENT - MIN_EXPONENT) * BINS_PER_DECADE
+
+
+class LatencyHistogram:
+    # Log-binned latencies: adding one costs a log10 and an increment, percentiles are read off the bin
+    # edges (within 12% of the true value).
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.counts = np.zeros(N_BINS + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds: float) -> None:
+        if seconds > 0:
+            i = int((math.log10(seconds) - MIN_EXPONENT) * BINS_PER_DECADE)
+            i = 0 if i < 0 else N_BINS if i > N_BINS else i
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        if self.count == 0:
+            return 0.
+        i = int(np.searchsorted(np.cumsum(self.counts), p / 100 * self.count))
+        # geometric centre of the bin, capped by the largest value seen
+        return min(10 ** (MIN_EXPONENT + (i + 0.5) / BINS_PER_DECADE), self.max)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.
+
+
+class Instrumentation:
+    # Opt-in latency recording. attach() replaces methods of an object by timed wrappers stored on the instance,
+    # detach() removes them again, so objects that are not attached run their methods untouched. Every call of
+    # a wrapped method goes into the histogram of its name; summary() returns p50/p99/mean/max and calls/s.
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        # RegisterCache objects whose counters are added to the summary
+        self.registers = {}
+        self._attached = []
+        self._register_base = {}
+        self._start = time.perf_counter()
+        self._reporter = None
+        self._stop = threading.Event()
+
+    def histogram(self, name: str) -> LatencyHistogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        return histogram
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def attach(self, obj, methods, prefix: str = None):
+        prefix = type(obj).__name__ if prefix is None else prefix
+        for name in methods:
+            method = getattr(obj, name, None)
+            if method is None or name in vars(obj):
+                continue
+            setattr(obj, name, self._timed(method, self.histogram(f'{prefix}.{name}')))
+            self._attached.append((obj, name))
+        return self
+
+    @staticmethod
+    def _timed(method, histogram):
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.add(time.perf_counter() - t0)
+        return timed
+
+    def detach(self) -> None:
+        for obj, name in self._attached:
+            vars(obj).pop(name, None)
+        self._attached = []
+        self.stop_reporting()
+
+    def reset(self) -> None:
+        for histogram in self.histograms.values():
+            histogram.clear()
+        self.counters = {name: 0 for name in self.counters}
+        self._register_base = {name: dict(cache.stats()) for name, cache in self.registers.items()}
+        self._start = time.perf_counter()
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self._start
+        calls = {name: {'calls': h.count, 'calls_per_s': h.count / elapsed if elapsed > 0 else 0.,
+                        'p50': h.percentile(50), 'p99': h.percentile(99), 'mean': h.mean, 'max': h.max}
+                 for name, h in self.histograms.items() if h.count}
+        counters = dict(self.counters)
+        for name, cache in self.registers.items():
+            base = self._register_base.get(name, {})
+            for key, value in cache.stats().items():
+                counters[f'{name}.{key}'] = value - base.get(key, 0)
+        return {'elapsed': elapsed, 'calls': calls, 'counters': counters}
+
+    def report(self) -> str:
+        summary = self.summary()
+        lines = [f'{"call":36s} {"calls":>7s} {"1/s":>8s} {"p50 ms":>9s} {"p99 ms":>9s} {"max ms":>9s}']
+        for name, s in sorted(summary['calls'].items(), key=lambda item: -item[1]['mean'] * item[1]['calls']):
+            lines.append(f'{name:36s} {s["calls"]:7d} {s["calls_per_s"]:8.1f} {1e3 * s["p50"]:9.3f} '
+                         f'{1e3 * s["p99"]:9.3f} {1e3 * s["max"]:9.3f}')
+        lines.extend(f'{name:36s} {value:7d}' for name, value in sorted(summary['counters'].items()))
+        return '\n'.join(lines)
+
+    def start_reporting(self, interval: float = 60., sink=print) -> None:
+        # calls sink(report()) every `interval` seconds from a background thread
+        self.stop_reporting()
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                sink(self.report())
+        self._reporter = threading.Thread(target=run, name='instrumentation-report', daemon=True)
+        self._reporter.start()
+
+    def stop_reporting(self) -> None:
+        if self._reporter is not None:
+            self._stop.set()
+            self._reporter.join()
+            self._reporter = None
+
+
+# the hot paths of the controller classes and of RedPitayaEnv
+CONTROLLER_METHODS = ('reset', 'set_asg0', 'set_asg1', 'set_iq0', 'set_dac2', 'get_dac2', 'set_pid0', 'scope',
+                      'lock_check', 'measure_temperature', 'scan_temperature', 'lock_cavity')
+ENV_METHODS = ('reset', 'step', 'scan_temperature', 'lock_cavity')
+
+
+def instrument(target, instrumentation: Instrumentation = None) -> Instrumentation:
+    # attach to a RedPitayaController (or subclass) or a RedPitayaEnv and the controller it drives
+    instrumentation = Instrumentation() if instrumentation is None else instrumentation
+    controller = getattr(target, 'rp', None)
+    if controller is not None:
+        instrumentation.attach(target, ENV_METHODS, 'env')
+    else:
+        controller = target
+    instrumentation.attach(controller, CONTROLLER_METHODS, 'rp')
+    for obj in (target, controller):
+        fitter = getattr(obj, 'fitter', None)
+        if fitter is not None:
+            instrumentation.attach(fitter, ('fit',), 'fitter')
+    # network level register I/O: the pyrpl monitor client, shared by all modules of the board
+    client = getattr(controller.redpitaya, 'client', None)
+    if client is not None:
+        instrumentation.attach(client, ('reads', 'writes'), 'client')
+    registers = getattr(controller, 'registers', None)
+    if registers is not None:
+        instrumentation.registers['registers'] = registers
+    return instrumentation
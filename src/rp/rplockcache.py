@@ -0,0 +1,122 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, asdict
+
+
+@dataclass
+class LockPoint:
+    temperature: float
+    amplitude: float
+    offset: float
+    gamma: float
+    x0: float
+    phase: float
+    timestamp: float = 0.
+
+    @property
+    def fit(self):
+        # initial guess for lorantian_derivative(x, A, B, g, x0)
+        return [self.amplitude, self.offset, self.gamma, self.x0]
+
+
+class LockPointCache:
+    # Last successful lock of every board, persisted as json so a restarted process relocks from it.
+    # A point older than max_age is ignored; a point whose narrow window scan fails is dropped.
+    # Several caches (controllers, processes) may share the file: save() merges the boards it changed into the
+    # entries on disk rather than overwriting them.
+    def __init__(self, path: str = 'lock_cache.json', max_age: float = 3600., window: float = 0.02):
+        self.path = path
+        self.max_age = max_age
+        # half width of the dac2 window scanned around a cached temperature
+        self.window = window
+        self._entries = {}
+        # one cache can be shared by the boards of a process, each thread writing its own hostname
+        self._lock = threading.Lock()
+        if path is not None:
+            self._entries = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        # a truncated or corrupt file costs a full scan, not the controller
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                return entries
+        except (OSError, ValueError) as e:
+            print(f'Ignoring the unreadable lock cache {self.path}: {e}')
+        return {}
+
+    def _entry(self, hostname):
+        with self._lock:
+            return self._entries.setdefault(hostname, {'hits': 0, 'misses': 0, 'point': None})
+
+    def get(self, hostname: str):
+        point = self._entry(hostname)['point']
+        if point is None or time.time() - point['timestamp'] > self.max_age:
+            return None
+        return LockPoint(**point)
+
+    def store(self, hostname: str, point: LockPoint) -> None:
+        point.timestamp = time.time()
+        self._entry(hostname)['point'] = {k: float(v) for k, v in asdict(point).items()}
+        self.save(hostname)
+
+    def invalidate(self, hostname: str = None) -> None:
+        hostnames = [hostname] if hostname is not None else list(self._entries)
+        for name in hostnames:
+            self._entry(name)['point'] = None
+        self.save(*hostnames)
+
+    def stats(self, hostname: str) -> dict:
+        entry = self._entry(hostname)
+        return {'hits': entry['hits'], 'misses': entry['misses']}
+
+    def save(self, *hostnames) -> None:
+        # writes the entries of `hostnames` (all of this cache's when none are given) over the ones on disk,
+        # keeping the other boards' entries and picking them up in memory
+        if self.path is None:
+            return
+        with self._lock:
+            entries = self._load()
+            for hostname in hostnames or list(self._entries):
+                entries[hostname] = self._entries[hostname]
+            for hostname, entry in entries.items():
+                if hostname not in self._entries:
+                    self._entries[hostname] = entry
+                elif self._entries[hostname] is not entry:
+                    self._entries[hostname].update(entry)
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.',
+                                       dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entries, f, indent=2)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+    def scan(self, hostname: str, search, measure, epsilon: int = 1000):
+        # scan a narrow dac2 window around the cached lock point first, the full range only on a miss
+        entry = self._entry(hostname)
+        point = self.get(hostname)
+        acquisitions, duration = 0, 0.
+        if point is not None:
+            result = search.search(measure, epsilon, max(point.temperature - self.window, 0.),
+                                   point.temperature + self.window)
+            if result.found:
+                entry['hits'] += 1
+                self.save(hostname)
+                return result
+            entry['point'] = None
+            acquisitions, duration = result.acquisitions, result.duration
+        entry['misses'] += 1
+        self.save(hostname)
+        result = search.search(measure, epsilon)
+        result.acquisitions += acquisitions
+        result.duration += duration
+        return result
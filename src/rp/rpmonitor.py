@@ -0,0 +1,242 @@
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+# pyrpl monitor server packets: 8 byte header (command, 0, uint16 length, uint32 address) then uint32 words
+HEADER = struct.Struct('<cBHI')
+MAX_LENGTH = 65535 - 2
+
+
+def header(command: bytes, length: int, addr: int) -> bytes:
+    return HEADER.pack(command, 0, length, addr)
+
+
+def _recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('monitor server closed the connection')
+        data += chunk
+    return data
+
+
+class MonitorSocketClient:
+    # Minimal client for the monitor server protocol with the reads/writes interface of
+    # pyrpl.redpitaya_client.MonitorClient.
+    def __init__(self, hostname: str = 'localhost', port: int = 2222, timeout: float = 1.):
+        self.socket = socket.create_connection((hostname, port), timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def reads(self, addr, length):
+        h = header(b'r', length, addr)
+        self.socket.sendall(h)
+        data = _recv_exactly(self.socket, 8 + 4 * length)
+        if data[:8] != h:
+            raise IOError('wrong control sequence from monitor server')
+        return np.frombuffer(data[8:], dtype=np.uint32)
+
+    def writes(self, addr, values):
+        values = np.asarray(values, dtype=np.uint32)
+        h = header(b'w', len(values), addr)
+        self.socket.sendall(h + values.tobytes())
+        if _recv_exactly(self.socket, 8) != h:
+            raise IOError('wrong control sequence from monitor server')
+        return True
+
+    def close(self):
+        try:
+            self.socket.sendall(header(b'c', 0, 0))
+        finally:
+            self.socket.close()
+
+
+class DeferredClient:
+    # Queues register writes and sends them in one pipelined burst: contiguous words are merged into one
+    # packet and all packets are written to the socket before the acknowledgements are read, so a flush
+    # costs a single network round-trip. Writes keep their order; reads of queued addresses are served from
+    # the queue, any other read flushes first.
+    def __init__(self, client):
+        self.client = client
+        self._runs = []
+        self.queued_writes = 0
+        self.packets = 0
+        self.flushes = 0
+
+    def writes(self, addr, values):
+        values = [int(v) & 0xFFFFFFFF for v in np.atleast_1d(values)]
+        self.queued_writes += 1
+        if self._runs:
+            start, run = self._runs[-1]
+            if addr == start + 4 * len(run) and len(run) + len(values) <= MAX_LENGTH:
+                run.extend(values)
+                return True
+        self._runs.append((addr, values))
+        return True
+
+    def _pending(self, addr):
+        for start, run in reversed(self._runs):
+            if start <= addr < start + 4 * len(run):
+                return run[(addr - start) // 4]
+        return None
+
+    def reads(self, addr, length):
+        values = [self._pending(a) for a in range(addr, addr + 4 * length, 4)]
+        if any(v is None for v in values):
+            self.flush()
+            return self.client.reads(addr, length)
+        return np.array(values, dtype=np.uint32)
+
+    def flush(self):
+        runs, self._runs = self._runs, []
+        if not runs:
+            return
+        self.flushes += 1
+        self.packets += len(runs)
+        sock = getattr(self.client, 'socket', None)
+        # a single packet goes through the client itself, with its retries and logging
+        if sock is None or len(runs) == 1:
+            for start, run in runs:
+                self.client.writes(start, run)
+            return
+        headers = [header(b'w', len(run), start) for start, run in runs]
+        sock.sendall(b''.join(h + np.asarray(run, dtype=np.uint32).tobytes() for h, (_, run) in zip(headers, runs)))
+        if _recv_exactly(sock, 8 * len(headers)) != b''.join(headers):
+            raise IOError('wrong control sequence from monitor server')
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class RegisterTransaction:
+    # Context manager that points every pyrpl module of a board at one DeferredClient and flushes it on exit.
+    # Transactions nest: only the outermost one flushes. Boards without monitor clients (the simulator)
+    # are written through directly.
+    def __init__(self, redpitaya, lock=None):
+        self.redpitaya = redpitaya
+        # held for the whole transaction so no other thread talks to the board in between
+        self.lock = lock if lock is not None else threading.RLock()
+        self.depth = 0
+        self.client = None
+        self._modules = []
+        self.round_trips = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            client = getattr(self.redpitaya, 'client', None)
+            modules = getattr(self.redpitaya, 'modules', {})
+            self._modules = [m for m in modules.values() if getattr(m, '_client', None) is not None]
+            if client is not None and self._modules:
+                self.client = DeferredClient(client)
+                for module in self._modules:
+                    module._client = self.client
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.depth -= 1
+            if self.depth > 0 or self.client is None:
+                return False
+            try:
+                self.client.flush()
+                self.round_trips += self.client.flushes
+            finally:
+                for module in self._modules:
+                    module._client = self.client.client
+                self.client = None
+        finally:
+            self.lock.release()
+        return False
+
+
+class MonitorServerStandIn:
+    # Local TCP stand-in for the pyrpl monitor server backed by a dict of registers. It counts packets and
+    # bytes, and sleeps `latency` seconds per burst of data received to emulate the network round-trip.
+    def __init__(self, host: str = 'localhost', port: int = 0, latency: float = 0.):
+        self.latency = latency
+        self.memory = {}
+        self.packets = {b'r': 0, b'w': 0}
+        self.bytes_received = 0
+        self.bursts = 0
+        self._server = socket.create_server((host, port))
+        self.address = self._server.getsockname()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self.address[1]
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = b''
+        with conn:
+            while True:
+                try:
+                    data = conn.recv(1 << 16)
+                except OSError:
+                    return
+                if not data:
+                    return
+                self.bursts += 1
+                self.bytes_received += len(data)
+                if self.latency:
+                    time.sleep(self.latency)
+                buffer += data
+                replies = []
+                while len(buffer) >= 8:
+                    command, _, length, addr = HEADER.unpack(buffer[:8])
+                    if command == b'c':
+                        conn.sendall(b''.join(replies))
+                        return
+                    if command == b'w':
+                        if len(buffer) < 8 + 4 * length:
+                            break
+                        values = np.frombuffer(buffer[8:8 + 4 * length], dtype=np.uint32)
+                        for i, value in enumerate(values):
+                            self.memory[addr + 4 * i] = int(value)
+                        replies.append(buffer[:8])
+                        buffer = buffer[8 + 4 * length:]
+                    else:
+                        values = np.array([self.memory.get(addr + 4 * i, 0) for i in range(length)], dtype=np.uint32)
+                        replies.append(buffer[:8] + values.tobytes())
+                        buffer = buffer[8:]
+                    self.packets[command] += 1
+                conn.sendall(b''.join(replies))
+
+    def close(self):
+        self._server.close()
+
+
+if __name__ == '__main__':
+    # 24 scattered register writes, one by one and as one transaction, over a 1 ms round-trip
+    server = MonitorServerStandIn(latency=0.001)
+    client = MonitorSocketClient('localhost', server.port)
+    addresses = [0x40300000 + 4 * i for i in range(0, 48, 2)]
+    t0 = time.perf_counter()
+    for a in addresses:
+        client.writes(a, [a])
+    direct = time.perf_counter() - t0, server.packets[b'w'], server.bursts
+    deferred = DeferredClient(client)
+    t0 = time.perf_counter()
+    for a in addresses:
+        deferred.writes(a, [a + 1])
+    deferred.flush()
+    batched = time.perf_counter() - t0, server.packets[b'w'] - direct[1], server.bursts - direct[2]
+    print(f'direct:  {1e3 * direct[0]:.1f} ms, {direct[1]} packets, {direct[2]} round-trips')
+    print(f'batched: {1e3 * batched[0]:.1f} ms, {batched[1]} packets, {batched[2]} round-trips')
+    client.close()
+    server.close()
@@ -0,0 +1,146 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rppid import RedPitayaPID
+from rplockcache import LockPointCache
+from rprecorder import TraceRecorder
+from rpcodec import TraceCodec
+from rpsupervisor import LockState
+
+
+class Orchestrator:
+    # Several boards from one process. Every board is a controller of its own (registers, io_lock, supervisor,
+    # settle detector, telemetry) driven by a thread of a pool, so the blocking pyrpl calls of one board never wait
+    # for another; only the lock point cache is shared, keyed by hostname. The methods run one step on all boards
+    # in parallel and return {hostname: result}; an exception is returned in place of the result of its board.
+    def __init__(self, hostnames, controller=RedPitayaPID, lock_cache: LockPointCache = None, **kwargs):
+        self.hostnames = list(hostnames)
+        self.executor = ThreadPoolExecutor(len(self.hostnames), thread_name_prefix='board')
+        self.lock_cache = LockPointCache() if lock_cache is None else lock_cache
+        # connecting takes seconds per board with pyrpl, so the boards are connected in parallel too
+        self.boards = {}
+        for hostname, board in self._map(lambda hostname: controller(hostname, **kwargs), self.hostnames).items():
+            if isinstance(board, Exception):
+                raise RuntimeError(f'could not connect to {hostname}') from board
+            board.lock_cache = self.lock_cache
+            self.boards[hostname] = board
+        self.recorders = {}
+        self.errors = {}
+        self._started = time.perf_counter()
+
+    def _map(self, fn, hostnames):
+        futures = {hostname: self.executor.submit(fn, hostname) for hostname in hostnames}
+        results = {}
+        for hostname, future in futures.items():
+            try:
+                results[hostname] = future.result()
+            except Exception as e:
+                self.errors[hostname] = e
+                results[hostname] = e
+        return results
+
+    def map(self, fn, hostnames=None) -> dict:
+        # fn(board) on every board in parallel
+        return self._map(lambda hostname: fn(self.boards[hostname]),
+                         self.hostnames if hostnames is None else hostnames)
+
+    def submit(self, hostname: str, fn, *args, **kwargs):
+        # fn(board, *args, **kwargs) on one board, returns a Future
+        return self.executor.submit(fn, self.boards[hostname], *args, **kwargs)
+
+    def reset(self) -> dict:
+        return self.map(lambda board: board.reset())
+
+    def scan(self, epsilon: int = 500) -> dict:
+        def scan(board):
+            board.ramp_piezo()
+            return board.scan_temperature(epsilon)
+        return self.map(scan)
+
+    def lock(self) -> dict:
+        # acquires the lock of every board, True where it succeeded
+        return self.map(lambda board: board.supervisor.acquire())
+
+    def run(self, duration: float = None, record: str = None, on_check=None) -> dict:
+        # keeps every board locked for `duration` seconds (until stop() when None), relocking after losses.
+        # With `record`, every monitor check also stores the out1 / asg0 traces of the board in
+        # record/<hostname>. on_check(hostname, board, check) is called from the thread of the board.
+        until = None if duration is None else time.time() + duration
+
+        def run(board):
+            hostname = board.hostname
+            recorder = None
+            if record is not None:
+                recorder = self.recorders.get(hostname)
+                if recorder is None:
+                    recorder = self.recorders[hostname] = TraceRecorder(os.path.join(record, hostname),
+                                                                        ('out1', 'iq0'), codec=TraceCodec())
+
+            def check(check):
+                if recorder is not None:
+                    out1, iq0 = board.scope(input2='asg0')
+                    recorder.record((out1, iq0), board.get_dac2(), check.max >= board.supervisor.lock_threshold,
+                                    transmission=check.max)
+                if on_check is not None:
+                    return on_check(hostname, board, check)
+            try:
+                board.supervisor.run(check, until)
+            finally:
+                if recorder is not None:
+                    recorder.flush()
+            return board.supervisor.stats()
+        return self.map(run)
+
+    def stop(self) -> None:
+        for board in self.boards.values():
+            board.supervisor.stop()
+
+    def metrics(self) -> dict:
+        # per board and aggregate lock uptime (time in MONITOR) and throughput since the orchestrator started
+        elapsed = time.perf_counter() - self._started
+        boards = {}
+        for hostname, board in self.boards.items():
+            supervisor = board.supervisor
+            uptime = supervisor.time_in(LockState.MONITOR)
+            recorder = self.recorders.get(hostname)
+            boards[hostname] = {'state': supervisor.state.value, 'uptime': uptime,
+                                'uptime_fraction': uptime / elapsed if elapsed > 0 else 0.,
+                                'locks': supervisor.locks, 'losses': supervisor.losses,
+                                'failures': sum(supervisor.failures.values()),
+                                'checks_per_s': supervisor.checks / elapsed if elapsed > 0 else 0.,
+                                'recorded': recorder.count if recorder is not None else 0,
+                                'error': repr(self.errors[hostname]) if hostname in self.errors else None}
+        total = {name: sum(board[name] for board in boards.values())
+                 for name in ('uptime', 'locks', 'losses', 'failures', 'checks_per_s', 'recorded')}
+        total['uptime_fraction'] = total['uptime'] / (elapsed * len(boards)) if elapsed > 0 and boards else 0.
+        total['recorded_per_s'] = total['recorded'] / elapsed if elapsed > 0 else 0.
+        return {'elapsed': elapsed, 'boards': boards, 'total': total}
+
+    def close(self) -> None:
+        self.stop()
+        self.executor.shutdown(wait=True)
+        for recorder in self.recorders.values():
+            recorder.close()
+        for board in self.boards.values():
+            board.reset()
+            board.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == '__main__':
+    # python rporchestrator.py 169.254.167.128 169.254.167.129 ...
+    hostnames = sys.argv[1:] or ['169.254.167.128']
+    with Orchestrator(hostnames) as orchestrator:
+        runner = threading.Thread(target=orchestrator.run, kwargs={'duration': 480, 'record': 'dataset'})
+        runner.start()
+        while runner.is_alive():
+            runner.join(60)
+            print(orchestrator.metrics()['total'])
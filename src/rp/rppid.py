@@ -1,14 +1,48 @@
-import numpy as np
-import scipy
-import matplotlib.pyplot as plt
+import json
 import time
+from dataclasses import dataclass, fields
+
 from rpscope import RedPitayaScope
+from rptempsearch import TemperatureSearch
+from rplockcache import LockPoint, LockPointCache
+from rpfit import PDHFitter
+from rpsupervisor import LockSupervisor
+from rptelemetry import DEBUG
+
+
+@dataclass
+class PIDGains:
+    # pid0 gains in pyrpl units and the offset added to the fitted setpoint relative to the PDH peak (the
+    # fitted FitResult.peak, as LoopModel.error_offset is relative to its error_amplitude); the defaults are the
+    # historical ones
+    p: float = 0.
+    i: float = 1e3
+    d: float = 0.
+    setpoint_offset: float = 0.
+
+    @classmethod
+    def load(cls, path: str):
+        # json written by pidtuning (rptuner.save_gains), keys other than the gains are ignored
+        with open(path) as f:
+            config = json.load(f)
+        return cls(**{f.name: float(config[f.name]) for f in fields(cls) if f.name in config})
 
 
 class RedPitayaPID(RedPitayaScope):
     def __init__(self, hostname: str, user: str = 'root', password: str = 'root', config: str = 'fermi',
                  gui: bool = False):
         super().__init__(hostname, user, password, config, gui)
+        self.temperature_search = TemperatureSearch()
+        self.lock_cache = LockPointCache()
+        self.fitter = PDHFitter()
+        self.pid_gains = PIDGains()
+        # the steps are looked up on every call, so instrumentation attached later sees them
+        self.supervisor = LockSupervisor(lambda: self.reset(), lambda: self.ramp_piezo(),
+                                         lambda: self.scan_temperature(500), lambda: self.lock_cavity(),
+                                         lambda: self.lock_check(('max', 'mean'), input1='out1'),
+                                         settle=self.settle_detector.wait,
+                                         on_locked=lambda point: self.lock_cache.store(self.hostname, point),
+                                         telemetry=self.telemetry)
 
     def scan_piezo(self, asg: bool = True, output_direct: str = 'out1', amp: float = 0.5,
                   offset: float = 0.5, freq: float = 1e2) -> None:
@@ -18,105 +52,89 @@ class RedPitayaPID(RedPitayaScope):
             self.set_asg1(waveform='halframp', output_direct=output_direct, amp=amp, offset=offset, freq=freq)
 
     def ramp_piezo(self, phase=15):
-        self.reset()
-        self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
-        self.set_iq0(phase=phase)
-
-    def lock_cavity(self, phase=20):
+        with self.transaction():
+            self.reset()
+            self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
+            self.set_iq0(phase=phase)
+
+    def lock_cavity(self, phase=None):
+        cached = self.lock_cache.get(self.hostname)
+        if phase is None:
+            phase = cached.phase if cached is not None else 20
         #####
         #   RAMP PIEZO
-        print("Scan Piezo")
-        self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
-        print("Run on Modulation")
-        self.set_iq0(phase=phase)
+        with self.transaction():
+            print("Scan Piezo")
+            self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
+            print("Run on Modulation")
+            self.set_iq0(phase=phase)
         ######
         print("Take a scope trace")
         scope_trace = self.scope('out1', 'iq0', trigger_source='ch1_positive_edge')
         print("Done taking scope trace")
-        np.save('scope_trace.npy', scope_trace)
+        self.save_lock_trace(scope_trace)
         print("Saved scope trace")
         ch1, ch2 = scope_trace
 
-        # Guess Initial Parameters
+        # Curve Fit, warm started from the last lock of this board
         print("Curve fit")
-        offs = np.mean(ch2)
-        gamma = (np.max(ch1) - np.min(ch1)) / 10
-        x0 = (np.max(ch1) - np.min(ch1)) / 2
-        amp = (np.max(ch2) - np.mean(ch2)) * (x0 ** 3)  # guessed,but don't guess the correct sign
-
-        # Curve Fit
-        poptLine, pcovLine = scipy.optimize.curve_fit(self.lorantian_derivative, ch1, ch2, p0=[amp, offs, gamma, x0])
-        fit = self.lorantian_derivative(ch1, poptLine[0], poptLine[1], poptLine[2], poptLine[3])
-        print("Plot")
-        # Plot Measured Data and Curve Fit
-        plt.figure(1)
-        plt.title("PDH Error Signal")
-        plt.xlabel("PZT Drive Voltage (V)")
-        plt.ylabel("Error Signal (V)")
-        plt.grid(True)
-        plt.plot(ch1, ch2)
-        plt.plot(ch1, fit)
-
-        print("Go back to resonance")
-        # Go to resonance (CONSTANT PIEZO)
-        # self.constantPzt(V=poptLine[3])
-        self.set_asg0(waveform='dc', output_direct='out1', offset=poptLine[3])
-
-        print("Close the feedback loop")
-        # Close the Feedback Loop
-        # Set PID gains and corner frequencies
-        # Set Point
-        self.redpitaya.pid0.setpoint = poptLine[1]
-        print('Setpoint ', poptLine[1])
-        self.set_pid0()
+        fit_result = self.fitter.fit(ch1, ch2, None if cached is None else cached.fit)
+        print(f'Fit: {fit_result}')
+        if not fit_result.success:
+            raise RuntimeError(f'PDH fit failed: {fit_result}')
+        poptLine = fit_result.params
+        # stored by the supervisor once the lock is confirmed
+        point = LockPoint(self.get_dac2(), *poptLine, phase)
+        if self.diagnostics is not None:
+            # Plot Measured Data and Curve Fit
+            fit = self.lorantian_derivative(ch1, poptLine[0], poptLine[1], poptLine[2], poptLine[3])
+            self.diagnostics.pdh_fit(self.hostname, ch1, ch2, fit)
+
+        with self.transaction():
+            print("Go back to resonance")
+            # Go to resonance (CONSTANT PIEZO)
+            # self.constantPzt(V=poptLine[3])
+            self.set_asg0(waveform='dc', output_direct='out1', offset=poptLine[3])
+
+            print("Close the feedback loop")
+            # Close the Feedback Loop
+            # Set PID gains and corner frequencies
+            # Set Point
+            gains = self.pid_gains
+            setpoint = poptLine[1] + gains.setpoint_offset * fit_result.peak
+            self.registers.write('pid0', 'setpoint', setpoint)
+            print('Setpoint ', setpoint)
+            self.set_pid0(integrator=gains.i, proportional=gains.p, differantiator=gains.d)
+        return point
+
+    def load_pid_gains(self, path: str = 'pid_gains.json') -> PIDGains:
+        # gains tuned by pidtuning, used from the next lock_cavity on
+        self.pid_gains = PIDGains.load(path)
+        return self.pid_gains
 
     @staticmethod
     def lorantian_derivative(x, A, B, g, x0):  # derivative a Lorantian
         return -2 * A * (x - x0) / (((x - x0) ** 2 + g ** 2) ** 2) + B
 
     def scan_temperature(self, epsilon=1000) -> bool:
-        for i in np.arange(0, 0.3, 0.00025):
-            # set temperature
-            self.set_dac2(i)
-            # take scope
-            _, blue_signal = self.scope(ordered=True)
-            half_scope_trace = int(blue_signal.shape[0]/2)
-
-            blue_signal_peak_index = np.where(blue_signal == blue_signal.max())[0][0]
-            if half_scope_trace - epsilon < blue_signal_peak_index < half_scope_trace + epsilon and \
-                    blue_signal.max() > .95:
-                print('Temperature: :', i)
-                return True
-        return False
+        result = self.lock_cache.scan(self.hostname, self.temperature_search, self.measure_temperature, epsilon)
+        if result.found:
+            print('Temperature: :', result.temperature, f'({result.acquisitions} acquisitions)')
+        return result.found
 
     def loop_auto_lock(self):
-        self.reset()
-        self.ramp_piezo()
-        if self.scan_temperature(500):
-            time.sleep(10)
-            try:
-                self.lock_cavity()
-            except:
-                self.loop_auto_lock()
-            starting_time = time.time()
-            print(f'Locked at: {starting_time}')
-            while True:
-                time.sleep(10)
-                print(f'Seconds after start: {time.time() - starting_time}')
-                purple_signal, blue_signal = self.scope()
-                print(f'purple (fast) signal mean: {purple_signal.mean()}')
-                print(f'blue signal mean: {blue_signal.mean()}')
-                if blue_signal.max() < 0.95:
-                    end_time = time.time()
-                    print(f'Lost lock at: {end_time}. Took {end_time-starting_time}')
-                    break
-        self.loop_auto_lock()
+        def monitor(check):
+            # transmission: max of the blue signal, signal_max and value: max and mean of the purple (fast) signal
+            if self.telemetry.enabled(DEBUG):
+                self.telemetry.debug('monitor', dac2=self.get_dac2(), transmission=check.max,
+                                     signal_max=check.ch1['max'], value=check.ch1['mean'])
+        self.supervisor.run(monitor)
 
     def lock_and_reset(self):
         self.reset()
         self.ramp_piezo()
         if self.scan_temperature(1000):
-            time.sleep(10)
+            self.wait_settled()
             self.lock_cavity()
             time.sleep(1)
             in1, _ = self.scope(input1='iq0')
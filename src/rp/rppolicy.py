@@ -0,0 +1,179 @@
+import time
+
+import numpy as np
+
+from rpinstrument import LatencyHistogram
+
+# activations of the policy network, applied in place
+ACTIVATIONS = {
+    'tanh': lambda x: np.tanh(x, out=x),
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'identity': lambda x: x,
+}
+
+
+def export_policy(model, path: str) -> None:
+    # Writes the deterministic actor of a stable_baselines3 PPO MlpPolicy (a model or the path of its .zip) to
+    # a .npz NumpyPolicy can load without torch: the policy_net layers, action_net and the action bounds.
+    if isinstance(model, str):
+        from stable_baselines3 import PPO
+        model = PPO.load(model, device='cpu')
+    from torch import nn
+    from stable_baselines3.common.torch_layers import FlattenExtractor
+    policy = model.policy
+    if not isinstance(policy.pi_features_extractor, FlattenExtractor):
+        raise ValueError(f'only MlpPolicy can be exported, not {type(policy.pi_features_extractor).__name__}')
+    arrays, activation = {}, 'identity'
+    n = 0
+    for module in policy.mlp_extractor.policy_net:
+        if isinstance(module, nn.Linear):
+            arrays[f'weight_{n}'] = module.weight.detach().cpu().numpy()
+            arrays[f'bias_{n}'] = module.bias.detach().cpu().numpy()
+            n += 1
+        else:
+            activation = type(module).__name__.lower()
+            if activation not in ACTIVATIONS:
+                raise ValueError(f'unsupported activation {type(module).__name__}')
+    arrays['action_weight'] = policy.action_net.weight.detach().cpu().numpy()
+    arrays['action_bias'] = policy.action_net.bias.detach().cpu().numpy()
+    space = model.action_space
+    np.savez(path, **arrays, activation=np.array(activation), squash=np.array(policy.squash_output),
+             low=space.low.astype(np.float32), high=space.high.astype(np.float32))
+
+
+class NumpyPolicy:
+    # Deterministic PPO actor in NumPy, loaded from export_policy(). Calling it with one observation runs the
+    # layers in float32 through buffers allocated once, so an action costs a few microseconds and no
+    # allocation; the returned array is one of those buffers and is overwritten by the next call.
+    # predict() takes a batch of observations and allocates.
+    def __init__(self, weights, biases, action_weight, action_bias, low, high, activation: str = 'tanh',
+                 squash: bool = False):
+        self.weights = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.ascontiguousarray(b, dtype=np.float32) for b in biases]
+        self.action_weight = np.ascontiguousarray(action_weight, dtype=np.float32)
+        self.action_bias = np.ascontiguousarray(action_bias, dtype=np.float32)
+        self.low = np.asarray(low, dtype=np.float32)
+        self.high = np.asarray(high, dtype=np.float32)
+        self.activation = activation
+        self._activation = ACTIVATIONS[activation]
+        self.squash = squash
+        n_in = self.weights[0].shape[1] if self.weights else self.action_weight.shape[1]
+        self._input = np.zeros(n_in, dtype=np.float32)
+        self._hidden = [np.zeros(w.shape[0], dtype=np.float32) for w in self.weights]
+        self._action = np.zeros(self.action_weight.shape[0], dtype=np.float32)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path, allow_pickle=False) as f:
+            n = sum(name.startswith('weight_') for name in f.files)
+            return cls([f[f'weight_{k}'] for k in range(n)], [f[f'bias_{k}'] for k in range(n)],
+                       f['action_weight'], f['action_bias'], f['low'], f['high'], str(f['activation']),
+                       bool(f['squash']))
+
+    @property
+    def observation_size(self) -> int:
+        return self._input.shape[0]
+
+    def __call__(self, observation):
+        x = self._input
+        x[:] = observation
+        for weight, bias, out in zip(self.weights, self.biases, self._hidden):
+            np.matmul(weight, x, out=out)
+            out += bias
+            x = self._activation(out)
+        action = self._action
+        np.matmul(self.action_weight, x, out=action)
+        action += self.action_bias
+        return self._bound(action)
+
+    def predict(self, observations):
+        x = np.asarray(observations, dtype=np.float32).reshape(-1, self.observation_size)
+        for weight, bias in zip(self.weights, self.biases):
+            x = self._activation(x @ weight.T + bias)
+        return self._bound(x @ self.action_weight.T + self.action_bias)
+
+    def _bound(self, action):
+        # what stable_baselines3 predict() does with a Box action: rescale a squashed action, clip otherwise
+        if self.squash:
+            np.tanh(action, out=action)
+            action += 1
+            action *= 0.5 * (self.high - self.low)
+            action += self.low
+            return action
+        return np.clip(action, self.low, self.high, out=action)
+
+
+def verify_policy(model, policy: NumpyPolicy, observations=None, n: int = 1000, atol: float = 1e-5,
+                  seed: int = 0) -> float:
+    # Compares the NumPy actor with the torch policy on `observations` (by default n samples of the observation
+    # space) through both the single observation and the batch path; returns the largest absolute difference
+    # and raises AssertionError above atol.
+    if observations is None:
+        space = model.observation_space
+        rng = np.random.default_rng(seed)
+        low = np.where(np.isfinite(space.low), space.low, -10.)
+        high = np.where(np.isfinite(space.high), space.high, 10.)
+        observations = rng.uniform(low, high, (n,) + space.shape)
+    observations = np.asarray(observations, dtype=np.float32)
+    expected, _ = model.predict(observations, deterministic=True)
+    expected = expected.reshape(observations.shape[0], -1)
+    single = np.array([policy(observation).copy() for observation in observations])
+    error = max(float(np.max(np.abs(single - expected))),
+                float(np.max(np.abs(policy.predict(observations) - expected))))
+    if error > atol:
+        raise AssertionError(f'NumPy policy differs from the torch policy by {error:.3g} > {atol:.3g}')
+    return error
+
+
+class PolicyRunner:
+    # Drives an env (RedPitayaEnv or any gymnasium env) with a policy: one action per env.step, the inference
+    # time of each action goes to a LatencyHistogram. run() stops after `steps` steps or `episodes` episodes,
+    # whichever comes first, resetting the env at the end of every episode.
+    def __init__(self, env, policy, telemetry=None):
+        self.env = env
+        self.policy = policy
+        self.telemetry = telemetry
+        self.inference = LatencyHistogram()
+        self.steps = 0
+        self.episodes = 0
+        self.total_reward = 0.
+
+    def run(self, steps: int = None, episodes: int = 1) -> dict:
+        observation, _ = self.env.reset()
+        start_steps, start_episodes = self.steps, self.episodes
+        while (steps is None or self.steps - start_steps < steps) and self.episodes - start_episodes < episodes:
+            t0 = time.perf_counter()
+            action = self.policy(observation)
+            self.inference.add(time.perf_counter() - t0)
+            observation, reward, terminated, truncated, _ = self.env.step(action)
+            self.steps += 1
+            self.total_reward += float(reward)
+            if terminated or truncated:
+                self.episodes += 1
+                if self.telemetry is not None:
+                    self.telemetry.debug('episode', steps=self.steps, episodes=self.episodes)
+                if self.episodes - start_episodes < episodes:
+                    observation, _ = self.env.reset()
+        return self.stats()
+
+    def stats(self) -> dict:
+        return {'steps': self.steps, 'episodes': self.episodes, 'total_reward': self.total_reward,
+                'inference_mean': self.inference.mean, 'inference_p99': self.inference.percentile(99),
+                'inference_max': self.inference.max}
+
+
+if __name__ == '__main__':
+    # python rppolicy.py model[.zip] [policy.npz]: export a trained PPO model and check it against torch
+    import sys
+    from stable_baselines3 import PPO
+    source = sys.argv[1]
+    target = sys.argv[2] if len(sys.argv) > 2 else source.removesuffix('.zip') + '.npz'
+    model = PPO.load(source, device='cpu')
+    export_policy(model, target)
+    policy = NumpyPolicy.load(target)
+    error = verify_policy(model, policy)
+    observation = np.zeros(policy.observation_size, dtype=np.float32)
+    t0 = time.perf_counter()
+    for _ in range(10000):
+        policy(observation)
+    print(f'{target}: max difference {error:.2e}, {1e6 * (time.perf_counter() - t0) / 10000:.1f} us per action')
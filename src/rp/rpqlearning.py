@@ -0,0 +1,221 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+class Discretizer:
+    # Maps values to the index of the nearest state centre. The bin edges are the midpoints between the centres,
+    # so np.digitize finds the bin with a binary search over arrays of any shape.
+    def __init__(self, centres):
+        self.centres = np.asarray(centres, dtype=float)
+        self.edges = (self.centres[1:] + self.centres[:-1]) / 2
+
+    def __len__(self):
+        return self.centres.shape[0]
+
+    def __call__(self, values):
+        return np.digitize(values, self.edges)
+
+
+class EpsilonSchedule:
+    # Exploration rate per episode: 'step' switches from start to end at `episodes`, 'linear' and 'exponential'
+    # decay from start to end over `episodes`.
+    def __init__(self, start: float = 0.7, end: float = None, episodes: int = 1000, kind: str = 'step'):
+        if kind not in ('step', 'linear', 'exponential'):
+            raise ValueError(f'unknown epsilon schedule {kind}')
+        self.start = start
+        self.end = start if end is None else end
+        self.episodes = episodes
+        self.kind = kind
+
+    def __call__(self, episode: int) -> float:
+        if self.kind == 'step':
+            return self.start if episode < self.episodes else self.end
+        progress = min(episode / self.episodes, 1.) if self.episodes > 0 else 1.
+        if self.kind == 'linear':
+            return self.start + (self.end - self.start) * progress
+        return self.start * (max(self.end, 1e-12) / self.start) ** progress if self.start > 0 else self.end
+
+
+class ReplayBuffer:
+    # Preallocated ring buffer of (state, action, reward, next state, done) transitions.
+    def __init__(self, capacity: int = 100_000):
+        self.capacity = capacity
+        self.states = np.zeros(capacity, dtype=np.int64)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity)
+        self.next_states = np.zeros(capacity, dtype=np.int64)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.size = 0
+        self._next = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, states, actions, rewards, next_states, dones) -> None:
+        states = np.atleast_1d(states)
+        slots = (self._next + np.arange(states.shape[0])) % self.capacity
+        self.states[slots] = states
+        self.actions[slots] = actions
+        self.rewards[slots] = rewards
+        self.next_states[slots] = next_states
+        self.dones[slots] = dones
+        self._next = (self._next + states.shape[0]) % self.capacity
+        self.size = min(self.size + states.shape[0], self.capacity)
+
+    def sample(self, batch_size: int, rng):
+        i = rng.integers(0, self.size, batch_size)
+        return self.states[i], self.actions[i], self.rewards[i], self.next_states[i], self.dones[i]
+
+
+class Checkpointer:
+    # Saves Q tables on a background thread. Only the newest pending table is kept, so a slow disk never
+    # queues up copies or blocks the caller.
+    def __init__(self):
+        self._queue = queue.Queue(1)
+        self._thread = threading.Thread(target=self._run, name='q-checkpoint', daemon=True)
+        self._thread.start()
+        self.saved = 0
+
+    def save(self, path: str, table) -> None:
+        item = (path, np.array(table))
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                except queue.Empty:
+                    pass
+
+    def wait(self) -> None:
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            path, table = self._queue.get()
+            try:
+                tmp = path + '.tmp.npy'
+                np.save(tmp, table)
+                os.replace(tmp, path)
+                self.saved += 1
+            except OSError as e:
+                print(f'Could not save {path}: {e}')
+            finally:
+                self._queue.task_done()
+
+
+class QLearningEngine:
+    # Tabular Q-learning on integer states. Transitions are applied as vectorized TD updates, one batch at a
+    # time: observe() updates from the transitions just taken and stores them, replay() updates from random
+    # batches of the stored ones. Repeated (state, action) pairs in a batch get the mean of their TD errors.
+    # With terminal_bootstrap (the original qlearning() rule) terminal transitions bootstrap from their next
+    # state like any other; without it their target is the reward alone.
+    def __init__(self, num_states: int, num_actions: int, learning_rate: float = 0.4, discount_factor: float = 0.99,
+                 epsilon=0.7, buffer_size: int = 100_000, batch_size: int = 256, seed=None, Q=None,
+                 terminal_bootstrap: bool = True):
+        self.num_states = num_states
+        self.num_actions = num_actions
+        self.learning_rate = learning_rate
+        self.discount_factor = discount_factor
+        self.terminal_bootstrap = terminal_bootstrap
+        self.epsilon_schedule = epsilon if callable(epsilon) else EpsilonSchedule(epsilon)
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.Q = np.zeros((num_states, num_actions)) if Q is None else np.asarray(Q, dtype=float)
+        self.buffer = ReplayBuffer(buffer_size)
+        self.episode = 0
+        self.updates = 0
+        self._checkpointer = None
+
+    @property
+    def epsilon(self) -> float:
+        return self.epsilon_schedule(self.episode)
+
+    def act(self, states, greedy: bool = False):
+        # epsilon-greedy actions for a state or an array of states
+        states = np.asarray(states)
+        actions = np.argmax(self.Q[states], axis=-1)
+        epsilon = 0. if greedy else self.epsilon
+        if epsilon > 0:
+            explore = self.rng.random(states.shape) < epsilon
+            actions = np.where(explore, self.rng.integers(0, self.num_actions, states.shape), actions)
+        return actions
+
+    def update(self, states, actions, rewards, next_states, dones=False) -> None:
+        states, actions = np.atleast_1d(states), np.atleast_1d(actions)
+        bootstrap = self.Q[next_states].max(axis=-1)
+        if not self.terminal_bootstrap:
+            bootstrap = bootstrap * ~np.asarray(dones)
+        targets = rewards + self.discount_factor * bootstrap
+        errors = np.broadcast_to(targets, states.shape) - self.Q[states, actions]
+        flat = states * self.num_actions + actions
+        if np.unique(flat).shape[0] == flat.shape[0]:
+            self.Q[states, actions] += self.learning_rate * errors
+        else:
+            total = np.bincount(flat, errors, self.Q.size)
+            count = np.bincount(flat, minlength=self.Q.size)
+            hit = count > 0
+            self.Q.reshape(-1)[hit] += self.learning_rate * total[hit] / count[hit]
+        self.updates += states.shape[0]
+
+    def observe(self, states, actions, rewards, next_states, dones=False) -> None:
+        self.update(states, actions, rewards, next_states, dones)
+        self.buffer.add(states, actions, rewards, next_states, dones)
+
+    def replay(self, batches: int = 1) -> None:
+        for _ in range(batches):
+            if len(self.buffer) == 0:
+                return
+            self.update(*self.buffer.sample(self.batch_size, self.rng))
+
+    def end_episode(self, n: int = 1) -> None:
+        self.episode += n
+
+    def checkpoint(self, path: str = 'q_qlearning.npy') -> None:
+        if self._checkpointer is None:
+            self._checkpointer = Checkpointer()
+        self._checkpointer.save(path, self.Q)
+
+    def wait(self) -> None:
+        # block until the pending checkpoint is written
+        if self._checkpointer is not None:
+            self._checkpointer.wait()
+
+
+def train(engine: QLearningEngine, venv, discretizer: Discretizer, action_values, steps: int,
+          replay_batches: int = 1, reward_fn=None):
+    # Trains on all environments of a gymnasium VectorEnv with same-step autoreset (RedPitayaVectorEnv, or
+    # SyncVectorEnv of RedPitayaReplayEnv) at once. States are the discretized observations, actions index
+    # action_values and the reward defaults to qlearning()'s: 1 while locked, 0 when the lock is lost.
+    action_values = np.asarray(action_values, dtype=np.float32)
+    obs, _ = venv.reset(seed=int(engine.rng.integers(2 ** 31)))
+    states = discretizer(np.asarray(obs).reshape(venv.num_envs))
+    returns = np.zeros(venv.num_envs)
+    episode_returns = []
+    for _ in range(steps):
+        actions = engine.act(states)
+        obs, rewards, terminations, truncations, infos = venv.step(action_values[actions].reshape(-1, 1))
+        if reward_fn is not None:
+            rewards = reward_fn(obs, rewards, terminations)
+        else:
+            rewards = (~terminations).astype(float)
+        done = terminations | truncations
+        # same-step autoreset: bootstrap finished episodes from their final observation
+        final = np.asarray(obs).reshape(venv.num_envs)
+        if '_final_obs' in infos and infos['_final_obs'].any():
+            final = final.copy()
+            for i in np.flatnonzero(infos['_final_obs']):
+                final[i] = np.asarray(infos['final_obs'][i]).reshape(-1)[0]
+        engine.observe(states, actions, rewards, discretizer(final), terminations)
+        engine.replay(replay_batches)
+        returns += rewards
+        episode_returns.extend(returns[done])
+        returns[done] = 0.
+        engine.end_episode(int(done.sum()))
+        states = discretizer(np.asarray(obs).reshape(venv.num_envs))
+    return np.array(episode_returns)
@@ -1,8 +1,13 @@
 import numpy as np
-import scipy
-import matplotlib.pyplot as plt
-import time
 from rpscope import RedPitayaScope
+from rptempsearch import TemperatureSearch
+from rplockcache import LockPoint, LockPointCache
+from rpfit import PDHFitter
+from rpqlearning import Discretizer, EpsilonSchedule, QLearningEngine
+from rpscheduler import RateScheduler
+from rpsupervisor import LockSupervisor
+from rpsession import simulated
+from rptelemetry import DEBUG
 
 
 def round_to_nearest_0_1(value):
@@ -16,11 +21,16 @@ def round_to_nearest_0_05(value):
 class RedPitayaQLearningNoPID(RedPitayaScope):
     def __init__(self, hostname: str, user: str = 'root', password: str = 'root', config: str = 'fermi',
                  gui: bool = False,  load=False, learning_rate=0.4, discout_factor=0.99, epsilon=0.7,
-                 num_episodes=5000, test=False):
+                 num_episodes=5000, test=False, rate=20., stream=None,
+                 terminal_bootstrap=True):
         super().__init__(hostname, user, password, config, gui)
+        self.temperature_search = TemperatureSearch()
+        self.lock_cache = LockPointCache()
+        self.fitter = PDHFitter()
 
         self.voltage_range = np.arange(-1, 1.1, 0.1)
         self.num_states = len(self.voltage_range)  # 21
+        self.discretizer = Discretizer(self.voltage_range)
         # actions
         self.action_range = np.arange(-.01, .015, .005)  # -.001, .0015, .0005
         self.num_actions = len(self.action_range)  # 5
@@ -37,9 +47,26 @@ class RedPitayaQLearningNoPID(RedPitayaScope):
         # Q-values
         if load:
             print('Loaded Q-Matrix')
-            self.Q = np.load('q_qlearning.npy')
+            Q = np.load('q_qlearning.npy')
         else:
-            self.Q = np.zeros((self.num_states, self.num_actions))
+            Q = None
+        # exploration drops to 0.3 after 1000 episodes
+        self.engine = QLearningEngine(self.num_states, self.num_actions, learning_rate, discout_factor,
+                                      EpsilonSchedule(self.epsilon, 0.3 if not test else 0., 1000), Q=Q,
+                                      terminal_bootstrap=terminal_bootstrap)
+        self.Q = self.engine.Q
+        # control steps per second
+        self.scheduler = RateScheduler(rate)
+        # while locked, traces are acquired in the background and every step reads the first one acquired after
+        # its action; off by default on the simulator, see RedPitayaEnv
+        self.stream_traces = not simulated(hostname) if stream is None else stream
+        # the steps are looked up on every call, so instrumentation attached later sees them
+        self.supervisor = LockSupervisor(lambda: self.reset(), lambda: self.ramp_piezo(),
+                                         lambda: self.scan_temperature(500), lambda: self.lock_cavity(),
+                                         lambda: self.lock_check(input1='out1'),
+                                         settle=self.settle_detector.wait,
+                                         on_locked=lambda point: self.lock_cache.store(self.hostname, point),
+                                         telemetry=self.telemetry)
 
     def scan_piezo(self, asg: bool = True, output_direct: str = 'out1', amp: float = 0.5,
                   offset: float = 0.5, freq: float = 1e2) -> None:
@@ -49,44 +76,43 @@ class RedPitayaQLearningNoPID(RedPitayaScope):
             self.set_asg1(waveform='halframp', output_direct=output_direct, amp=amp, offset=offset, freq=freq)
 
     def ramp_piezo(self, phase=15):
-        self.reset()
-        self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
-        self.set_iq0(phase=phase)
+        with self.transaction():
+            self.reset()
+            self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
+            self.set_iq0(phase=phase)
 
-    def lock_cavity(self, phase=20):
+    def lock_cavity(self, phase=None):
+        cached = self.lock_cache.get(self.hostname)
+        if phase is None:
+            phase = cached.phase if cached is not None else 20
         #####
         #   RAMP PIEZO
-        print("Scan Piezo")
-        self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
-        print("Run on Modulation")
-        self.set_iq0(phase=phase)
+        with self.transaction():
+            print("Scan Piezo")
+            self.scan_piezo(freq=1 / (8E-9 * (2 ** 14) * 256))
+            print("Run on Modulation")
+            self.set_iq0(phase=phase)
         ######
         print("Take a scope trace")
         scope_trace = self.scope('out1', 'iq0', trigger_source='ch1_positive_edge')
         print("Done taking scope trace")
-        np.save('scope_trace.npy', scope_trace)
+        self.save_lock_trace(scope_trace)
         print("Saved scope trace")
         ch1, ch2 = scope_trace
 
-        # Guess Initial Parameters
+        # Curve Fit, warm started from the last lock of this board
         print("Curve fit")
-        offs = np.mean(ch2)
-        gamma = (np.max(ch1) - np.min(ch1)) / 10
-        x0 = (np.max(ch1) - np.min(ch1)) / 2
-        amp = (np.max(ch2) - np.mean(ch2)) * (x0 ** 3)  # guessed,but don't guess the correct sign
-
-        # Curve Fit
-        poptLine, pcovLine = scipy.optimize.curve_fit(self.lorantian_derivative, ch1, ch2, p0=[amp, offs, gamma, x0])
-        fit = self.lorantian_derivative(ch1, poptLine[0], poptLine[1], poptLine[2], poptLine[3])
-        print("Plot")
-        # Plot Measured Data and Curve Fit
-        plt.figure(1)
-        plt.title("PDH Error Signal")
-        plt.xlabel("PZT Drive Voltage (V)")
-        plt.ylabel("Error Signal (V)")
-        plt.grid(True)
-        plt.plot(ch1, ch2)
-        plt.plot(ch1, fit)
+        fit_result = self.fitter.fit(ch1, ch2, None if cached is None else cached.fit)
+        print(f'Fit: {fit_result}')
+        if not fit_result.success:
+            raise RuntimeError(f'PDH fit failed: {fit_result}')
+        poptLine = fit_result.params
+        # stored by the supervisor once the lock is confirmed
+        point = LockPoint(self.get_dac2(), *poptLine, phase)
+        if self.diagnostics is not None:
+            # Plot Measured Data and Curve Fit
+            fit = self.lorantian_derivative(ch1, poptLine[0], poptLine[1], poptLine[2], poptLine[3])
+            self.diagnostics.pdh_fit(self.hostname, ch1, ch2, fit)
 
         print("Go back to resonance")
         # Go to resonance (CONSTANT PIEZO)
@@ -97,90 +123,81 @@ class RedPitayaQLearningNoPID(RedPitayaScope):
         # Close the Feedback Loop
         # Set PID gains and corner frequencies
         # Set Point
-        self.redpitaya.pid0.setpoint = poptLine[1]
+        self.registers.write('pid0', 'setpoint', poptLine[1])
         print('Setpoint ', poptLine[1])
         self.set_pid0()"""
+        return point
 
     @staticmethod
     def lorantian_derivative(x, A, B, g, x0):  # derivative a Lorantian
         return -2 * A * (x - x0) / (((x - x0) ** 2 + g ** 2) ** 2) + B
 
     def scan_temperature(self, epsilon=1000) -> bool:
-        for i in np.arange(0, 0.3, 0.00025):
-            # set temperature
-            self.set_dac2(i)
-            # take scope
-            _, blue_signal = self.scope(ordered=True)
-            half_scope_trace = int(blue_signal.shape[0]/2)
-
-            blue_signal_peak_index = np.where(blue_signal == blue_signal.max())[0][0]
-            if half_scope_trace - epsilon < blue_signal_peak_index < half_scope_trace + epsilon and \
-                    blue_signal.max() > .95:
-                print('Temperature: :', i)
-                return True
-        return False
+        result = self.lock_cache.scan(self.hostname, self.temperature_search, self.measure_temperature, epsilon)
+        if result.found:
+            print('Temperature: :', result.temperature, f'({result.acquisitions} acquisitions)')
+        return result.found
 
     def _get_state_index(self, temperature):
-        return np.argmin(np.abs(self.voltage_range - temperature))
+        return int(self.discretizer(temperature))
 
     def _get_action_index(self, action):
         return np.argmin(np.abs(self.action_range - action))
 
     def qlearning(self, episode: int = 0):
+        try:
+            self._qlearning(episode)
+        finally:
+            self.stop_stream()
+        self.engine.wait()
+
+    def _qlearning(self, episode):
         while episode < self.num_episodes:
-            print(f'EPISODE {episode}')
-            if episode == 1000 and not self.test:
-                self.epsilon = 0.3
-            self.reset()
-            self.ramp_piezo()
-            if self.scan_temperature(500):
-                time.sleep(10)
-                try:
-                    self.lock_cavity()
-                except:
-                    continue
-                system_unlock = False
-                print(f'\tLocked at: {time.time()}')
-                print(f'\tInitial temperature voltage: {self.redpitaya.ams.dac2}V')
-                purple_signal, blue_signal = self.scope()
-                print(f'\tFast signal max: {purple_signal.max()}')
-                print(f'\tPD Voltage after cavity max: {blue_signal.max()}')
-                state = self._get_state_index(round_to_nearest_0_1(purple_signal.max()))
-                while True:
-                    time.sleep(0.001)   # TODO: 1 0.1
-                    # Choose action using epsilon-greedy policy
-                    if np.random.rand() < self.epsilon and not self.test:
-                        action = np.random.choice(self.num_actions)
-                    else:
-                        action = np.argmax(self.Q[state, :])
-                    print(f'\tAction index: {action}')
-                    self.set_dac2(self.redpitaya.ams.dac2 + self.action_range[action])
-                    print(f'\tTemperature voltage: {self.redpitaya.ams.dac2}V')
-                    time.sleep(0.0001)    # TODO: 0.1 0.01
-                    # Get the next state, reward, and system_unlock
-                    purple_signal, blue_signal = self.scope()
-                    print(f'\tFast signal max: {purple_signal.max()}')
-                    print(f'\tPD Voltage after cavity max: {blue_signal.max()}')
-                    if blue_signal.max() < 0.95:
-                        print(f'\tLost lock at: {time.time()}')
-                        system_unlock = True
-                    next_state = self._get_state_index(round_to_nearest_0_1(purple_signal.max()))
-                    reward = 1 if not system_unlock else 0
-                    print(f'\tState index: {next_state}')
-                    # Update Q-values
+            telemetry = self.telemetry
+            telemetry.info('episode', episode=episode)
+            self.engine.episode = episode
+            self.stop_stream()
+            if not self.supervisor.acquire():
+                raise RuntimeError(f'could not lock the cavity in {self.supervisor.max_retries} attempts')
+            if self.stream_traces:
+                self.start_stream()
+            system_unlock = False
+            purple_signal, blue_signal = self.latest_trace()
+            state = self._get_state_index(purple_signal.max())
+            dac2 = self.get_dac2()
+            telemetry.info('locked', episode=episode, state=state, dac2=dac2, signal_max=purple_signal.max(),
+                           transmission=blue_signal.max())
+            self.scheduler.reset()
+            while True:
+                self.scheduler.wait()
+                # Choose action using epsilon-greedy policy
+                action = int(self.engine.act(state))
+                self.set_dac2(dac2 + self.action_range[action])
+                # the voltage the board applies, clipped to the dac2 range
+                dac2 = self.get_dac2()
+                # Get the next state, reward, and system_unlock
+                check = self.lock_check(input1='out1')
+                if check.max < 0.95:
+                    system_unlock = True
+                next_state = self._get_state_index(check.ch1['max'])
+                reward = 1 if not system_unlock else 0
+                if telemetry.enabled(DEBUG):
+                    telemetry.debug('step', episode=episode, state=next_state, action=action, dac2=dac2,
+                                    signal_max=check.ch1['max'], transmission=check.max)
+                # Update Q-values
+                if not self.test:
+                    self.engine.observe(state, action, reward, next_state, system_unlock)
+                state = next_state
+
+                if system_unlock:
+                    telemetry.info('lock_lost', f'control loop {self.scheduler}', episode=episode, dac2=dac2,
+                                   signal_max=check.ch1['max'], transmission=check.max)
                     if not self.test:
-                        max_next_q = np.max(self.Q[next_state, :])
-                        self.Q[state, action] = (self.Q[state, action] +
-                                                 self.learning_rate * (reward +
-                                                                       self.discount_factor * max_next_q -
-                                                                       self.Q[state, action]))
-                    state = next_state
-
-                    if system_unlock:
-                        if not self.test:
-                            np.save('q_qlearning.npy', self.Q)
-                        episode += 1
-                        break
+                        # a few batches from the replay buffer between episodes, saved in the background
+                        self.engine.replay(8)
+                        self.engine.checkpoint('q_qlearning.npy')
+                    episode += 1
+                    break
 
 
 if __name__ == '__main__':
@@ -0,0 +1,221 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from rpcodec import TraceCodec
+
+# per-trace metadata stored next to the samples, transmission is the in2 max when the caller measured it
+INDEX_DTYPE = np.dtype([('counter', '<i8'), ('timestamp', '<f8'), ('dac2', '<f8'), ('locked', '?'),
+                        ('transmission', '<f8')])
+# recording.json carries the format version: 1 (no version key) has no transmission in the index
+FORMAT_VERSION = 2
+INDEX_DTYPES = {1: np.dtype([('counter', '<i8'), ('timestamp', '<f8'), ('dac2', '<f8'), ('locked', '?')]),
+                2: INDEX_DTYPE}
+
+
+def index_dtype(meta: dict) -> np.dtype:
+    version = meta.get('version', 1)
+    if version not in INDEX_DTYPES:
+        raise ValueError(f'recording format version {version} is not supported (up to {FORMAT_VERSION})')
+    return INDEX_DTYPES[version]
+
+
+class TraceRecorder:
+    # Append-only recording of scope traces. Samples go to one flat file (traces.dat, shape (n, channels,
+    # length)) and the metadata to index.dat, so a TraceReader can memory map any slice without copying.
+    # record() only enqueues; a writer thread collects up to `chunk_size` traces and appends them with one
+    # write per file. When the bounded queue is full the trace is dropped and counted rather than blocking
+    # the control loop. With an (uncompressed) codec the samples are stored encoded, e.g. as int14 codes.
+    def __init__(self, path: str, channels=('ch1', 'ch2'), chunk_size: int = 64, queue_size: int = 1024,
+                 dtype: str = 'float32', codec: TraceCodec = None):
+        if codec is not None and codec.compression is not None:
+            raise ValueError('recordings are memory mapped, use save_traces() for compressed files')
+        self.path = path
+        self.channels = tuple(channels)
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.dtype = np.dtype(dtype) if codec is None else codec.dtype
+        self.length = None
+        self.count = 0
+        self.dropped = 0
+        os.makedirs(path, exist_ok=True)
+        header = os.path.join(path, 'recording.json')
+        if os.path.exists(header):
+            # appending to an existing recording
+            with open(header) as f:
+                meta = json.load(f)
+            if meta.get('version', 1) != FORMAT_VERSION:
+                raise ValueError(f'{path} holds a recording in format version {meta.get("version", 1)}, '
+                                 f'record version {FORMAT_VERSION} to a new directory')
+            if tuple(meta['channels']) != self.channels or np.dtype(meta['dtype']) != self.dtype or \
+                    meta.get('codec') != (None if codec is None else codec.to_dict()):
+                raise ValueError(f'{path} holds a recording with other channels, dtype or codec')
+            self.length = meta['length']
+            self.count = TraceReader(path).count
+            # drop a partly written last row so appended rows stay aligned
+            with open(os.path.join(path, 'traces.dat'), 'r+b') as f:
+                f.truncate(self.count * len(self.channels) * self.length * self.dtype.itemsize)
+            with open(os.path.join(path, 'index.dat'), 'r+b') as f:
+                f.truncate(self.count * INDEX_DTYPE.itemsize)
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='trace-recorder', daemon=True)
+        self._thread.start()
+
+    def record(self, traces, dac2: float = np.nan, locked: bool = False, counter: int = -1,
+               timestamp: float = None, transmission: float = np.nan) -> bool:
+        # traces: one array per channel, in the order of `channels`, or a dict keyed by channel name
+        if self._error is not None:
+            raise self._error
+        if isinstance(traces, dict):
+            traces = [traces[name] for name in self.channels]
+        # conversion to the stored dtype happens on the writer thread
+        item = (tuple(traces), (counter, time.time() if timestamp is None else timestamp, dac2, locked,
+                                transmission))
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def flush(self, timeout: float = None) -> None:
+        # block until everything recorded so far is on disk
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+        if self._error is not None:
+            raise self._error
+
+    def close(self) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def _write_header(self):
+        tmp = os.path.join(self.path, 'recording.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'version': FORMAT_VERSION, 'index': INDEX_DTYPE.descr, 'channels': list(self.channels),
+                       'length': self.length, 'dtype': self.dtype.str,
+                       'codec': None if self.codec is None else self.codec.to_dict(), 'count': self.count}, f,
+                      indent=2)
+        os.replace(tmp, os.path.join(self.path, 'recording.json'))
+
+    def _run(self):
+        data = open(os.path.join(self.path, 'traces.dat'), 'ab')
+        index = open(os.path.join(self.path, 'index.dat'), 'ab')
+        samples, meta, n = None, np.zeros(self.chunk_size, dtype=INDEX_DTYPE), 0
+
+        def write():
+            nonlocal n
+            if n:
+                data.write(samples[:n].tobytes())
+                index.write(meta[:n].tobytes())
+                self.count += n
+                n = 0
+            data.flush()
+            index.flush()
+            if self.length is not None:
+                self._write_header()
+
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    write()
+                    return
+                if isinstance(item, threading.Event):
+                    write()
+                    item.set()
+                    continue
+                traces, row = item
+                if self.length is None:
+                    self.length = len(traces[0])
+                shape = (len(traces),) + np.shape(traces[0])
+                if len(traces) != len(self.channels) or any(np.shape(trace) != (self.length,) for trace in traces):
+                    raise ValueError(f'trace of shape {shape}, expected {(len(self.channels), self.length)}')
+                if samples is None:
+                    samples = np.empty((self.chunk_size, len(self.channels), self.length), dtype=self.dtype)
+                for i, trace in enumerate(traces):
+                    samples[n, i] = trace if self.codec is None else self.codec.encode(trace)
+                meta[n] = row
+                n += 1
+                if n == self.chunk_size:
+                    write()
+        except Exception as e:
+            self._error = e
+            # keep draining so flush() and close() do not hang
+            while True:
+                item = self._queue.get()
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif item is None:
+                    return
+        finally:
+            data.close()
+            index.close()
+
+
+class TraceReader:
+    # Memory mapped view of a TraceRecorder directory, e.g. reader[100:200] or reader.channel('iq0', slice(0,
+    # None, 10)). Indexing returns views into the file, or decodes only the selected traces of an encoded
+    # recording (the codes are in `traces`); refresh() picks up traces appended since.
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'recording.json')) as f:
+            self.meta = json.load(f)
+        self.channels = tuple(self.meta['channels'])
+        self.length = self.meta['length']
+        self.dtype = np.dtype(self.meta['dtype'])
+        codec = self.meta.get('codec')
+        self.codec = None if codec is None else TraceCodec.from_dict(codec)
+        self.index_dtype = index_dtype(self.meta)
+        self.refresh()
+
+    def refresh(self) -> None:
+        # the files may hold a partly written chunk, only complete rows of both are visible
+        row = len(self.channels) * self.length * self.dtype.itemsize
+        data = os.path.join(self.path, 'traces.dat')
+        index = os.path.join(self.path, 'index.dat')
+        self.count = min(os.path.getsize(data) // row, os.path.getsize(index) // self.index_dtype.itemsize)
+        if self.count == 0:
+            self.traces = np.empty((0, len(self.channels), self.length), dtype=self.dtype)
+            self.index = np.empty(0, dtype=self.index_dtype)
+            return
+        self.traces = np.memmap(data, dtype=self.dtype, mode='r', shape=(self.count, len(self.channels), self.length))
+        self.index = np.memmap(index, dtype=self.index_dtype, mode='r', shape=(self.count,))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key):
+        if self.codec is None:
+            return self.traces[key]
+        return self.codec.decode(self.traces[key])
+
+    def channel(self, name: str, key=slice(None)):
+        return self[key, self.channels.index(name)]
+
+    def __getattr__(self, name):
+        # metadata columns: reader.timestamp, reader.dac2, reader.locked, reader.counter, reader.transmission
+        # (NaN in version 1 recordings)
+        if name in INDEX_DTYPE.names:
+            if name not in self.index_dtype.names:
+                return np.full(self.count, np.nan)
+            return self.index[name]
+        raise AttributeError(name)
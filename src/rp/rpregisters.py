@@ -0,0 +1,93 @@
+import numpy as np
+
+
+def pwm_voltage(voltage):
+    # what a slow DAC (pyrpl PWMRegister, ams.dac0-3) outputs for `voltage`: 0 - 1.8 V in 8 bit PWM steps with
+    # 16 dither steps each; returns the voltage and whether the request was clipped
+    requested = float(np.squeeze(voltage))
+    clipped = min(max(requested, 0.), 1.8)
+    x = clipped / 1.8 * 2 ** 8
+    high = min(np.floor(x), 2 ** 8 - 1)
+    low = round((x - high) * 16)
+    return float(1.8 * (high + low / 16) / 2 ** 8), clipped != requested
+
+
+class RegisterCache:
+    # Shadow copy of the module attributes written through it, so unchanged values are neither rewritten
+    # nor read back over the network. The cache holds the requested values: anything that changes on the
+    # board by itself must be listed as volatile, and a module reconfigured behind the cache's back must be
+    # invalidated. Registers the board clips or quantizes are listed in `coerced`; their values are converted
+    # before they are compared, sent and cached, and a clipped write is read back from the board.
+    volatile = {('pid0', 'ival')}
+    coerced = {('ams', 'dac2'): pwm_voltage}
+
+    def __init__(self, redpitaya):
+        self.redpitaya = redpitaya
+        self._values = {}
+        self.writes = 0
+        self.reads = 0
+        self.skipped_writes = 0
+        self.skipped_reads = 0
+
+    @staticmethod
+    def _equal(a, b):
+        if isinstance(a, (list, tuple, np.ndarray)) or isinstance(b, (list, tuple, np.ndarray)):
+            return np.array_equal(a, b)
+        return a == b
+
+    def _known(self, module, name, value):
+        key = (module, name)
+        return key not in self.volatile and key in self._values and self._equal(self._values[key], value)
+
+    def write(self, module: str, name: str, value) -> None:
+        key = (module, name)
+        clipped = False
+        if key in self.coerced:
+            value, clipped = self.coerced[key](value)
+        if self._known(module, name, value):
+            self.skipped_writes += 1
+            return
+        setattr(getattr(self.redpitaya, module), name, value)
+        self.writes += 1
+        if clipped:
+            self._values.pop(key, None)
+        elif key not in self.volatile:
+            self._values[key] = value
+
+    def setup(self, module: str, **kwargs) -> None:
+        # module.setup() with only the attributes that differ from the cache
+        changed = {name: value for name, value in kwargs.items() if not self._known(module, name, value)}
+        self.skipped_writes += len(kwargs) - len(changed)
+        if not changed:
+            return
+        getattr(self.redpitaya, module).setup(**changed)
+        self.writes += len(changed)
+        for name, value in changed.items():
+            if (module, name) not in self.volatile:
+                self._values[(module, name)] = value
+
+    def read(self, module: str, name: str):
+        key = (module, name)
+        if key in self._values:
+            self.skipped_reads += 1
+            return self._values[key]
+        value = getattr(getattr(self.redpitaya, module), name)
+        self.reads += 1
+        if key not in self.volatile:
+            self._values[key] = value
+        return value
+
+    def invalidate(self, module: str = None) -> None:
+        if module is None:
+            self._values.clear()
+        else:
+            for key in [key for key in self._values if key[0] == module]:
+                del self._values[key]
+
+    @property
+    def saved(self) -> int:
+        return self.skipped_writes + self.skipped_reads
+
+    def stats(self) -> dict:
+        return {'writes': self.writes, 'reads': self.reads, 'skipped_writes': self.skipped_writes,
+                'skipped_reads': self.skipped_reads, 'saved': self.saved}
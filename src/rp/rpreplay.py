@@ -0,0 +1,106 @@
+import gymnasium as gym
+import numpy as np
+from gymnasium import spaces
+
+from rprecorder import TraceReader
+
+
+class RedPitayaReplayEnv(gym.Env):
+    # RedPitayaEnv emulated from a TraceRecorder recording (e.g. PIDIQ's dataset/traces), for offline training.
+    # The observation is the in2 max, the action is added to dac2 and the episode ends below lock_threshold.
+    # An episode starts on a random locked trace and replays its lock session, `steps_per_trace` steps per
+    # recorded trace. PIDIQ holds dac2 constant during a lock session, so a recording says nothing about other
+    # dac2 values: the observation is the recorded transmission (interpolated in time between traces), falling
+    # off as a Lorentzian of half width `linewidth` (in dac2 volts) with the distance of the agent's dac2 from
+    # the recorded one. Transmissions come from the recorded metadata or, for traces without it, from the
+    # max of `channel` (in2 if recorded), read lazily from the memory mapped traces, so recordings larger than
+    # RAM work.
+    metadata = {'render_modes': []}
+
+    def __init__(self, path: str = 'dataset/traces', channel: str = None, lock_threshold: float = 0.95,
+                 linewidth: float = 0.001, steps_per_trace: int = 1, max_episode_steps: int = None,
+                 seed=None):
+        self.reader = TraceReader(path)
+        if channel is None and 'in2' in self.reader.channels:
+            channel = 'in2'
+        self.channel = channel
+        self.action_space = spaces.Box(low=-0.3, high=0.3, shape=(1,), dtype=np.float32)
+        self.observation_space = spaces.Box(low=0, high=1, shape=(1,), dtype=np.float32)
+        self.reward_range = (-0.95, 0.04)
+        self.lock_threshold = lock_threshold
+        self.linewidth = linewidth
+        self.steps_per_trace = steps_per_trace
+        self.max_episode_steps = max_episode_steps
+
+        n = len(self.reader)
+        self.dac2_recorded = np.array(self.reader.dac2, dtype=float)
+        self._transmission = np.array(self.reader.transmission, dtype=float)
+        if channel is None and np.isnan(self._transmission).all():
+            raise ValueError(f'{path} has no recorded transmission, pass the channel to take it from')
+        locked = np.array(self.reader.locked, dtype=bool) & np.isfinite(self.dac2_recorded)
+        if channel is None:
+            locked &= np.isfinite(self._transmission)
+        # a lock session is a run of locked traces together with the trace where the lock was lost
+        begins = np.concatenate(([True], ~locked[:-1]))
+        self._session_start = np.maximum.accumulate(np.where(begins, np.arange(n), 0))
+        ends = np.concatenate((~locked[:-1], [True]))
+        self._session_end = np.minimum.accumulate(np.where(ends, np.arange(n), n - 1)[::-1])[::-1]
+        self._starts = np.flatnonzero(locked & (self._session_end > np.arange(n)))
+        if self._starts.size == 0:
+            raise ValueError(f'{path} has no locked trace to start an episode from')
+        self.np_random, _ = gym.utils.seeding.np_random(seed)
+        self.position = 0.
+        self.dac2 = 0.
+        self.episode_steps = 0
+        self._begin, self._end = 0, 0
+
+    def _recorded(self, indices):
+        # recorded transmissions, computing the missing ones from the traces
+        if self.channel is not None:
+            for i in indices[np.isnan(self._transmission[indices])]:
+                self._transmission[i] = self.reader.channel(self.channel, i).max()
+        return self._transmission[indices]
+
+    def transmission(self, position: float, dac2: float) -> float:
+        # the recorded transmission and dac2 between the traces around the position
+        i = min(int(position), self._end)
+        indices = np.array([i, min(i + 1, self._end)])
+        x = self.dac2_recorded[indices]
+        y = self._recorded(indices)
+        known = np.isfinite(x) & np.isfinite(y)
+        if not known.any():
+            return 0.
+        weights = np.array([1 - (position - i), position - i])[known]
+        weights = weights / weights.sum() if weights.sum() > 0 else np.full(known.sum(), 1 / known.sum())
+        x, y = weights @ x[known], weights @ y[known]
+        return float(y / (1 + ((dac2 - x) / self.linewidth) ** 2))
+
+    def _observe(self):
+        return np.array([min(self.transmission(self.position, self.dac2), 1.)], dtype=np.float32)
+
+    def reset(self, *, seed=None, options=None):
+        if seed is not None:
+            self.np_random, _ = gym.utils.seeding.np_random(seed)
+        start = (options or {}).get('start')
+        if start is None:
+            start = int(self.np_random.choice(self._starts))
+        self.position = float(start)
+        self._begin, self._end = int(self._session_start[start]), int(self._session_end[start])
+        # the agent takes over from the recorded operating point
+        self.dac2 = float(self.dac2_recorded[start])
+        self.episode_steps = 0
+        return self._observe(), {'start': start}
+
+    def step(self, action):
+        self.dac2 = float(np.clip(self.dac2 + float(np.asarray(action).reshape(-1)[0]), 0., 1.8))
+        self.position += 1 / self.steps_per_trace
+        self.episode_steps += 1
+        obs = self._observe()
+        reward = float(obs[0]) - self.lock_threshold
+        terminated = bool(obs[0] < self.lock_threshold)
+        truncated = self.position >= self._end or \
+            (self.max_episode_steps is not None and self.episode_steps >= self.max_episode_steps)
+        return obs, reward, terminated, bool(truncated), {'dac2': self.dac2, 'position': self.position}
+
+    def render(self):
+        return None
@@ -0,0 +1,44 @@
+import numpy as np
+from stable_baselines3.common.vec_env import VecEnv
+
+
+class SB3VectorEnv(VecEnv):
+    # exposes a gymnasium VectorEnv with same-step autoreset through the stable_baselines3 VecEnv interface
+    def __init__(self, venv):
+        self.venv = venv
+        self._actions = None
+        super().__init__(venv.num_envs, venv.single_observation_space, venv.single_action_space)
+
+    def reset(self):
+        seed = self._seeds[0] if any(s is not None for s in self._seeds) else None
+        obs, _ = self.venv.reset(seed=seed)
+        self._reset_seeds()
+        return obs
+
+    def step_async(self, actions):
+        self._actions = actions
+
+    def step_wait(self):
+        obs, rewards, terminations, truncations, infos = self.venv.step(self._actions)
+        dones = terminations | truncations
+        final = infos.get('_final_obs', np.zeros(self.num_envs, dtype=bool))
+        sb3_infos = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(final):
+            sb3_infos[i]['terminal_observation'] = infos['final_obs'][i]
+            sb3_infos[i]['TimeLimit.truncated'] = bool(truncations[i] and not terminations[i])
+        return obs, rewards, dones, sb3_infos
+
+    def close(self):
+        self.venv.close()
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self.venv, attr_name)] * len(self._get_indices(indices))
+
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self.venv, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return [getattr(self.venv, method_name)(*method_args, **method_kwargs)] * len(self._get_indices(indices))
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False] * len(self._get_indices(indices))
@@ -0,0 +1,70 @@
+import time
+
+import numpy as np
+
+# jitter histogram bin edges, seconds late
+JITTER_EDGES = np.array([0., 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, np.inf])
+
+
+class RateScheduler:
+    # Paces a control loop at a fixed rate against monotonic deadlines: wait() returns at the next deadline,
+    # whatever the loop spent in scope() or set_dac2 since the previous one. It sleeps until `spin` seconds
+    # before the deadline and busy-waits the rest, which is far more precise than time.sleep alone. A loop that
+    # misses a deadline by more than a period counts an overrun and restarts from now instead of bursting
+    # through the missed ticks. rate=None runs as fast as possible and only keeps the statistics.
+    def __init__(self, rate: float = None, spin: float = 0.0005):
+        self.spin = spin
+        self.set_rate(rate)
+        self.reset()
+
+    def set_rate(self, rate: float = None) -> None:
+        self.rate = rate
+        self.period = 0. if rate is None else 1 / rate
+
+    def reset(self) -> None:
+        self.deadline = None
+        self.ticks = 0
+        self.overruns = 0
+        self.histogram = np.zeros(len(JITTER_EDGES) - 1, dtype=np.int64)
+        self._jitter_sum = 0.
+        self._jitter_max = 0.
+        self._start = time.perf_counter()
+
+    def wait(self) -> float:
+        # returns how late this tick is, in seconds
+        now = time.perf_counter()
+        if self.deadline is None or self.period == 0:
+            self.deadline = now + self.period
+            self.ticks += 1
+            return 0.
+        remaining = self.deadline - now
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while time.perf_counter() < self.deadline:
+            pass
+        now = time.perf_counter()
+        late = now - self.deadline
+        self.ticks += 1
+        self.histogram[np.searchsorted(JITTER_EDGES, late, side='right') - 1] += 1
+        self._jitter_sum += late
+        self._jitter_max = max(self._jitter_max, late)
+        if late > self.period:
+            self.overruns += 1
+            self.deadline = now + self.period
+        else:
+            self.deadline += self.period
+        return late
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self._start
+        measured = int(self.histogram.sum())
+        return {'ticks': self.ticks, 'overruns': self.overruns,
+                'rate': self.ticks / elapsed if elapsed > 0 else 0.,
+                'mean_jitter': self._jitter_sum / measured if measured else 0., 'max_jitter': self._jitter_max,
+                'histogram': dict(zip([f'<{1e6 * edge:.0f}us' for edge in JITTER_EDGES[1:-1]] + ['>10ms'],
+                                      self.histogram.tolist()))}
+
+    def __str__(self):
+        stats = self.stats()
+        return (f'{stats["ticks"]} ticks at {stats["rate"]:.1f} Hz (target {self.rate}), {stats["overruns"]} overruns, '
+                f'jitter mean {1e6 * stats["mean_jitter"]:.0f} us max {1e6 * stats["max_jitter"]:.0f} us')
@@ -1,30 +1,202 @@
+import time
+from dataclasses import dataclass, field
+
 import numpy as np
 from rpcontrol import RedPitayaController
+from rpstream import TraceStream
+from rpsettle import SettleDetector
+
+STATISTICS = {'max': np.max, 'argmax': np.argmax, 'mean': np.mean, 'min': np.min}
+
+
+@dataclass
+class LockCheck:
+    # summary statistics of the scope channels read by RedPitayaScope.lock_check(), ch1 is empty unless input1
+    # was given; argmax is relative to `start`, the first sample of the window in the ordered trace
+    ch2: dict
+    ch1: dict = field(default_factory=dict)
+    start: int = 0
+    n_points: int = 0
+    decimation: int = 256
+    latency: float = 0.
+
+    @property
+    def max(self):
+        return self.ch2['max']
+
+    @property
+    def argmax(self):
+        return self.ch2['argmax']
+
+    @property
+    def mean(self):
+        return self.ch2['mean']
+
+    @property
+    def min(self):
+        return self.ch2['min']
+
+
+def trace_stats(trace, stats) -> dict:
+    return {name: STATISTICS[name](trace).item() for name in stats}
 
 
 class RedPitayaScope(RedPitayaController):
     def __init__(self, hostname: str, user: str = 'root', password: str = 'root', config: str = 'fermi',
                  gui: bool = False):
         super().__init__(hostname, user, password, config, gui)
+        self.stream = None
+        self._stream_inputs = (None, None)
+        # TraceRecorder for the traces taken by lock_cavity, scope_trace.npy is overwritten when None
+        self.lock_recorder = None
+        # a FigureSink (rpdiagnostics) that plots the PDH fit of every lock, None runs headless
+        self.diagnostics = None
+        # waits for the transmission peak to stop moving after a temperature change, over a window that
+        # calibrate_settle() fits to the laser's thermal time constant
+        self.settle_detector = SettleDetector(self.transmission_peak, telemetry=self.telemetry)
 
     def scope(self, input1: str = 'out1', input2: str = 'in2', hysteresis: float = 0.01,
               trigger_source: str = 'immediately', ordered: bool = False):
-        self.redpitaya.scope.decimation = 256
-        self.redpitaya.scope.input1 = input1
-        # Scope's second input
-        self.redpitaya.scope.input2 = input2
-        self.redpitaya.scope.threshold = self.redpitaya.asg0.offset + self.redpitaya.asg0.amplitude / 2
-        # Trigger Hysteresis
-        self.redpitaya.scope.hysteresis = hysteresis
-        # Trigger Source
-        self.redpitaya.scope.trigger_source = trigger_source
-        # Trigger Time Delay
-        self.redpitaya.scope.trigger_delay = 0
-        # Take a Scope Trace
-        purple_signal, blue_signal = self.redpitaya.scope.single()
+        with self.io_lock:
+            registers = self.registers
+            registers.write('scope', 'decimation', 256)
+            registers.write('scope', 'input1', input1)
+            # Scope's second input
+            registers.write('scope', 'input2', input2)
+            threshold = registers.read('asg0', 'offset') + registers.read('asg0', 'amplitude') / 2
+            registers.write('scope', 'threshold', threshold)
+            # Trigger Hysteresis
+            registers.write('scope', 'hysteresis', hysteresis)
+            # Trigger Source
+            registers.write('scope', 'trigger_source', trigger_source)
+            # Trigger Time Delay
+            registers.write('scope', 'trigger_delay', 0)
+            # Take a Scope Trace
+            purple_signal, blue_signal = self.redpitaya.scope.single()
         if ordered:
             purple_signal_peak_index = np.where(purple_signal == purple_signal.max())[0][0]
             first_position = purple_signal_peak_index + 1
             purple_signal = np.concatenate((purple_signal[first_position:], purple_signal[:first_position]))
             blue_signal = np.concatenate((blue_signal[first_position:], blue_signal[:first_position]))
         return purple_signal, blue_signal
+
+    def start_stream(self, input1: str = 'out1', input2: str = 'in2', n_slots: int = 64, **kwargs) -> TraceStream:
+        # acquire scope traces continuously in the background, see latest_trace(), next_trace() and stream.traces()
+        self.stop_stream()
+        self._stream_inputs = (input1, input2)
+        self.stream = TraceStream(lambda: self.scope(input1, input2, **kwargs), n_slots, self.telemetry).start()
+        return self.stream
+
+    def stop_stream(self) -> None:
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+
+    def latest_trace(self, wait: float = 1.):
+        # newest streamed (ch1, ch2) pair, falls back to a single acquisition when no stream is running
+        if self.stream is not None and self.stream.running:
+            trace = self.stream.latest(wait)
+            if trace is not None:
+                return trace[2], trace[3]
+        return self.scope()
+
+    def next_trace(self, timeout: float = 1.):
+        # first streamed (ch1, ch2) pair acquired entirely after the call, e.g. after a control action;
+        # falls back to a single acquisition when no stream is running
+        if self.stream is not None and self.stream.running:
+            trace = self.stream.next(timeout)
+            if trace is not None:
+                return trace[2], trace[3]
+        return self.scope()
+
+    def lock_check(self, stats=('max',), input2: str = 'in2', input1: str = None, window=None,
+                   decimation: int = 256, timeout: float = 1.) -> LockCheck:
+        # Acquire one trace and read back only what the statistics need: the samples of `window` (start, stop)
+        # of the ordered trace, of ch2 and of ch1 only when input1 is given. The default window spans the
+        # duration of a decimation 256 trace, so a coarser decimation reads proportionally fewer samples
+        # (enable scope.average to have them averaged rather than subsampled). With a stream running on the
+        # same inputs the statistics come from the first streamed trace acquired after the call instead, without
+        # arming the scope: the stream holds io_lock for a whole acquisition, so that trace follows any register
+        # write made before the call.
+        t0 = time.perf_counter()
+        length = self.redpitaya.scope.data_length
+        if window is None:
+            window = (length - min(length, length * 256 // decimation), length)
+        start, stop = window
+        if self.stream is not None and self.stream.running and decimation == 256 and \
+                input2 == self._stream_inputs[1] and input1 in (None, self._stream_inputs[0]):
+            trace = self.stream.next(timeout)
+            if trace is not None:
+                ch1 = trace_stats(trace[2][start:stop], stats) if input1 is not None else {}
+                return LockCheck(trace_stats(trace[3][start:stop], stats), ch1, start, stop - start, decimation,
+                                 time.perf_counter() - t0)
+
+        scope = self.redpitaya.scope
+        with self.io_lock:
+            registers = self.registers
+            registers.write('scope', 'decimation', decimation)
+            if input1 is not None:
+                registers.write('scope', 'input1', input1)
+            registers.write('scope', 'input2', input2)
+            registers.write('scope', 'trigger_source', 'immediately')
+            registers.write('scope', 'trigger_delay', 0)
+            scope._start_trace_acquisition()
+            deadline = time.time() + timeout
+            while not scope._data_ready():
+                if time.time() > deadline:
+                    raise TimeoutError('scope acquisition timed out')
+                time.sleep(0.0001)
+            pointer = scope._write_pointer_trigger + scope._trigger_delay_register + 1
+            ch2 = self._read_window(0x20000, pointer, start, stop)
+            ch1 = self._read_window(0x10000, pointer, start, stop) if input1 is not None else None
+        return LockCheck(trace_stats(ch2, stats), {} if ch1 is None else trace_stats(ch1, stats), start,
+                         stop - start, decimation, time.perf_counter() - t0)
+
+    def _read_window(self, addr, pointer, start, stop):
+        # samples start:stop of the ordered trace from the scope ring buffer, the oldest sample sits at pointer
+        scope = self.redpitaya.scope
+        length = scope.data_length
+        first = (start + pointer) % length
+        n = stop - start
+        if first + n <= length:
+            words = scope._reads(addr + 4 * first, n)
+        else:
+            words = np.concatenate((scope._reads(addr + 4 * first, length - first),
+                                    scope._reads(addr, n - (length - first))))
+        raw = np.asarray(words, dtype=np.int64) & 0x3FFF
+        raw[raw >= 2 ** 13] -= 2 ** 14
+        return raw / 2 ** 13
+
+    def close(self) -> None:
+        self.stop_stream()
+        super().close()
+
+    def save_lock_trace(self, scope_trace, locked: bool = False) -> None:
+        if self.lock_recorder is None:
+            np.save('scope_trace.npy', scope_trace)
+        else:
+            self.lock_recorder.record(scope_trace, self.get_dac2(), locked)
+
+    def measure_temperature(self, temperature: float, settle: float = 0.):
+        # set the temperature and locate the transmission peak on the ordered piezo ramp
+        self.set_dac2(temperature)
+        if settle:
+            time.sleep(settle)
+        _, blue_signal = self.scope(ordered=True)
+        return int(np.argmax(blue_signal)), blue_signal.max(), blue_signal.shape[0]
+
+    def transmission_peak(self):
+        # position (fraction of the piezo ramp) and height of the transmission peak
+        _, blue_signal = self.scope(ordered=True)
+        return np.argmax(blue_signal) / blue_signal.shape[0], blue_signal.max()
+
+    def wait_settled(self, timeout: float = None) -> bool:
+        return self.settle_detector.wait(timeout).settled
+
+    def calibrate_settle(self, step: float = 0.005, duration: float = 10.) -> float:
+        # time constant of the peak position after a dac2 step of `step` volts, which sets the settle window
+        dac2 = self.get_dac2()
+        try:
+            return self.settle_detector.calibrate(lambda: self.set_dac2(dac2 + step), duration)
+        finally:
+            self.set_dac2(dac2)
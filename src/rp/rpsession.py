@@ -0,0 +1,206 @@
+import threading
+import time
+
+from rpregisters import RegisterCache
+from rpmonitor import RegisterTransaction
+
+
+def simulated(hostname: str) -> bool:
+    # 'sim' or 'sim:<seed>' runs against the in-process cavity simulator instead of a board
+    return hostname.split(':')[0] == 'sim'
+
+
+def connect(hostname: str, user: str = 'root', password: str = 'root', config: str = 'fermi'):
+    if simulated(hostname):
+        from rpsim import SimulatedRedPitaya
+        seed = hostname.split(':')[1] if ':' in hostname else None
+        return SimulatedRedPitaya(hostname, seed=None if seed is None else int(seed))
+    import pyrpl
+    return pyrpl.RedPitaya(hostname=hostname, config=config, user=user, password=password)
+
+
+class Session:
+    # One live connection to a board, shared by every controller, scope and env object of that board in the
+    # process. Attribute access is forwarded to the current pyrpl.RedPitaya (`board`), so holders of the session
+    # keep working across reconnects. The session also owns the state that has to be shared with the connection:
+    # the register cache (invalidated on reconnect), the I/O lock and the register transaction.
+    def __init__(self, hostname: str, user: str = 'root', password: str = 'root', config: str = 'fermi',
+                 max_retries: int = 5, backoff: float = 1., max_backoff: float = 30., check_interval: float = 5.):
+        self.hostname = hostname
+        self._args = (hostname, user, password, config)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # ensure() skips the health check when the board answered less than check_interval seconds ago
+        self.check_interval = check_interval
+        self.board = None
+        self.lock = threading.RLock()
+        self.registers = RegisterCache(self)
+        self.transaction = RegisterTransaction(self, self.lock)
+        self.refs = 0
+        # seconds taken by every successful connection, the first one included
+        self.setup_times = []
+        self.failures = 0
+        self.last_error = None
+        self._checked = 0.
+
+    def __getattr__(self, name):
+        # only called for attributes the session does not have itself
+        if name == 'board':
+            raise AttributeError(name)
+        return getattr(self.board, name)
+
+    def connect(self) -> None:
+        with self.lock:
+            for attempt in range(self.max_retries):
+                t0 = time.perf_counter()
+                try:
+                    self.board = connect(*self._args)
+                except Exception as e:
+                    self.failures += 1
+                    self.last_error = e
+                    if attempt + 1 < self.max_retries:
+                        time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+                    continue
+                self.setup_times.append(time.perf_counter() - t0)
+                self._checked = time.monotonic()
+                return
+            raise ConnectionError(f'could not connect to {self.hostname} in {self.max_retries} attempts: '
+                                  f'{self.last_error}') from self.last_error
+
+    def healthy(self) -> bool:
+        # one register read round-trip
+        with self.lock:
+            try:
+                self.board.scope.decimation
+            except Exception as e:
+                self.last_error = e
+                return False
+            self._checked = time.monotonic()
+            return True
+
+    def ensure(self) -> bool:
+        # reconnects when the board does not answer, returns True when it had to
+        with self.lock:
+            if self.board is not None and (time.monotonic() - self._checked < self.check_interval or self.healthy()):
+                return False
+            self.reconnect()
+            return True
+
+    def reconnect(self) -> None:
+        with self.lock:
+            self._close_board()
+            self.connect()
+            # the board may have been reset while it was away
+            self.registers.invalidate()
+
+    def _close_board(self):
+        board, self.board = self.board, None
+        end = getattr(board, 'end_all', None)
+        if end is not None:
+            try:
+                end()
+            except Exception:
+                pass
+
+    @property
+    def reconnects(self) -> int:
+        return max(len(self.setup_times) - 1, 0)
+
+    def stats(self) -> dict:
+        return {'refs': self.refs, 'connects': len(self.setup_times), 'reconnects': self.reconnects,
+                'failures': self.failures, 'setup_time': self.setup_times[-1] if self.setup_times else None,
+                'total_setup_time': sum(self.setup_times),
+                'last_error': None if self.last_error is None else repr(self.last_error)}
+
+
+def pooled(hostname: str) -> bool:
+    # a simulator is the board itself rather than a connection to it, so every 'sim' object gets its own
+    return not simulated(hostname)
+
+
+class SessionPool:
+    # Process-wide sessions keyed by (hostname, config, user): the first get() connects, later ones reuse the
+    # live connection. Boards are connected outside the pool lock, so several can connect in parallel.
+    # Every get() is paired with a release() (RedPitaya.close()); the connection stays open while the session
+    # is referenced and until close(). Simulated hostnames are not pooled: each get() returns a new session with
+    # its own simulator and register cache, so two RedPitayaEnv('sim') do not drive the same cavity.
+    # start_watchdog() health-checks all sessions from a background thread and reconnects the dead ones.
+    def __init__(self, **session_kwargs):
+        self.session_kwargs = session_kwargs
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._watchdog = None
+        self._stop = threading.Event()
+
+    def get(self, hostname: str, user: str = 'root', password: str = 'root', config: str = 'fermi') -> Session:
+        if not pooled(hostname):
+            session = Session(hostname, user, password, config, **self.session_kwargs)
+            session.refs = 1
+            session.connect()
+            return session
+        key = (hostname, config, user)
+        with self._lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.sessions[key] = Session(hostname, user, password, config, **self.session_kwargs)
+            session.refs += 1
+        with session.lock:
+            if session.board is None:
+                try:
+                    session.connect()
+                except ConnectionError:
+                    with self._lock:
+                        session.refs -= 1
+                    raise
+        return session
+
+    def release(self, session: Session) -> None:
+        # a pooled connection stays open for the next get(), close() ends it; an unpooled one ends with its
+        # last reference
+        with self._lock:
+            session.refs = max(session.refs - 1, 0)
+            if session.refs or pooled(session.hostname):
+                return
+        with session.lock:
+            session._close_board()
+
+    def close(self, hostname: str = None) -> None:
+        with self._lock:
+            keys = [key for key in self.sessions if hostname is None or key[0] == hostname]
+            sessions = [self.sessions.pop(key) for key in keys]
+        for session in sessions:
+            with session.lock:
+                session._close_board()
+
+    def start_watchdog(self, interval: float = 10.) -> None:
+        self.stop_watchdog()
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                with self._lock:
+                    sessions = list(self.sessions.values())
+                for session in sessions:
+                    try:
+                        session.ensure()
+                    except ConnectionError:
+                        # retried on the next round
+                        pass
+        self._watchdog = threading.Thread(target=run, name='session-watchdog', daemon=True)
+        self._watchdog.start()
+
+    def stop_watchdog(self) -> None:
+        if self._watchdog is not None:
+            self._stop.set()
+            self._watchdog.join()
+            self._watchdog = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {f'{hostname}/{config}/{user}': session.stats()
+                    for (hostname, config, user), session in self.sessions.items()}
+
+
+# the sessions of this process
+sessions = SessionPool()
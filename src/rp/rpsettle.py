@@ -0,0 +1,128 @@
+import time
+from collections import deque
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class SettleResult:
+    settled: bool
+    # seconds from the start of wait() to the end of the first steady window (or to the timeout)
+    duration: float
+    samples: int
+    # peak-to-peak over the last window: position in fractions of the ramp, height relative to its mean
+    position_drift: float = np.inf
+    height_drift: float = np.inf
+
+
+class SettleDetector:
+    # Waits for the laser temperature to settle after a dac2 change. measure() returns the transmission peak as
+    # (position, height), position in fractions of the piezo ramp. The system is settled once the peaks of the
+    # last `span` seconds (at least `window` of them, taken every `interval` seconds, span / (window - 1) by
+    # default) move by less than position_tolerance and change height by less than height_tolerance of their
+    # mean; it gives up after `timeout` seconds. The window spans time rather than traces because a trace takes
+    # milliseconds while the laser temperature follows dac2 with a time constant of the order of seconds: span
+    # should be about that time constant, which calibrate() measures from a step response. Every wait() is kept
+    # in `results`, so the settle times of a setup can be read back with stats().
+    def __init__(self, measure, window: int = 4, span: float = 2., position_tolerance: float = 0.005,
+                 height_tolerance: float = 0.05, min_height: float = 0.1, interval: float = None,
+                 timeout: float = 10., telemetry=None):
+        self.measure = measure
+        self.window = window
+        self.span = span
+        self.position_tolerance = position_tolerance
+        self.height_tolerance = height_tolerance
+        self.min_height = min_height
+        self.interval = interval
+        self.timeout = timeout
+        self.telemetry = telemetry
+        self.results = []
+        # time constant found by the last calibrate()
+        self.tau = None
+
+    @property
+    def pace(self) -> float:
+        # seconds between two measurements
+        return self.interval if self.interval is not None else self.span / max(self.window - 1, 1)
+
+    def wait(self, timeout: float = None) -> SettleResult:
+        timeout = self.timeout if timeout is None else timeout
+        times, positions, heights = deque(), deque(), deque()
+        start = time.perf_counter()
+        samples = 0
+        result = None
+        while result is None:
+            position, height = self.measure()
+            samples += 1
+            elapsed = time.perf_counter() - start
+            times.append(elapsed)
+            positions.append(position)
+            heights.append(height)
+            # keep the newest samples covering span seconds, and at least `window` of them
+            while len(times) > self.window and elapsed - times[1] >= self.span:
+                times.popleft()
+                positions.popleft()
+                heights.popleft()
+            if len(times) >= self.window and elapsed - times[0] >= self.span:
+                position_drift = float(np.ptp(positions))
+                mean_height = float(np.mean(heights))
+                height_drift = float(np.ptp(heights)) / mean_height if mean_height > 0 else np.inf
+                if (position_drift < self.position_tolerance and height_drift < self.height_tolerance
+                        and min(heights) >= self.min_height):
+                    result = SettleResult(True, elapsed, samples, position_drift, height_drift)
+                elif elapsed >= timeout:
+                    result = SettleResult(False, elapsed, samples, position_drift, height_drift)
+            elif elapsed >= timeout:
+                result = SettleResult(False, elapsed, samples)
+            if result is None and self.pace:
+                time.sleep(self.pace)
+        self.results.append(result)
+        if self.telemetry is not None:
+            if result.settled:
+                self.telemetry.debug('settled', f'{result.samples} traces', value=result.duration)
+            else:
+                self.telemetry.warning('settle_timeout', f'drift {result.position_drift:.4f} of the ramp, '
+                                                         f'{result.height_drift:.3f} of the height',
+                                       value=result.duration)
+        return result
+
+    def calibrate(self, step, duration: float = 10., interval: float = 0.01, spans: float = 3.) -> float:
+        # Measures the step response of the peak position: step() changes dac2, then the peak is followed for
+        # `duration` seconds. For a first order response the area between the final position and the response,
+        # in units of the position change, is the time constant tau (and averages out the trace noise); the
+        # window then spans `spans` time constants. Returns tau in seconds.
+        before, height = self.measure()
+        if height < self.min_height:
+            raise ValueError(f'no transmission peak to follow (height {height:.3f}), calibrate near resonance')
+        start = time.perf_counter()
+        step()
+        times, positions = [0.], [before]
+        while times[-1] < duration:
+            position, _ = self.measure()
+            times.append(time.perf_counter() - start)
+            positions.append(position)
+            time.sleep(interval)
+        times, positions = np.asarray(times), np.asarray(positions)
+        final = float(np.median(positions[times >= 0.8 * duration]))
+        if abs(final - before) < 2 * self.position_tolerance:
+            raise ValueError(f'the step moved the peak by {abs(final - before):.4f} of the ramp only, '
+                             f'use a larger step')
+        # clipped, so a trace that found another resonance order costs at most one sample interval
+        remaining = np.clip((final - positions) / (final - before), 0., 1.)
+        self.tau = max(float(np.sum((remaining[1:] + remaining[:-1]) / 2 * np.diff(times))), 0.)
+        self.span = spans * self.tau
+        self.interval = None
+        if self.telemetry is not None:
+            self.telemetry.info('settle_calibrated', f'span {self.span:.2f} s', value=self.tau)
+        return self.tau
+
+    def settle_times(self):
+        return np.array([result.duration for result in self.results if result.settled])
+
+    def stats(self) -> dict:
+        times = self.settle_times()
+        return {'waits': len(self.results), 'timeouts': len(self.results) - times.shape[0],
+                'mean': float(times.mean()) if times.shape[0] else 0.,
+                'p90': float(np.percentile(times, 90)) if times.shape[0] else 0.,
+                'max': float(times.max()) if times.shape[0] else 0.}
@@ -0,0 +1,345 @@
+import time
+import numpy as np
+
+from rpregisters import pwm_voltage
+
+# Red Pitaya acquisition constants
+DATA_LENGTH = 2 ** 14
+CLOCK_PERIOD = 8e-9
+ADC_BITS = 14
+
+
+def wrap(x, period):
+    # floating point modulo, much faster than np.remainder on large arrays
+    return x - period * np.floor(x / period)
+
+
+def lorentzian(detuning, linewidth):
+    return linewidth ** 2 / (detuning ** 2 + linewidth ** 2)
+
+
+def pdh_error(detuning, linewidth):
+    # derivative of a Lorentzian, normalised to a unit peak at detuning = -linewidth / sqrt(3)
+    return -16 * np.sqrt(3) / 9 * detuning * linewidth ** 3 / ((detuning ** 2 + linewidth ** 2) ** 2)
+
+
+class SimulatedCavity:
+    # Optical cavity seen through the piezo (out1) and the laser temperature (dac2).
+    # All voltages are in the units the Red Pitaya uses, every method broadcasts over arrays.
+    def __init__(self, seed=None, linewidth: float = 0.004, fsr: float = 1.2, tuning: float = 4.0,
+                 hom_offsets: tuple = (0.35, 0.7), hom_heights: tuple = (0.45, 0.2), peak: float = 1.0,
+                 noise: float = 0.004, drift: float = 0.0005, thermal_tau: float = 0.05, phase: float = 20.):
+        self.rng = np.random.default_rng(seed)
+        self.linewidth = linewidth
+        self.fsr = fsr
+        # piezo volts of resonance shift per volt of dac2
+        self.tuning = tuning
+        self.hom_offsets = np.asarray(hom_offsets, dtype=float)
+        self.hom_heights = np.asarray(hom_heights, dtype=float)
+        self.peak = peak
+        self.noise = noise
+        # random walk of the resonance in piezo volts per sqrt(second)
+        self.drift = drift
+        self.thermal_tau = thermal_tau
+        # IQ demodulation phase (degrees) giving the steepest error signal
+        self.phase = phase
+        # position of the TEM00 resonance for dac2 = 0
+        self.x_ref = self.rng.uniform(0, fsr)
+        self._lut_size = 2 ** 16
+        self._lut_transmission = None
+        self._lut_error = None
+
+    def _build_lut(self):
+        # one free spectral range of the transmission and error signal, looked up for whole traces
+        d = (np.arange(self._lut_size) / self._lut_size - 0.5) * self.fsr
+        t = self.peak * lorentzian(d, self.linewidth)
+        for offset, height in zip(self.hom_offsets, self.hom_heights):
+            t = t + height * lorentzian(wrap(d - offset + self.fsr / 2, self.fsr) - self.fsr / 2, self.linewidth)
+        self._lut_transmission = t
+        self._lut_error = pdh_error(d, self.linewidth)
+
+    def _lut_index(self, x, temperature):
+        if self._lut_transmission is None:
+            self._build_lut()
+        scale = self._lut_size / self.fsr
+        index = ((x - (self.x_ref + self.tuning * temperature - self.fsr / 2)) * scale).astype(np.int64)
+        return np.bitwise_and(index, self._lut_size - 1, out=index)
+
+    def detuning(self, x, temperature, offset=0.):
+        # distance to the closest TEM00 resonance, wrapped to [-fsr / 2, fsr / 2)
+        d = x - (self.x_ref + self.tuning * temperature + offset)
+        return wrap(d + self.fsr / 2, self.fsr) - self.fsr / 2
+
+    def transmission(self, x, temperature):
+        if np.ndim(x):
+            index = self._lut_index(x, temperature)
+            return self._lut_transmission[index]
+        d = self.detuning(x, temperature)
+        t = self.peak * lorentzian(d, self.linewidth)
+        for offset, height in zip(self.hom_offsets, self.hom_heights):
+            t = t + height * lorentzian(self.detuning(x, temperature, offset), self.linewidth)
+        return t
+
+    def error_signal(self, x, temperature, phase=None):
+        phase = self.phase if phase is None else phase
+        scale = 0.5 * np.cos(np.deg2rad(phase - self.phase))
+        if np.ndim(x):
+            index = self._lut_index(x, temperature)
+            return scale * self._lut_error[index]
+        return scale * pdh_error(self.detuning(x, temperature), self.linewidth)
+
+    def step_drift(self, dt):
+        if dt > 0 and self.drift > 0:
+            self.x_ref += self.drift * np.sqrt(dt) * self.rng.standard_normal()
+
+
+class SimModule:
+    def __init__(self, board, **defaults):
+        self._board = board
+        for key, value in defaults.items():
+            setattr(self, key, value)
+
+    def setup(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+class SimAsg(SimModule):
+    def __init__(self, board):
+        super().__init__(board, waveform='sin', output_direct='off', amplitude=0., offset=0., frequency=1e3,
+                         trigger_source='off')
+
+    def signal(self, t):
+        if self.waveform == 'dc':
+            return np.full_like(t, self.offset)
+        phase = wrap(t * self.frequency, 1.)
+        if self.waveform == 'halframp':
+            y = 2 * phase - 1
+        elif self.waveform == 'ramp':
+            y = np.where(phase < 0.5, 4 * phase - 1, 3 - 4 * phase)
+        elif self.waveform == 'square':
+            y = np.where(phase < 0.5, 1., -1.)
+        elif self.waveform == 'cos':
+            y = np.cos(2 * np.pi * phase)
+        else:
+            y = np.sin(2 * np.pi * phase)
+        return self.offset + self.amplitude * y
+
+    def is_constant(self):
+        return self.waveform == 'dc' or self.amplitude == 0
+
+
+class SimIq(SimModule):
+    def __init__(self, board):
+        super().__init__(board, frequency=25e6, bandwidth=[2e6, 2e6], gain=0., phase=0, acbandwidth=5e6,
+                         amplitude=0., input='in1', output_direct='off', output_signal='quadrature',
+                         quadrature_factor=1, output='off')
+
+
+class SimPid(SimModule):
+    def __init__(self, board):
+        super().__init__(board, ival=0., p=0., i=0., d=0., input='off', output_direct='off', setpoint=0.)
+
+    def is_active(self):
+        return self.output_direct != 'off' and self.input == 'iq0' and (self.i != 0 or self.p != 0)
+
+
+class SimAms(SimModule):
+    def __init__(self, board):
+        super().__init__(board)
+        self._dac2 = 0.
+
+    @property
+    def dac2(self):
+        return self._dac2
+
+    @dac2.setter
+    def dac2(self, value):
+        self._board.advance()
+        # the slow DACs of the Red Pitaya span 0 - 1.8 V in steps of 0.44 mV
+        self._dac2 = pwm_voltage(value)[0]
+
+
+class SimScope(SimModule):
+    def __init__(self, board):
+        super().__init__(board, decimation=1, input1='in1', input2='in2', threshold=0., hysteresis=0.,
+                         trigger_source='immediately', trigger_delay=0.)
+        self._raw = None
+        self._write_pointer_trigger = 0
+        self._trigger_delay_register = 0
+
+    @property
+    def data_length(self):
+        return DATA_LENGTH
+
+    @property
+    def sampling_time(self):
+        return CLOCK_PERIOD * self.decimation
+
+    @property
+    def duration(self):
+        return self.sampling_time * DATA_LENGTH
+
+    def _acquire(self):
+        board = self._board
+        board.advance(self.duration + board.acquisition_latency)
+        if board.latency:
+            time.sleep(board.latency)
+        t0 = board.t
+        if self.trigger_source != 'immediately':
+            t0 = t0 + self._trigger_time(board.t)
+        t = t0 + board.samples * self.sampling_time
+        drive = board.out1(t)
+        return board.signal(self.input1, t, drive), board.signal(self.input2, t, drive)
+
+    def single(self):
+        ch1, ch2 = self._acquire()
+        self._board.words_read += 2 * DATA_LENGTH
+        return ch1, ch2
+
+    # raw trace memory as seen through pyrpl's private scope interface: _start_trace_acquisition() and
+    # _data_ready(), then _reads() of the int14 ring buffers at 0x10000 (ch1) and 0x20000 (ch2) whose
+    # oldest sample follows _write_pointer_trigger + _trigger_delay_register
+    def _start_trace_acquisition(self):
+        ch1, ch2 = self._acquire()
+        self._write_pointer_trigger = int(self._board.rng.integers(DATA_LENGTH))
+        self._trigger_delay_register = DATA_LENGTH // 2
+        shift = self._write_pointer_trigger + self._trigger_delay_register + 1
+        self._raw = {0x10000: np.roll(self._to_raw(ch1), shift), 0x20000: np.roll(self._to_raw(ch2), shift)}
+
+    def _data_ready(self):
+        return self._raw is not None
+
+    def _reads(self, addr, length):
+        base = addr & ~0xFFFF
+        start = (addr - base) // 4
+        self._board.words_read += length
+        return self._raw[base][start:start + length]
+
+    @staticmethod
+    def _to_raw(values):
+        return np.round(values * 2 ** (ADC_BITS - 1)).astype(np.int64) & (2 ** ADC_BITS - 1)
+
+    def _trigger_time(self, t0):
+        # a positive edge trigger of the asg0 ramp puts the threshold crossing in the middle of the trace
+        asg = self._board.asg0
+        if asg.is_constant() or asg.frequency <= 0:
+            return 0.
+        period = 1 / asg.frequency
+        level = np.clip((self.threshold - asg.offset) / asg.amplitude, -1, 1)
+        crossing = (level + 1) / 2 * period
+        return wrap(crossing - self.duration / 2 - t0, period) + self.trigger_delay
+
+
+class SimulatedRedPitaya:
+    # Stand-in for pyrpl.RedPitaya exposing the modules used in src/rp (asg0, asg1, iq0, pid0, ams, scope).
+    # Time is the sum of the simulated acquisition durations and the wall clock time spent outside them,
+    # so sleeps in the control code still let the cavity settle and drift.
+    def __init__(self, hostname: str = 'sim', seed=None, latency: float = 0., acquisition_latency: float = 0.,
+                 **cavity):
+        self.hostname = hostname
+        self.cavity = SimulatedCavity(seed=seed, **cavity)
+        self.rng = self.cavity.rng
+        # real seconds slept per acquisition, to emulate network transfers in benchmarks
+        self.latency = latency
+        # simulated seconds added to each acquisition (arm + transfer)
+        self.acquisition_latency = acquisition_latency
+        self.t = 0.
+        self.temperature = 0.
+        self._wall = time.monotonic()
+        self._noise = self.rng.standard_normal(4 * DATA_LENGTH)
+        self.samples = np.arange(DATA_LENGTH, dtype=float)
+        self.acquisitions = 0
+        # 32 bit words read from the scope memory, to compare readout volumes
+        self.words_read = 0
+        self.asg0 = SimAsg(self)
+        self.asg1 = SimAsg(self)
+        self.iq0 = SimIq(self)
+        self.pid0 = SimPid(self)
+        self.ams = SimAms(self)
+        self.scope = SimScope(self)
+        self.modules = {'asg0': self.asg0, 'asg1': self.asg1, 'iq0': self.iq0, 'pid0': self.pid0,
+                        'ams': self.ams, 'scope': self.scope}
+
+    def advance(self, simulated: float = 0.):
+        now = time.monotonic()
+        dt = simulated + (now - self._wall)
+        self._wall = now
+        self.t += dt
+        cavity = self.cavity
+        # first order thermal response of the laser to dac2
+        if cavity.thermal_tau > 0:
+            self.temperature += (self.ams.dac2 - self.temperature) * (1 - np.exp(-dt / cavity.thermal_tau))
+        else:
+            self.temperature = self.ams.dac2
+        cavity.step_drift(dt)
+        self._update_pid()
+        if simulated:
+            self.acquisitions += 1
+
+    def _update_pid(self):
+        # an integrating loop pulls the piezo onto the resonance inside its capture range and saturates otherwise
+        pid = self.pid0
+        if not pid.is_active():
+            return
+        drive = self._asg_output('out1', np.zeros(1))[0]
+        detuning = self.cavity.detuning(drive + pid.ival, self.temperature)
+        if abs(detuning) < 3 * self.cavity.linewidth:
+            pid.ival = pid.ival - detuning
+        else:
+            pid.ival = float(np.sign(-detuning))
+        pid.ival = float(np.clip(pid.ival, -1 - drive, 1 - drive))
+
+    def _asg_output(self, output, t):
+        out = np.zeros_like(t)
+        for asg in (self.asg0, self.asg1):
+            if asg.output_direct == output:
+                out = out + asg.signal(t)
+        return out
+
+    def out1(self, t):
+        out = self._asg_output('out1', t)
+        if self.pid0.is_active() and self.pid0.output_direct == 'out1':
+            out = out + self.pid0.ival
+        return np.clip(out, -1, 1)
+
+    def _modulated(self):
+        return self.iq0.output_direct != 'off' and self.iq0.amplitude != 0
+
+    def signal(self, name, t, drive=None):
+        cavity = self.cavity
+        drive = self.out1(t) if drive is None else drive
+        if name in ('out1', 'asg0', 'asg1'):
+            # internal DSP signals are digital and do not pick up ADC noise
+            values = drive if name == 'out1' else getattr(self, name).signal(t)
+            return self._quantize(values)
+        # evaluate the cavity once when the piezo is held at a constant voltage
+        x = drive[0] if self._constant_drive() else drive
+        if name == 'in2':
+            values = cavity.transmission(x, self.temperature)
+        elif name == 'in1':
+            values = 1 - 0.8 * cavity.transmission(x, self.temperature)
+        elif name == 'iq0':
+            values = cavity.error_signal(x, self.temperature, self.iq0.phase) * self._modulated() * \
+                     2 * self.iq0.gain * self.iq0.amplitude
+        elif name == 'pid0':
+            return self._quantize(np.full_like(t, self.pid0.ival))
+        else:
+            values = np.zeros_like(t)
+        if np.ndim(values) == 0:
+            values = np.full_like(t, values)
+        return self._add_noise(values)
+
+    def _constant_drive(self):
+        return all(asg.output_direct != 'out1' or asg.is_constant() for asg in (self.asg0, self.asg1))
+
+    def _add_noise(self, values):
+        start = self.rng.integers(0, self._noise.shape[0] - values.shape[0])
+        values = values + self.cavity.noise * self._noise[start:start + values.shape[0]]
+        return self._quantize(values)
+
+    @staticmethod
+    def _quantize(values):
+        # 14 bit signed samples over +-1 V
+        return np.clip(np.round(values * 2 ** (ADC_BITS - 1)), -2 ** (ADC_BITS - 1), 2 ** (ADC_BITS - 1) - 1) / \
+            2 ** (ADC_BITS - 1)
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import numpy as np
+
+
+class TraceStream:
+    # Background acquisition into a preallocated ring buffer of traces. A reader thread calls `acquire()`
+    # back to back and stores every (ch1, ch2) pair with a sequence number and a timestamp; consumers take
+    # the latest trace or iterate over new ones without arming the scope themselves. A consumer that falls
+    # more than `n_slots` traces behind skips ahead and the skipped traces are counted as dropped. Failed
+    # acquisitions are counted in `errors` and reported to `telemetry` when one is given.
+    def __init__(self, acquire, n_slots: int = 64, telemetry=None):
+        self.acquire = acquire
+        self.telemetry = telemetry
+        self.n_slots = n_slots
+        self.buffer = None
+        self.timestamps = np.zeros(n_slots)
+        self.sequence = np.full(n_slots, -1, dtype=np.int64)
+        # sequence number of the newest trace, -1 before the first one
+        self.head = -1
+        self.dropped = 0
+        self.errors = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='trace-stream', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 5.) -> None:
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._cond:
+            self._cond.notify_all()
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def _run(self):
+        while self._running:
+            try:
+                ch1, ch2 = self.acquire()
+            except Exception as e:
+                self.errors += 1
+                if self.telemetry is not None:
+                    self.telemetry.warning('stream_error', f'{type(e).__name__}: {e}', value=self.errors)
+                time.sleep(0.01)
+                continue
+            timestamp = time.time()
+            with self._cond:
+                if self.buffer is None:
+                    self.buffer = np.empty((self.n_slots, 2, len(ch1)), dtype=np.asarray(ch1).dtype)
+                seq = self.head + 1
+                slot = seq % self.n_slots
+                self.buffer[slot, 0] = ch1
+                self.buffer[slot, 1] = ch2
+                self.timestamps[slot] = timestamp
+                self.sequence[slot] = seq
+                self.head = seq
+                self._cond.notify_all()
+
+    def _read(self, seq):
+        slot = seq % self.n_slots
+        return seq, self.timestamps[slot], self.buffer[slot, 0].copy(), self.buffer[slot, 1].copy()
+
+    def latest(self, wait: float = None):
+        # (sequence, timestamp, ch1, ch2) of the newest trace, None if there is none yet and `wait` expires
+        with self._cond:
+            if self.head < 0 and wait:
+                self._cond.wait_for(lambda: self.head >= 0 or not self._running, wait)
+            if self.head < 0:
+                return None
+            return self._read(self.head)
+
+    def next(self, timeout: float = None):
+        # first trace whose acquisition started after the call, None on timeout or when the stream stops
+        with self._cond:
+            seq = self.head + 2
+            if not self._cond.wait_for(lambda: self.head >= seq or not self._running, timeout) or self.head < seq:
+                return None
+            return self._read(self.head)
+
+    def traces(self, start: int = None, timeout: float = None):
+        # yields every new trace in order, starting after the newest one unless `start` is given
+        with self._cond:
+            seq = self.head + 1 if start is None else start
+        while self._running or seq <= self.head:
+            with self._cond:
+                if not self._cond.wait_for(lambda: self.head >= seq or not self._running, timeout):
+                    return
+                if self.head < seq:
+                    return
+                if self.head - seq >= self.n_slots:
+                    skipped = self.head - self.n_slots + 1 - seq
+                    self.dropped += skipped
+                    seq += skipped
+                trace = self._read(seq)
+            seq += 1
+            yield trace
+
+    def __iter__(self):
+        return self.traces()
+
+    def stats(self) -> dict:
+        with self._cond:
+            valid = self.sequence >= 0
+            times = np.sort(self.timestamps[valid])
+        rate = float((len(times) - 1) / (times[-1] - times[0])) if len(times) > 1 and times[-1] > times[0] else 0.
+        return {'acquired': self.head + 1, 'dropped': self.dropped, 'errors': self.errors, 'rate': rate}
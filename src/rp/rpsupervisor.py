@@ -0,0 +1,190 @@
+import threading
+import time
+from enum import Enum
+
+from rpinstrument import LatencyHistogram
+
+
+class LockState(Enum):
+    RESET = 'reset'
+    RAMP = 'ramp'
+    TEMP_SEARCH = 'temp_search'
+    SETTLE = 'settle'
+    FIT = 'fit'
+    LOCKED = 'locked'
+    MONITOR = 'monitor'
+    LOST = 'lost'
+    FAILED = 'failed'
+
+
+class LockSupervisor:
+    # Lock acquisition as an explicit state machine, RESET -> RAMP -> TEMP_SEARCH -> SETTLE -> FIT -> LOCKED,
+    # then MONITOR until the transmission drops below lock_threshold (LOST). A failed state goes back to RESET
+    # after a backoff that doubles with every consecutive failure; after max_retries of them acquire() gives up
+    # (FAILED) without waiting for another backoff. A check that raises fails the attempt in LOCKED and counts
+    # as a lost lock in MONITOR. The steps are callables of the controller:
+    #   reset(), ramp(), search() -> bool, settle(), fit() (raises on failure), check() -> LockCheck
+    # settle is usually a SettleDetector.wait; a settle timeout does not fail the attempt, the fit decides.
+    # Without one SETTLE waits settle_time seconds.
+    # on_locked(point) gets what fit() returned once the LOCKED check has confirmed the lock, so only confirmed
+    # lock points reach the lock point cache; a failing on_locked is reported but keeps the lock.
+    # The time spent in every state is kept in `timings`, failures per state in `failures`.
+    def __init__(self, reset, ramp, search, fit, check, settle=None, settle_time: float = 10.,
+                 lock_threshold: float = 0.95, max_retries: int = 10, backoff: float = 1., max_backoff: float = 60.,
+                 monitor_interval: float = 10., on_locked=None, telemetry=None):
+        self.steps = {LockState.RESET: reset, LockState.RAMP: ramp, LockState.TEMP_SEARCH: search,
+                      LockState.SETTLE: settle if settle is not None else lambda: time.sleep(settle_time),
+                      LockState.FIT: fit}
+        self.check = check
+        self.lock_threshold = lock_threshold
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.monitor_interval = monitor_interval
+        self.on_locked = on_locked
+        self.telemetry = telemetry
+        self.state = LockState.RESET
+        self.timings = {state: LatencyHistogram() for state in LockState}
+        self.failures = {state: 0 for state in LockState}
+        self.locks = 0
+        self.losses = 0
+        self.checks = 0
+        # the LockCheck of the last LOCKED or MONITOR check
+        self.last_check = None
+        self._entered = time.perf_counter()
+        self._stop = threading.Event()
+
+    def _enter(self, state: LockState) -> None:
+        now = time.perf_counter()
+        self.timings[self.state].add(now - self._entered)
+        self.state = state
+        self._entered = now
+        if self.telemetry is not None:
+            self.telemetry.debug('lock_state', state.value)
+
+    def _fail(self, state: LockState, reason: str, attempt: int) -> None:
+        self.failures[state] += 1
+        if attempt >= self.max_retries:
+            if self.telemetry is not None:
+                self.telemetry.warning('lock_failed', f'{state.value}: {reason}, giving up', value=attempt)
+            return
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        if self.telemetry is not None:
+            self.telemetry.warning('lock_failed', f'{state.value}: {reason}, retrying in {delay:.0f} s',
+                                   value=attempt)
+        self._stop.wait(delay)
+
+    def acquire(self) -> bool:
+        # runs the acquisition states until the cavity is locked, iteratively retrying failures
+        for attempt in range(1, self.max_retries + 1):
+            if self._stop.is_set():
+                break
+            failed = None
+            point = None
+            for state in (LockState.RESET, LockState.RAMP, LockState.TEMP_SEARCH, LockState.SETTLE, LockState.FIT):
+                self._enter(state)
+                try:
+                    result = self.steps[state]()
+                except Exception as e:
+                    failed = (state, f'{type(e).__name__}: {e}')
+                    break
+                if state is LockState.TEMP_SEARCH and not result:
+                    failed = (state, 'TEM00 mode not found')
+                    break
+                if state is LockState.FIT:
+                    point = result
+            if failed is None:
+                self._enter(LockState.LOCKED)
+                try:
+                    self.last_check = self.check()
+                except Exception as e:
+                    self.last_check = None
+                    failed = (LockState.LOCKED, f'{type(e).__name__}: {e}')
+                else:
+                    transmission = self.last_check.max
+                    if transmission >= self.lock_threshold:
+                        self.locks += 1
+                        if self.on_locked is not None and point is not None:
+                            try:
+                                self.on_locked(point)
+                            except Exception as e:
+                                if self.telemetry is not None:
+                                    self.telemetry.warning('lock_point', f'{type(e).__name__}: {e}')
+                        if self.telemetry is not None:
+                            self.telemetry.info('locked', transmission=transmission, value=attempt)
+                        return True
+                    failed = (LockState.LOCKED, f'transmission {transmission:.3f} after the fit')
+            self._fail(*failed, attempt)
+        self._enter(LockState.FAILED)
+        return False
+
+    def monitor(self, on_check=None, until: float = None):
+        # polls check() every monitor_interval until the lock is lost (returns the last LockCheck), until the
+        # time.time() deadline `until`, or until on_check(check) returns False (both return None). A check that
+        # raises loses the lock too, with state LOST and last_check None, but returns None as there is no check.
+        self._enter(LockState.MONITOR)
+        started = time.time()
+        while until is None or time.time() < until:
+            if self._stop.wait(self.monitor_interval):
+                return None
+            try:
+                check = self.last_check = self.check()
+            except Exception as e:
+                self.last_check = None
+                self.losses += 1
+                self._enter(LockState.LOST)
+                if self.telemetry is not None:
+                    self.telemetry.warning('lock_lost', f'check failed after {time.time() - started:.1f} s: '
+                                                        f'{type(e).__name__}: {e}')
+                return None
+            self.checks += 1
+            # on_check also sees the check that finds the lock lost
+            stop = on_check is not None and on_check(check) is False
+            if check.max < self.lock_threshold:
+                self.losses += 1
+                self._enter(LockState.LOST)
+                if self.telemetry is not None:
+                    self.telemetry.info('lock_lost', f'took {time.time() - started:.1f} s', transmission=check.max)
+                return check
+            if stop:
+                return None
+        return None
+
+    def run(self, on_check=None, until: float = None) -> None:
+        # keeps the cavity locked, relocking after every loss, until the deadline or until on_check(check)
+        # returns False (also on the check that finds the lock lost); raises when a relock fails
+        stopped = False
+
+        def check(lock_check):
+            nonlocal stopped
+            result = on_check(lock_check)
+            stopped = stopped or result is False
+            return result
+        try:
+            while (until is None or time.time() < until) and not self._stop.is_set():
+                if not self.acquire():
+                    if self._stop.is_set():
+                        return
+                    raise RuntimeError(f'could not lock the cavity in {self.max_retries} attempts')
+                self.monitor(None if on_check is None else check, until)
+                if stopped:
+                    return
+        finally:
+            self._stop.clear()
+
+    def stop(self) -> None:
+        # makes a running run() return after the current step, from any thread
+        self._stop.set()
+
+    def time_in(self, state: LockState) -> float:
+        # total seconds spent in a state, including the current visit
+        total = self.timings[state].total
+        if self.state is state:
+            total += time.perf_counter() - self._entered
+        return total
+
+    def stats(self) -> dict:
+        return {'state': self.state.value, 'locks': self.locks, 'losses': self.losses, 'checks': self.checks,
+                'failures': {state.value: n for state, n in self.failures.items() if n},
+                'time_in_state': {state.value: {'count': h.count, 'mean': h.mean, 'max': h.max}
+                                  for state, h in self.timings.items() if h.count}}
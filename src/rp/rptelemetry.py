@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+# numeric fields of an event, NaN / -1 when not given. transmission: the cavity transmission (in2, the blue
+# signal) max, signal_max: the fast signal (out1, the purple signal) max, value: anything else, e.g. a mean
+EVENT_DTYPE = np.dtype([('timestamp', '<f8'), ('level', '<i1'), ('event', '<i2'), ('episode', '<i4'),
+                        ('state', '<i4'), ('action', '<i4'), ('dac2', '<f8'), ('signal_max', '<f8'),
+                        ('transmission', '<f8'), ('value', '<f8')])
+INT_FIELDS = ('episode', 'state', 'action')
+FLOAT_FIELDS = ('dac2', 'signal_max', 'transmission', 'value')
+
+
+class Telemetry:
+    # Structured events of the control loops in a preallocated ring buffer. emit() below `level` returns at
+    # once, anything else is one row write; a background thread writes the new rows to `path` as json lines
+    # every `interval` seconds and prints the ones at or above `echo`. A writer that falls more than `capacity`
+    # events behind loses the oldest ones, counted in `dropped`.
+    def __init__(self, path: str = None, level: int = INFO, echo: int = INFO, capacity: int = 65536,
+                 interval: float = 1.):
+        self.path = path
+        self.level = level
+        self.echo = echo
+        self.capacity = capacity
+        self.interval = interval
+        self.rows = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self.messages = [None] * capacity
+        self.events = []
+        self._event_ids = {}
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+        self._thread.start()
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def emit(self, event: str, level: int = DEBUG, message: str = None, **fields) -> None:
+        if level < self.level:
+            return
+        event_id = self._event_ids.get(event)
+        if event_id is None:
+            event_id = self._register(event)
+        row = (time.time(), level, event_id,
+               *(fields.get(name, -1) for name in INT_FIELDS), *(fields.get(name, np.nan) for name in FLOAT_FIELDS))
+        with self._lock:
+            slot = self.head % self.capacity
+            self.rows[slot] = row
+            self.messages[slot] = message
+            self.head += 1
+
+    def _register(self, event: str) -> int:
+        # the first emit of an event from any thread gives it its id; the name is in `events` before the id is
+        # published, so a thread that finds the id also finds the name
+        with self._lock:
+            event_id = self._event_ids.get(event)
+            if event_id is None:
+                self.events.append(event)
+                event_id = self._event_ids[event] = len(self.events) - 1
+            return event_id
+
+    def debug(self, event: str, message: str = None, **fields) -> None:
+        if DEBUG >= self.level:
+            self.emit(event, DEBUG, message, **fields)
+
+    def info(self, event: str, message: str = None, **fields) -> None:
+        if INFO >= self.level:
+            self.emit(event, INFO, message, **fields)
+
+    def warning(self, event: str, message: str = None, **fields) -> None:
+        if WARNING >= self.level:
+            self.emit(event, WARNING, message, **fields)
+
+    def error(self, event: str, message: str = None, **fields) -> None:
+        if ERROR >= self.level:
+            self.emit(event, ERROR, message, **fields)
+
+    def _take(self):
+        with self._lock:
+            head, tail = self.head, self.tail
+            if head - tail > self.capacity:
+                self.dropped += head - tail - self.capacity
+                tail = head - self.capacity
+            slots = np.arange(tail, head) % self.capacity
+            rows = self.rows[slots]
+            messages = [self.messages[slot] for slot in slots]
+            self.tail = head
+        return rows, messages
+
+    def _format(self, row, message) -> dict:
+        record = {'time': float(row['timestamp']), 'level': LEVEL_NAMES.get(int(row['level']), int(row['level'])),
+                  'event': self.events[row['event']]}
+        record.update({name: int(row[name]) for name in INT_FIELDS if row[name] != -1})
+        record.update({name: float(row[name]) for name in FLOAT_FIELDS if not np.isnan(row[name])})
+        if message is not None:
+            record['message'] = message
+        return record
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        rows, messages = self._take()
+        if rows.shape[0] == 0:
+            return
+        records = [self._format(row, message) for row, message in zip(rows, messages)]
+        if self.path is not None:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(''.join(json.dumps(record) + '\n' for record in records))
+            self._file.flush()
+        for row, record in zip(rows, records):
+            if row['level'] >= self.echo:
+                fields = ' '.join(f'{k}={v}' for k, v in record.items() if k not in ('time', 'level', 'event',
+                                                                                      'message'))
+                print(f'{record["event"]}: {record.get("message", "")} {fields}'.rstrip())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,129 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class SearchResult:
+    found: bool
+    temperature: float = None
+    peak_index: int = None
+    peak_height: float = None
+    acquisitions: int = 0
+    duration: float = 0.
+
+
+class TemperatureSearch:
+    # Finds the dac2 voltage that puts the TEM00 peak in the middle of the piezo ramp.
+    # A coarse sweep looks for two neighbouring temperatures whose TEM00 peak sits on opposite sides of the
+    # middle of the trace, then the bracket is refined by bisection or by the secant of the peak position,
+    # which moves linearly with the temperature. method='linear' is the original fine sweep.
+    methods = ('bisect', 'secant', 'linear')
+
+    def __init__(self, start: float = 0., stop: float = 0.3, coarse_step: float = 0.005, fine_step: float = 0.00025,
+                 threshold: float = 0.95, method: str = 'secant', max_refinements: int = 12, settle: float = 0.2):
+        assert method in self.methods
+        self.start = start
+        self.stop = stop
+        self.coarse_step = coarse_step
+        self.fine_step = fine_step
+        self.threshold = threshold
+        self.method = method
+        self.max_refinements = max_refinements
+        # seconds the laser temperature is given to follow a dac2 jump before the trace is taken
+        self.settle = settle
+
+    def search(self, measure, epsilon: int = 1000, start: float = None, stop: float = None) -> SearchResult:
+        # measure(temperature, settle) sets dac2, waits settle seconds and returns (peak_index, peak_height,
+        # trace_length)
+        start = self.start if start is None else start
+        stop = self.stop if stop is None else stop
+        t0 = time.perf_counter()
+        self._measure = measure
+        self._epsilon = epsilon
+        self._acquisitions = 0
+        if self.method == 'linear':
+            result = self._linear(start, stop)
+        else:
+            result = self._coarse_to_fine(start, stop)
+        result.acquisitions = self._acquisitions
+        result.duration = time.perf_counter() - t0
+        return result
+
+    def _probe(self, temperature, settle=None):
+        peak_index, peak_height, length = self._measure(temperature, self.settle if settle is None else settle)
+        self._acquisitions += 1
+        # signed distance of the peak from the middle of the trace, None if no TEM00 peak is visible
+        offset = peak_index - length // 2 if peak_height > self.threshold else None
+        found = offset is not None and abs(offset) < self._epsilon
+        return offset, SearchResult(found, temperature, peak_index, peak_height)
+
+    def _linear(self, start, stop):
+        for temperature in np.arange(start, stop, self.fine_step):
+            # fine steps are small enough for the temperature to follow without waiting
+            _, result = self._probe(temperature, 0.)
+            if result.found:
+                return result
+        return SearchResult(False)
+
+    def _coarse_to_fine(self, start, stop):
+        previous = None
+        for temperature in np.arange(start, stop, self.coarse_step):
+            offset, result = self._probe(temperature)
+            if result.found:
+                return result
+            if offset is not None and previous is not None:
+                if np.sign(offset) != np.sign(previous[1]):
+                    refined = self._refine(previous, (temperature, offset))
+                    if refined.found:
+                        return refined
+                elif self.method == 'secant' and offset != previous[1]:
+                    refined = self._extrapolate(previous, (temperature, offset), stop)
+                    if refined.found:
+                        return refined
+            previous = (temperature, offset) if offset is not None else None
+        return SearchResult(False)
+
+    def _extrapolate(self, previous, current, stop):
+        # the peak moves linearly with the temperature: follow the line through the last two points to the middle
+        result = SearchResult(False)
+        for _ in range(self.max_refinements):
+            (t_prev, o_prev), (t, o) = previous, current
+            if o == o_prev:
+                break
+            target = t - o * (t - t_prev) / (o - o_prev)
+            if not t + self.fine_step < target < stop:
+                break
+            offset, result = self._probe(target)
+            if result.found or offset is None:
+                return result
+            if np.sign(offset) != np.sign(o):
+                return self._refine((t, o), (target, offset))
+            previous, current = current, (target, offset)
+        return result
+
+    def _refine(self, low, high):
+        (t_low, o_low), (t_high, o_high) = low, high
+        result = SearchResult(False)
+        for _ in range(self.max_refinements):
+            if t_high - t_low < self.fine_step:
+                break
+            if self.method == 'secant':
+                temperature = t_low - o_low * (t_high - t_low) / (o_high - o_low)
+                # keep the secant inside the bracket so a bad model cannot stall the search
+                margin = 0.1 * (t_high - t_low)
+                temperature = float(np.clip(temperature, t_low + margin, t_high - margin))
+            else:
+                temperature = (t_low + t_high) / 2
+            offset, result = self._probe(temperature)
+            if result.found:
+                return result
+            if offset is None:
+                # the TEM00 peak left the trace: the bracket straddled a free spectral range
+                break
+            if np.sign(offset) == np.sign(o_low):
+                t_low, o_low = temperature, offset
+            else:
+                t_high, o_high = temperature, offset
+        return SearchResult(False, result.temperature, result.peak_index, result.peak_height)
@@ -0,0 +1,96 @@
+import numpy as np
+from gymnasium import spaces
+from gymnasium.vector import VectorEnv, AutoresetMode
+from gymnasium.vector.utils import batch_space
+
+from rpsim import SimulatedCavity, DATA_LENGTH, CLOCK_PERIOD, ADC_BITS, wrap
+
+
+class RedPitayaVectorEnv(VectorEnv):
+    # N independent simulated cavities stepped together with the observation, action and reward of RedPitayaEnv:
+    # the observation is the max of the in2 trace, the action is added to dac2 and the episode ends below 0.95.
+    metadata = {'autoreset_mode': AutoresetMode.SAME_STEP}
+
+    def __init__(self, num_envs: int = 16, seed=None, lock_threshold: float = 0.95, max_episode_steps: int = None,
+                 decimation: int = 256, step_delay: float = 0.0011, **cavity):
+        self.num_envs = num_envs
+        self.single_action_space = spaces.Box(low=-0.3, high=0.3, shape=(1,), dtype=np.float32)
+        self.single_observation_space = spaces.Box(low=0, high=1, shape=(1,), dtype=np.float32)
+        self.action_space = batch_space(self.single_action_space, num_envs)
+        self.observation_space = batch_space(self.single_observation_space, num_envs)
+        self.reward_range = (-0.95, 0.04)
+        self.lock_threshold = lock_threshold
+        self.max_episode_steps = max_episode_steps
+        # simulated seconds per step: the sleeps in RedPitayaEnv.step plus one scope trace
+        self.dt = step_delay + CLOCK_PERIOD * decimation * DATA_LENGTH
+        self.cavity = SimulatedCavity(seed=seed, **cavity)
+        self._init_state(self.cavity.rng)
+
+    def _init_state(self, rng):
+        n = self.num_envs
+        self.cavity.x_ref = rng.uniform(0, self.cavity.fsr, n)
+        self.dac2 = np.zeros(n)
+        self.temperature = np.zeros(n)
+        self.piezo = np.zeros(n)
+        self.episode_steps = np.zeros(n, dtype=np.int64)
+        # Gumbel approximation of the max of DATA_LENGTH gaussian noise samples
+        log_n = np.log(DATA_LENGTH)
+        self._max_loc = np.sqrt(2 * log_n) - (np.log(log_n) + np.log(4 * np.pi)) / (2 * np.sqrt(2 * log_n))
+        self._max_scale = 1 / np.sqrt(2 * log_n)
+
+    def _lock(self, mask):
+        # what reset() ends with on the board: the first dac2 of the temperature scan that puts the TEM00
+        # resonance in the middle of the piezo ramp, then the piezo parked on the fitted resonance
+        cavity = self.cavity
+        x_ref = cavity.x_ref[mask]
+        dac2 = wrap(0.5 - x_ref, cavity.fsr) / cavity.tuning
+        self.dac2[mask] = dac2
+        self.temperature[mask] = dac2
+        self.piezo[mask] = 0.5
+        self.episode_steps[mask] = 0
+
+    def _observe(self):
+        cavity = self.cavity
+        transmission = cavity.transmission(self.piezo, self.temperature)
+        noise = self._max_loc + self._max_scale * cavity.rng.gumbel(size=self.num_envs)
+        obs = np.minimum(transmission + cavity.noise * noise, 1 - 2 ** -(ADC_BITS - 1))
+        return obs.astype(np.float32).reshape(self.num_envs, 1)
+
+    def reset(self, *, seed=None, options=None):
+        if seed is not None:
+            self.cavity.rng = np.random.default_rng(seed)
+            self._init_state(self.cavity.rng)
+        self._lock(np.ones(self.num_envs, dtype=bool))
+        return self._observe(), {}
+
+    def step(self, actions):
+        cavity = self.cavity
+        actions = np.clip(np.asarray(actions, dtype=float).reshape(self.num_envs), -0.3, 0.3)
+        self.dac2 = np.clip(self.dac2 + actions, 0., 1.8)
+        if cavity.thermal_tau > 0:
+            self.temperature += (self.dac2 - self.temperature) * (1 - np.exp(-self.dt / cavity.thermal_tau))
+        else:
+            self.temperature[:] = self.dac2
+        if cavity.drift > 0:
+            cavity.x_ref += cavity.drift * np.sqrt(self.dt) * cavity.rng.standard_normal(self.num_envs)
+        self.episode_steps += 1
+
+        obs = self._observe()
+        rewards = obs[:, 0] - self.lock_threshold
+        terminations = obs[:, 0] < self.lock_threshold
+        if self.max_episode_steps is not None:
+            truncations = ~terminations & (self.episode_steps >= self.max_episode_steps)
+        else:
+            truncations = np.zeros(self.num_envs, dtype=bool)
+
+        infos = {}
+        done = terminations | truncations
+        if done.any():
+            infos['final_obs'] = obs.copy()
+            infos['_final_obs'] = done
+            self._lock(done)
+            obs[done] = self._observe()[done]
+        return obs, rewards.astype(np.float32), terminations, truncations, infos
+
+    def render(self):
+        return None
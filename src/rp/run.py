@@ -1,22 +1,36 @@
 from os.path import exists
-from stable_baselines3 import PPO
-from stable_baselines3.common.utils import set_random_seed
-from stable_baselines3.common.callbacks import CheckpointCallback
 
 from redpitayaenv import RedPitayaEnv
+from rpvecenv import RedPitayaVectorEnv
+from rpreplay import RedPitayaReplayEnv
 from rpscope import RedPitayaScope
-from pyrpl import Pyrpl
+from rpsession import sessions
 
-def create_env(skip: int = 15):
-    #env = RedPitayaEnv(RedPitayaScope('169.254.167.128'))
+def create_env(skip: int = 15, hostname: str = '169.254.167.128'):
+    # hostname='sim' trains against the in-process cavity simulator, without the background trace stream
+    env = RedPitayaEnv(RedPitayaScope(hostname))
     #env = SkipSteps(env, skip)
-    return #env
+    return env
+
+
+def create_vec_env(num_envs: int = 16, seed: int = 42, max_episode_steps: int = 2048):
+    # batched simulated cavities for fast PPO rollouts
+    from rpsb3 import SB3VectorEnv
+    return SB3VectorEnv(RedPitayaVectorEnv(num_envs, seed=seed, max_episode_steps=max_episode_steps))
+
+
+def create_replay_env(path: str = 'dataset/traces', seed: int = 42, max_episode_steps: int = 2048):
+    # offline pretraining on traces recorded by PIDIQ
+    return RedPitayaReplayEnv(path, seed=seed, max_episode_steps=max_episode_steps)
 
 
 def ppo_model(env, verbose: int = 1, n_steps: int = 2048 * 8,
               batch_size: int = 64, n_epochs: int = 10, gamma: float = 0.999,
               device: str = 'cpu', file_name=None):
     assert device in ['cuda', 'mps', 'cpu']
+    # stable_baselines3 and torch take a second to import, only training needs them
+    from stable_baselines3 import PPO
+    from stable_baselines3.common.utils import set_random_seed
     set_random_seed(42, 'cuda' == device)
     if file_name is not None and exists(file_name + '.zip'):
         print('\nLoading checkpoint')
@@ -35,9 +49,20 @@ def ppo_model(env, verbose: int = 1, n_steps: int = 2048 * 8,
     return model
 
 
+def run_policy(file_name: str, hostname: str = '169.254.167.128', steps: int = None, episodes: int = 1):
+    # deployment: the trained actor runs in NumPy, torch is only imported to export it the first time
+    from rppolicy import NumpyPolicy, PolicyRunner, export_policy
+    if not exists(file_name + '.npz'):
+        export_policy(file_name + '.zip', file_name + '.npz')
+    env = create_env(hostname=hostname)
+    runner = PolicyRunner(env, NumpyPolicy.load(file_name + '.npz'), env.rp.telemetry)
+    return runner.run(steps, episodes)
+
+
 def run():
     RedPitayaScope(hostname='169.254.167.128')
-    """model = ppo_model(
+    """from stable_baselines3.common.callbacks import CheckpointCallback
+    model = ppo_model(
         create_env(),
         verbose=1,
         n_steps=256,
@@ -55,5 +80,7 @@ def run():
 
 
 if __name__ == '__main__':
-    p = Pyrpl(hostname='169.254.167.128')
+    # connection check: the session is reused by every env and controller created afterwards
+    session = sessions.get('169.254.167.128')
+    print(session.stats())
     #run()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules of src/rp and src/pidtuning import each other as top level modules
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ('rp', 'pidtuning'):
+    sys.path.insert(0, os.path.join(ROOT, 'src', directory))
@@ -0,0 +1,39 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+from redpitayaenv import RedPitayaEnv
+from rpscope import RedPitayaScope
+
+
+@pytest.fixture
+def make_env(tmp_path, monkeypatch):
+    # lock_cache.json and scope_trace.npy go to the working directory
+    monkeypatch.chdir(tmp_path)
+    envs = []
+
+    def make(hostname, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            envs.append(RedPitayaEnv(RedPitayaScope(hostname), rate=None, **kwargs))
+        return envs[-1]
+    yield make
+    for env in envs:
+        env.close()
+
+
+def test_zero_actions_keep_the_simulated_cavity_locked(make_env):
+    env = make_env('sim:11')
+    assert not env.stream
+    for _ in range(10):
+        state, _, done, _, _ = env.step(np.zeros(1, dtype=np.float32))
+        assert state >= 0.95 and not done
+
+
+def test_streamed_observation_follows_the_action(make_env):
+    env = make_env('sim:12', stream=True)
+    assert env.rp.stream is not None and env.rp.stream.running
+    # a jump of the laser temperature far beyond the linewidth shows in the observation of the same step
+    state, _, done, _, _ = env.step(np.full(1, 0.3, dtype=np.float32))
+    assert state < 0.5 and done
@@ -0,0 +1,63 @@
+import time
+
+import numpy as np
+
+from rpbus import TraceBus, TraceSubscriber, record_traces, start_subscriber
+from rprecorder import TraceReader
+
+
+def traces(k, length=64):
+    return np.full((2, length), k, dtype=np.float32)
+
+
+def test_round_trip():
+    with TraceBus(length=64, n_slots=8) as bus, TraceSubscriber(bus.name, start=0, copy=True) as subscriber:
+        for k in range(3):
+            bus.publish(traces(k), dac2=0.1 * k, locked=True, counter=k, transmission=0.9)
+        received = [subscriber.poll() for _ in range(3)]
+        assert [trace.counter for trace in received] == [0, 1, 2]
+        assert np.array_equal(received[2].data, traces(2))
+        assert received[1].dac2 == 0.1 and received[1].transmission == np.float32(0.9)
+        assert subscriber.poll() is None
+
+
+def test_lapped_subscriber_counts_the_dropped_traces():
+    with TraceBus(length=64, n_slots=4) as bus, TraceSubscriber(bus.name, start=0) as subscriber:
+        for k in range(10):
+            bus.publish(traces(k), counter=k)
+        assert subscriber.poll().counter == 6
+        assert subscriber.dropped == 6
+
+
+def test_traces_published_right_before_close_are_read():
+    with TraceBus(length=64, n_slots=8) as bus, TraceSubscriber(bus.name) as subscriber:
+        poll = subscriber.poll
+
+        def racing_poll():
+            # the publisher sends its last trace and closes between the subscriber's poll and its closed check
+            trace = poll()
+            if bus.published == 0:
+                bus.publish(traces(0), counter=0)
+                bus.close()
+            return trace
+        subscriber.poll = racing_poll
+        assert subscriber.next(timeout=1.).counter == 0
+        assert subscriber.next(timeout=1.) is None
+
+
+def test_closed_bus_is_drained_by_a_starting_subscriber(tmp_path):
+    # the bus closes before the spawned recorder has attached
+    path = str(tmp_path / 'traces')
+    bus = TraceBus(length=64, n_slots=64)
+    try:
+        process = start_subscriber(record_traces, bus.name, path, ('ch1', 'ch2'))
+        for k in range(20):
+            bus.publish(traces(k), counter=k)
+        time.sleep(0.05)
+        bus.close()
+        process.join(60)
+        assert process.exitcode == 0
+    finally:
+        bus.unlink()
+    reader = TraceReader(path)
+    assert np.array_equal(reader.counter, np.arange(20))
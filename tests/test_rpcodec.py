@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from rpcodec import INT14_MAX, INT14_MIN, TraceCodec, load_traces, save_traces
+
+KINDS = ('int14', 'float16', 'float32')
+COMPRESSIONS = (None, 'zlib', 'lzma')
+
+
+def scope_traces(n=10, length=512, seed=0):
+    # (n, 2, length) traces on the scope's int14 grid, a ramp and a noisy error signal
+    rng = np.random.default_rng(seed)
+    ramp = np.tile(np.arange(length) % 2 ** 14 - 2 ** 13, (n, 1))
+    noise = rng.integers(INT14_MIN, INT14_MAX + 1, (n, length))
+    return np.stack((ramp, noise), axis=1) * 2. ** -13
+
+
+def tolerance(kind):
+    # largest round trip error of a value in [-1, 1)
+    return {'int14': 0., 'float16': 2. ** -11, 'float32': 0.}[kind]
+
+
+@pytest.mark.parametrize('kind', KINDS)
+def test_encode_round_trip(kind):
+    codec = TraceCodec(kind)
+    traces = scope_traces()
+    q = codec.encode(traces)
+    assert q.dtype == codec.dtype
+    assert np.abs(codec.decode(q) - traces).max() <= tolerance(kind)
+
+
+def test_int14_rounds_and_clips():
+    codec = TraceCodec(offset=0.5)
+    x = np.array([-10., 0.5, 0.5 + 2. ** -13 * 0.4, 10.])
+    assert codec.encode(x).tolist() == [INT14_MIN, 0, 0, INT14_MAX]
+    assert codec.decode(codec.encode(x))[1] == 0.5
+
+
+@pytest.mark.parametrize('kind', KINDS)
+@pytest.mark.parametrize('compression', ('zlib', 'lzma'))
+def test_compress_round_trip(kind, compression):
+    codec = TraceCodec(kind, compression=compression)
+    q = codec.encode(scope_traces())
+    assert np.array_equal(codec.decompress(codec.compress(q), q.shape), q)
+
+
+@pytest.mark.parametrize('compression', ('zlib', 'lzma'))
+def test_delta_wrap(compression):
+    # full scale jumps overflow nothing: int16 deltas wrap and the int16 cumulative sum undoes them
+    codec = TraceCodec(compression=compression)
+    q = np.array([[INT14_MIN, INT14_MAX, INT14_MIN, 0, INT14_MAX, INT14_MAX, INT14_MIN]], dtype=np.int16)
+    assert np.array_equal(codec.decompress(codec.compress(q), q.shape), q)
+
+
+@pytest.mark.parametrize('kind', KINDS)
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_save_load_round_trip(tmp_path, kind, compression):
+    traces = scope_traces(n=21)
+    codec = TraceCodec(kind, compression=compression)
+    path = str(tmp_path / 'traces.rpt')
+    size = save_traces(path, traces, codec, chunk_size=4)
+    assert size == (tmp_path / 'traces.rpt').stat().st_size
+    loaded = load_traces(path)
+    assert len(loaded) == 21
+    assert loaded.codec.to_dict() == codec.to_dict()
+    atol = tolerance(kind)
+    assert np.abs(loaded[:] - traces).max() <= atol
+    # lazy access across chunk boundaries, with the same indexing as the array
+    for key in (7, slice(3, 9), (5, 1), (slice(2, 18, 5), 0), np.array([20, 0, 4])):
+        assert np.abs(loaded[key] - traces[key]).max() <= atol
+
+
+def test_uncompressed_files_are_memory_mapped(tmp_path):
+    path = str(tmp_path / 'traces.rpt')
+    save_traces(path, scope_traces(), TraceCodec())
+    loaded = load_traces(path)
+    assert isinstance(loaded.raw, np.memmap)
+    assert loaded.offset % 64 == 0
+
+
+def test_invalid_codec():
+    with pytest.raises(ValueError):
+        TraceCodec('int8')
+    with pytest.raises(ValueError):
+        TraceCodec(compression='bz2')
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from rpfit import PDHFitter
+
+
+def pdh(x, A, B, g, x0):
+    return -2 * A * (x - x0) / ((x - x0) ** 2 + g ** 2) ** 2 + B
+
+
+def test_warm_start_with_a_negative_linewidth_keeps_the_amplitude_sign():
+    x = np.linspace(-1, 1, 4000)
+    A, B, g, x0 = 2e-4, 0.01, 0.05, 0.1
+    rng = np.random.default_rng(0)
+    y = pdh(x, A, B, g, x0) + rng.normal(0, 1e-3, x.shape[0])
+    # the same curve as (A, B, g, x0), the fit converges to a negative g
+    result = PDHFitter().fit(x, y, (A, B, -g, x0))
+    assert result.success
+    assert result.params[0] == pytest.approx(A, rel=1e-2)
+    assert result.params[2] == pytest.approx(g, rel=1e-2)
+    assert result.params[3] == pytest.approx(x0, abs=1e-3)
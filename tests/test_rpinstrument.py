@@ -0,0 +1,16 @@
+from rpinstrument import instrument
+from rppid import RedPitayaPID
+
+
+def test_supervisor_steps_are_timed_when_instrumented_after_construction(tmp_path, monkeypatch):
+    # lock_cache.json and scope_trace.npy go to the working directory
+    monkeypatch.chdir(tmp_path)
+    rp = RedPitayaPID('sim:3')
+    try:
+        instrumentation = instrument(rp)
+        assert rp.supervisor.acquire()
+        calls = instrumentation.summary()['calls']
+        for name in ('rp.reset', 'rp.scan_temperature', 'rp.lock_cavity', 'rp.lock_check', 'fitter.fit'):
+            assert calls[name]['calls'] >= 1, name
+    finally:
+        rp.close()
@@ -0,0 +1,25 @@
+import json
+
+from rplockcache import LockPoint, LockPointCache
+
+
+def point(temperature):
+    return LockPoint(temperature, 2e-4, 0., 0.05, 0.5, 20.)
+
+
+def test_caches_sharing_a_file_keep_each_others_boards(tmp_path):
+    path = str(tmp_path / 'lock_cache.json')
+    a, b = LockPointCache(path), LockPointCache(path)
+    a.store('board-a', point(0.3))
+    b.store('board-b', point(0.6))
+    with open(path) as f:
+        entries = json.load(f)
+    assert entries['board-a']['point']['temperature'] == 0.3
+    assert entries['board-b']['point']['temperature'] == 0.6
+    # b picked board-a up from the file, a sees board-b after its next save
+    assert b.get('board-a').temperature == 0.3
+    a.invalidate('board-a')
+    assert a.get('board-b').temperature == 0.6
+    assert LockPointCache(path).get('board-a') is None
+    # no temporary files are left next to the cache
+    assert [p.name for p in tmp_path.iterdir()] == ['lock_cache.json']
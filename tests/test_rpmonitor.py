@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from rpmonitor import DeferredClient, MonitorServerStandIn, MonitorSocketClient, RegisterTransaction
+
+BASE = 0x40300000
+
+
+class Module:
+    # the part of a pyrpl hardware module a transaction touches: registers are written through `_client`
+    def __init__(self, client, base):
+        self._client = client
+        self.base = base
+
+    def write(self, offset, value):
+        self._client.writes(self.base + offset, [value])
+
+
+class Board:
+    def __init__(self, client):
+        self.client = client
+        self.modules = {'pid0': Module(client, BASE), 'asg0': Module(client, BASE + 0x1000)}
+
+
+@pytest.fixture
+def server():
+    server = MonitorServerStandIn()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def client(server):
+    client = MonitorSocketClient('localhost', server.port)
+    yield client
+    client.close()
+
+
+def test_transaction_sends_one_packet(server, client):
+    board = Board(client)
+    transaction = RegisterTransaction(board)
+    pid = board.modules['pid0']
+    with transaction:
+        for i in range(8):
+            pid.write(4 * i, 100 + i)
+        assert server.packets[b'w'] == 0
+    assert server.packets[b'w'] == 1
+    assert transaction.round_trips == 1
+    assert [server.memory[BASE + 4 * i] for i in range(8)] == [100 + i for i in range(8)]
+    # the modules talk to the board directly again
+    assert pid._client is client
+
+
+def test_transaction_scattered_writes_one_round_trip(server, client):
+    board = Board(client)
+    transaction = RegisterTransaction(board)
+    with transaction:
+        board.modules['pid0'].write(0, 1)
+        board.modules['asg0'].write(8, 2)
+        # nested blocks flush with the outermost one
+        with transaction:
+            board.modules['pid0'].write(4, 3)
+    # writes only merge with the run before them, so these are three packets in one burst
+    assert transaction.round_trips == 1
+    assert server.packets[b'w'] == 3
+    assert server.memory == {BASE: 1, BASE + 4: 3, BASE + 0x1008: 2}
+
+
+def test_reads_see_queued_writes(server, client):
+    deferred = DeferredClient(client)
+    deferred.writes(BASE, [7, 8])
+    assert list(deferred.reads(BASE + 4, 1)) == [8]
+    assert server.packets[b'r'] == 0
+    client.writes(BASE + 64, [9])
+    # a read of an address that is not queued flushes first
+    assert list(deferred.reads(BASE + 64, 1)) == [9]
+    assert deferred.flushes == 1
+    assert server.memory[BASE] == 7
+
+
+def test_single_write_goes_through_the_client(server, client):
+    calls = []
+    writes = client.writes
+    client.writes = lambda addr, values: calls.append(addr) or writes(addr, values)
+    deferred = DeferredClient(client)
+    deferred.writes(BASE, [np.uint32(5)])
+    deferred.flush()
+    assert calls == [BASE]
+    assert server.memory[BASE] == 5
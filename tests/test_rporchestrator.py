@@ -0,0 +1,50 @@
+import contextlib
+import io
+import threading
+import time
+
+import pytest
+
+from rporchestrator import Orchestrator
+from rpsupervisor import LockState
+
+
+def test_two_simulated_boards_run_until_stopped(tmp_path, monkeypatch):
+    # the shared lock_cache.json and the lock traces go to the working directory
+    monkeypatch.chdir(tmp_path)
+    hostnames = ['sim:21', 'sim:22']
+    with contextlib.redirect_stdout(io.StringIO()):
+        orchestrator = Orchestrator(hostnames)
+    try:
+        assert all(board.lock_cache is orchestrator.lock_cache for board in orchestrator.boards.values())
+        assert orchestrator.boards['sim:21'].session is not orchestrator.boards['sim:22'].session
+        for board in orchestrator.boards.values():
+            board.supervisor.monitor_interval = 0.02
+        results = {}
+        runner = threading.Thread(target=lambda: results.update(orchestrator.run(record='dataset')))
+        runner.start()
+        deadline = time.time() + 60
+        while time.time() < deadline and \
+                not all(board['recorded'] >= 3 for board in orchestrator.metrics()['boards'].values()):
+            time.sleep(0.05)
+        orchestrator.stop()
+        runner.join(10)
+        assert not runner.is_alive()
+
+        metrics = orchestrator.metrics()
+        for hostname in hostnames:
+            board = metrics['boards'][hostname]
+            assert board['error'] is None and board['locks'] >= 1 and board['recorded'] >= 3
+            assert 0 < board['uptime_fraction'] < 1
+            assert results[hostname]['locks'] == board['locks']
+            assert orchestrator.boards[hostname].supervisor.state is LockState.MONITOR
+            # both lock points went into the one cache
+            assert orchestrator.lock_cache.get(hostname) is not None
+        assert metrics['total']['locks'] == sum(metrics['boards'][h]['locks'] for h in hostnames)
+        assert metrics['total']['recorded'] == sum(metrics['boards'][h]['recorded'] for h in hostnames)
+    finally:
+        orchestrator.close()
+    with pytest.raises(RuntimeError):
+        orchestrator.submit('sim:21', lambda board: None)
+    # the simulators are released with their sessions
+    assert all(board.session.board is None for board in orchestrator.boards.values())
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from rppolicy import NumpyPolicy, export_policy, verify_policy
+
+sb3 = pytest.importorskip('stable_baselines3')
+nn = pytest.importorskip('torch.nn')
+gym = pytest.importorskip('gymnasium')
+
+
+class LockEnv(gym.Env):
+    # the observation and action spaces of RedPitayaEnv, with a random transmission
+    def __init__(self):
+        self.observation_space = gym.spaces.Box(low=0, high=1, shape=(1,), dtype=np.float32)
+        self.action_space = gym.spaces.Box(low=-0.3, high=0.3, shape=(1,), dtype=np.float32)
+        self.steps = 0
+
+    def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        self.steps = 0
+        return self.observation_space.sample(), {}
+
+    def step(self, action):
+        self.steps += 1
+        observation = self.observation_space.sample()
+        return observation, float(observation[0]) - 0.95, self.steps >= 16, False, {}
+
+
+@pytest.mark.parametrize('policy_kwargs', [{}, {'activation_fn': nn.ReLU}, {'squash_output': True}],
+                         ids=['tanh', 'relu', 'squash'])
+def test_exported_policy_matches_torch(tmp_path, policy_kwargs):
+    sde = policy_kwargs.get('squash_output', False)
+    model = sb3.PPO('MlpPolicy', LockEnv(), n_steps=32, batch_size=16, n_epochs=1, use_sde=sde, seed=0,
+                    device='cpu', policy_kwargs={'net_arch': [8, 8], **policy_kwargs})
+    model.learn(32)
+    path = str(tmp_path / 'policy.npz')
+    export_policy(model, path)
+    policy = NumpyPolicy.load(path)
+    assert policy.squash == sde
+    assert verify_policy(model, policy, n=200) < 1e-5
+
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from rpqlearning import Discretizer, EpsilonSchedule, QLearningEngine, ReplayBuffer
+
+
+def test_discretizer_maps_values_to_the_nearest_centre():
+    centres = np.arange(-1, 1.1, 0.1)
+    discretize = Discretizer(centres)
+    values = np.array([-5., -1., -0.96, -0.94, 0.02, 0.049, 0.051, 1., 5.])
+    expected = [np.argmin(np.abs(centres - v)) for v in values]
+    assert discretize(values).tolist() == expected
+    assert discretize(0.3) == 13 and len(discretize) == 21
+
+
+def test_epsilon_schedules():
+    step = EpsilonSchedule(0.7, 0.3, 1000)
+    assert step(999) == 0.7 and step(1000) == 0.3
+    linear = EpsilonSchedule(1., 0., 100, 'linear')
+    assert linear(50) == pytest.approx(0.5) and linear(500) == 0.
+    exponential = EpsilonSchedule(1., 0.01, 100, 'exponential')
+    assert exponential(50) == pytest.approx(0.1) and exponential(200) == pytest.approx(0.01)
+    assert EpsilonSchedule(0.5)(10 ** 6) == 0.5
+    with pytest.raises(ValueError):
+        EpsilonSchedule(kind='cosine')
+
+
+def test_replay_buffer_wraps_around():
+    buffer = ReplayBuffer(capacity=4)
+    buffer.add(np.arange(3), 0, 1., np.arange(3) + 1, False)
+    buffer.add(np.arange(3, 6), 1, 0., np.arange(3, 6) + 1, [False, False, True])
+    assert len(buffer) == 4
+    # transitions 4 and 5 overwrote the two oldest slots
+    assert buffer.states.tolist() == [4, 5, 2, 3]
+    assert buffer.actions.tolist() == [1, 1, 0, 1] and buffer.dones.tolist() == [False, True, False, False]
+    states, actions, rewards, next_states, dones = buffer.sample(100, np.random.default_rng(0))
+    assert set(states.tolist()) <= {2, 3, 4, 5} and (next_states == states + 1).all()
+
+
+def test_repeated_pairs_get_the_mean_of_their_td_errors():
+    engine = QLearningEngine(3, 2, learning_rate=0.5, discount_factor=0.9)
+    engine.Q[2] = [1., 4.]
+    # (0, 1) twice with targets 1 + 0.9 * 4 and 0, (1, 0) once
+    engine.update([0, 0, 1], [1, 1, 0], [1., 0., 2.], [2, 1, 1])
+    assert engine.Q[0, 1] == pytest.approx(0.5 * (4.6 + 0.) / 2)
+    assert engine.Q[1, 0] == pytest.approx(0.5 * 2.)
+    assert engine.Q[0, 0] == 0. and engine.updates == 3
+
+
+@pytest.mark.parametrize('terminal_bootstrap', [True, False])
+def test_terminal_bootstrap(terminal_bootstrap):
+    engine = QLearningEngine(2, 1, learning_rate=1., discount_factor=0.5, terminal_bootstrap=terminal_bootstrap)
+    engine.Q[1] = 2.
+    engine.update(0, 0, 0., 1, True)
+    # the original qlearning() rule bootstraps from the state after the lock was lost too
+    assert engine.Q[0, 0] == (1. if terminal_bootstrap else 0.)
@@ -0,0 +1,78 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from rprecorder import FORMAT_VERSION, INDEX_DTYPES, TraceReader, TraceRecorder
+from rpreplay import RedPitayaReplayEnv
+
+
+def record(path, n=6, transmission=0.99):
+    with TraceRecorder(path, ('in2',), chunk_size=4) as recorder:
+        for k in range(n):
+            recorder.record((np.full(32, k, dtype=float),), dac2=0.5, locked=k < n - 1, counter=k,
+                            transmission=transmission if k < n - 1 else 0.5)
+
+
+def write_version_1(path, n=3):
+    # a recording made before the index had the transmission column
+    os.makedirs(path)
+    with open(os.path.join(path, 'recording.json'), 'w') as f:
+        json.dump({'channels': ['in2'], 'length': 32, 'dtype': '<f4', 'codec': None, 'count': n}, f)
+    np.zeros((n, 1, 32), dtype=np.float32).tofile(os.path.join(path, 'traces.dat'))
+    index = np.zeros(n, dtype=INDEX_DTYPES[1])
+    index['counter'] = np.arange(n)
+    index.tofile(os.path.join(path, 'index.dat'))
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'rec')
+    record(path)
+    reader = TraceReader(path)
+    assert reader.meta['version'] == FORMAT_VERSION
+    assert len(reader) == 6
+    assert np.array_equal(reader.counter, np.arange(6))
+    assert reader.transmission[0] == 0.99
+    assert np.array_equal(reader[3, 0], np.full(32, 3))
+
+
+def test_append(tmp_path):
+    path = str(tmp_path / 'rec')
+    record(path)
+    record(path)
+    assert len(TraceReader(path)) == 12
+
+
+def test_version_1_is_read_and_not_appended_to(tmp_path):
+    path = str(tmp_path / 'old')
+    write_version_1(path)
+    reader = TraceReader(path)
+    assert len(reader) == 3
+    assert np.array_equal(reader.counter, np.arange(3))
+    assert np.isnan(reader.transmission).all()
+    with pytest.raises(ValueError):
+        TraceRecorder(path, ('in2',))
+
+
+def test_unknown_version(tmp_path):
+    path = str(tmp_path / 'rec')
+    record(path)
+    with open(os.path.join(path, 'recording.json')) as f:
+        meta = json.load(f)
+    meta['version'] = FORMAT_VERSION + 1
+    with open(os.path.join(path, 'recording.json'), 'w') as f:
+        json.dump(meta, f)
+    with pytest.raises(ValueError):
+        TraceReader(path)
+
+
+def test_replay_falls_off_around_the_recorded_dac2(tmp_path):
+    path = str(tmp_path / 'rec')
+    record(path)
+    env = RedPitayaReplayEnv(path, linewidth=0.001, seed=0)
+    obs, _ = env.reset(options={'start': 0})
+    assert obs[0] == pytest.approx(0.99)
+    obs, reward, terminated, _, _ = env.step(np.array([0.001]))
+    assert obs[0] == pytest.approx(0.99 / 2)
+    assert terminated
@@ -0,0 +1,78 @@
+import types
+
+import pytest
+
+import rpscheduler
+from rpscheduler import RateScheduler
+
+
+class Clock:
+    # perf_counter() advances by `tick` per call, so the busy wait ends; sleep() jumps ahead
+    def __init__(self, tick=1e-6):
+        self.t = 100.
+        self.tick = tick
+
+    def perf_counter(self):
+        self.t += self.tick
+        return self.t
+
+    def sleep(self, seconds):
+        self.t += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rpscheduler, 'time', types.SimpleNamespace(perf_counter=clock.perf_counter,
+                                                                   sleep=clock.sleep))
+    return clock
+
+
+def test_ticks_keep_to_the_deadlines(clock):
+    scheduler = RateScheduler(100.)
+    assert scheduler.wait() == 0.
+    start = scheduler.deadline - 0.01
+    for k in range(1, 6):
+        clock.t += 0.004
+        assert scheduler.wait() < 1e-5
+        # the work of the loop does not shift the schedule
+        assert clock.t == pytest.approx(start + 0.01 * k, abs=1e-5)
+    assert scheduler.overruns == 0 and scheduler.ticks == 6
+
+
+def test_late_tick_catches_up_and_overrun_resyncs(clock):
+    scheduler = RateScheduler(100.)
+    scheduler.wait()
+    start = scheduler.deadline - 0.01
+    # 5 ms late: the next deadline stays on the original grid
+    clock.t += 0.015
+    assert scheduler.wait() == pytest.approx(0.005, abs=1e-5)
+    assert scheduler.overruns == 0 and scheduler.deadline == pytest.approx(start + 0.02)
+    # more than a period late: one overrun and the schedule restarts from now rather than bursting
+    clock.t = start + 0.045
+    assert scheduler.wait() == pytest.approx(0.025, abs=1e-5)
+    assert scheduler.overruns == 1 and scheduler.deadline == pytest.approx(clock.t + 0.01)
+    clock.t += 0.002
+    assert scheduler.wait() < 1e-5
+
+
+def test_jitter_statistics(clock):
+    scheduler = RateScheduler(100.)
+    scheduler.wait()
+    clock.t += 0.013
+    scheduler.wait()
+    clock.t += 0.001
+    scheduler.wait()
+    stats = scheduler.stats()
+    assert stats['ticks'] == 3 and stats['overruns'] == 0
+    assert stats['max_jitter'] == pytest.approx(0.003, abs=1e-5)
+    assert stats['mean_jitter'] == pytest.approx(0.0015, abs=1e-5)
+    assert stats['histogram']['<5000us'] == 1 and stats['histogram']['<10us'] == 1
+    assert sum(stats['histogram'].values()) == 2
+
+
+def test_without_a_rate_only_counts(clock):
+    scheduler = RateScheduler()
+    t = clock.t
+    assert [scheduler.wait() for _ in range(3)] == [0., 0., 0.]
+    assert scheduler.ticks == 3 and clock.t - t < 1e-3
@@ -0,0 +1,35 @@
+import pytest
+
+import rpsession
+from rpsession import SessionPool
+from rpsim import SimulatedRedPitaya
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    # boards are simulators, whatever their hostname
+    monkeypatch.setattr(rpsession, 'connect', lambda hostname, *args: SimulatedRedPitaya(hostname, seed=0))
+    pool = SessionPool(max_retries=1)
+    yield pool
+    pool.close()
+
+
+def test_boards_are_shared_until_released(pool):
+    a, b = pool.get('board'), pool.get('board')
+    assert a is b and a.refs == 2
+    board = a.board
+    pool.release(a)
+    pool.release(a)
+    assert a.refs == 0
+    # the connection stays open for the next get()
+    assert a.board is board and pool.get('board') is a
+    pool.close('board')
+    assert a.board is None and pool.get('board') is not a
+
+
+def test_simulators_are_not_pooled(pool):
+    a, b = pool.get('sim:1'), pool.get('sim:1')
+    assert a is not b and a.board is not b.board and a.registers is not b.registers
+    assert pool.stats() == {}
+    pool.release(a)
+    assert a.board is None and b.board is not None
@@ -0,0 +1,50 @@
+import time
+
+import numpy as np
+import pytest
+
+from rpsettle import SettleDetector
+
+
+class Laser:
+    # peak position following a dac2 step with a first order response of time constant tau
+    def __init__(self, tau=0.05):
+        self.tau = tau
+        self.start, self.target = time.perf_counter(), 0.5
+        self.origin = self.target
+
+    def step(self, size=0.1):
+        self.origin, self.start = self.measure()[0], time.perf_counter()
+        self.target += size
+
+    def measure(self):
+        t = time.perf_counter() - self.start
+        return self.target + (self.origin - self.target) * np.exp(-t / self.tau), 1.
+
+
+def test_window_spans_time():
+    laser = Laser()
+    detector = SettleDetector(laser.measure, window=4, span=0.1, position_tolerance=1e-3)
+    assert detector.pace == pytest.approx(0.1 / 3)
+    laser.step()
+    result = detector.wait()
+    assert result.settled
+    assert result.duration >= 0.1
+    # a window of four consecutive traces would have settled before the position got within tolerance
+    assert abs(laser.measure()[0] - laser.target) < 1e-3
+
+
+def test_calibrate_measures_the_time_constant():
+    laser = Laser(tau=0.05)
+    detector = SettleDetector(laser.measure)
+    tau = detector.calibrate(laser.step, duration=0.4, interval=0.002)
+    assert tau == pytest.approx(0.05, rel=0.2)
+    assert detector.span == pytest.approx(3 * tau)
+
+
+def test_calibrate_needs_a_peak_and_a_step():
+    laser = Laser()
+    with pytest.raises(ValueError):
+        SettleDetector(lambda: (0.5, 0.)).calibrate(laser.step, duration=0.05)
+    with pytest.raises(ValueError):
+        SettleDetector(laser.measure).calibrate(lambda: laser.step(0.), duration=0.05)
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import numpy as np
+
+from rpscope import RedPitayaScope
+from rpstream import TraceStream
+
+
+class Source:
+    # numbered traces, paced by the test through `release`
+    def __init__(self):
+        self.n = 0
+        self.release = threading.Semaphore(0)
+
+    def acquire(self):
+        self.release.acquire()
+        self.n += 1
+        return np.full(4, self.n), np.full(4, -self.n)
+
+
+def test_ring_keeps_order_timestamps_and_counts_drops():
+    source = Source()
+    stream = TraceStream(source.acquire, n_slots=4).start()
+    try:
+        traces = stream.traces(start=0, timeout=1.)
+        source.release.release(10)
+        deadline = time.time() + 1.
+        while stream.head < 9 and time.time() < deadline:
+            time.sleep(0.001)
+        # the reader fell 10 traces behind a ring of 4 and skips to the oldest one still in it
+        first = next(traces)
+        assert first[0] == 6 and stream.dropped == 6
+        assert [trace[0] for trace in (next(traces), next(traces), next(traces))] == [7, 8, 9]
+        seq, timestamp, ch1, ch2 = stream.latest()
+        assert seq == 9 and ch1[0] == 10 and ch2[0] == -10
+        assert timestamp >= first[1]
+        assert stream.stats()['acquired'] == 10
+    finally:
+        # the reader is blocked in acquire(), it exits once released
+        stream.stop(timeout=0.)
+        source.release.release()
+    assert not stream.running
+
+
+def test_lock_check_reads_the_stream_without_arming_the_scope():
+    rp = RedPitayaScope('sim:8')
+    try:
+        rp.start_stream()
+        check = rp.lock_check(('max', 'mean'), input1='out1')
+        assert rp.stream.head >= 0 and check.n_points == rp.redpitaya.scope.data_length
+        # lock_check arms the scope through _start_trace_acquisition, the stream takes single() traces
+        assert rp.redpitaya.scope._raw is None
+    finally:
+        rp.close()
+    assert rp.stream is None
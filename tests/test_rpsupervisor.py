@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from rpscope import LockCheck
+from rpsupervisor import LockState, LockSupervisor
+
+
+class Checks:
+    # check() of a stub controller: plays back transmissions, raising where the list holds an exception
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        result = self.results.pop(0) if len(self.results) > 1 else self.results[0]
+        if isinstance(result, Exception):
+            raise result
+        return LockCheck({'max': result})
+
+
+def supervisor(check, **kwargs):
+    kwargs = {'backoff': 0.01, 'monitor_interval': 0.01, **kwargs}
+    steps = {name: lambda: None for name in ('reset', 'ramp', 'fit', 'settle') if name not in kwargs}
+    return LockSupervisor(search=lambda: True, check=check, **steps, **kwargs)
+
+
+def test_failing_check_is_retried_in_locked():
+    s = supervisor(Checks(TimeoutError('scope acquisition timed out'), 1.))
+    assert s.acquire()
+    assert s.state is LockState.LOCKED and s.failures[LockState.LOCKED] == 1 and s.last_check.max == 1.
+
+
+def test_acquire_gives_up_without_a_last_backoff():
+    s = supervisor(Checks(ConnectionError('dropped')), max_retries=3, backoff=0.2)
+    t0 = time.perf_counter()
+    assert not s.acquire()
+    # backoffs after the first two attempts only
+    assert time.perf_counter() - t0 == pytest.approx(0.6, abs=0.15)
+    assert s.state is LockState.FAILED and s.failures[LockState.LOCKED] == 3 and s.last_check is None
+
+
+def test_failing_check_loses_the_lock_in_monitor():
+    s = supervisor(Checks(1., ConnectionError('dropped'), 1.))
+    assert s.acquire()
+    assert s.monitor() is None
+    assert s.state is LockState.LOST and s.losses == 1 and s.last_check is None
+    # run() relocks after it
+    checks = Checks(1., ConnectionError('dropped'), 1.)
+    s = supervisor(checks)
+    s.run(until=time.time() + 0.2)
+    assert s.losses == 1 and s.locks == 2 and checks.calls > 3
+
+
+def test_only_confirmed_lock_points_are_stored():
+    stored = []
+    points = iter(['rejected', 'confirmed'])
+    s = supervisor(Checks(0.5, 1.), fit=lambda: next(points), on_locked=stored.append)
+    assert s.acquire()
+    assert stored == ['confirmed'] and s.failures[LockState.LOCKED] == 1
+
+
+def test_run_returns_when_on_check_returns_false():
+    s = supervisor(Checks(1.))
+    seen = []
+    s.run(lambda check: seen.append(check.max) or len(seen) < 3, until=time.time() + 5.)
+    assert seen == [1., 1., 1.] and s.locks == 1 and s.state is LockState.MONITOR
+    # also when the check that stops it finds the lock lost
+    s = supervisor(Checks(1., 0.5, 1.))
+    s.run(lambda check: False, until=time.time() + 5.)
+    assert s.locks == 1 and s.losses == 1 and s.state is LockState.LOST
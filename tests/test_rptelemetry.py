@@ -0,0 +1,28 @@
+import json
+import threading
+
+from rptelemetry import DEBUG, Telemetry
+
+
+def test_events_emitted_from_many_threads_get_one_id_each(tmp_path):
+    path = tmp_path / 'telemetry.jsonl'
+    telemetry = Telemetry(str(path), level=DEBUG, echo=DEBUG + 100, interval=0.01)
+    start = threading.Barrier(8)
+
+    def emit(thread):
+        start.wait()
+        for i in range(200):
+            telemetry.debug(f'event{i % 50}', value=thread)
+    threads = [threading.Thread(target=emit, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    telemetry.close()
+    assert sorted(telemetry.events) == sorted(f'event{i}' for i in range(50))
+    assert all(telemetry.events[event_id] == event for event, event_id in telemetry._event_ids.items())
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 8 * 200 and telemetry.dropped == 0
+    for n in range(8):
+        assert sum(record['event'] == 'event7' and record['value'] == n for record in records) == 4
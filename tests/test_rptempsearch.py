@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from rpsim import DATA_LENGTH, SimulatedCavity
+from rptempsearch import TemperatureSearch
+
+
+def ramp_measure(cavity):
+    # measure() of a controller whose piezo ramp spans 0 - 1 V over one trace, the laser follows dac2 at once
+    x = np.arange(DATA_LENGTH) / DATA_LENGTH
+
+    def measure(temperature, settle=0.):
+        transmission = cavity.transmission(x, temperature)
+        return int(np.argmax(transmission)), transmission.max(), DATA_LENGTH
+    return measure
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('method', ['secant', 'bisect'])
+def test_search_puts_the_resonance_in_the_middle_of_the_ramp(method, seed):
+    cavity = SimulatedCavity(seed=seed)
+    epsilon = 500
+    result = TemperatureSearch(method=method).search(ramp_measure(cavity), epsilon)
+    assert result.found
+    # within epsilon samples of the middle of the ramp, in piezo volts
+    assert abs(cavity.detuning(0.5, result.temperature)) < epsilon / DATA_LENGTH
+    linear = TemperatureSearch(method='linear').search(ramp_measure(cavity), epsilon)
+    assert linear.found and result.acquisitions < linear.acquisitions
+
+
+@pytest.mark.parametrize('method', ['secant', 'bisect', 'linear'])
+def test_search_without_a_tem00_peak_is_not_found(method):
+    # the TEM00 peak stays below the threshold, the higher order modes too
+    cavity = SimulatedCavity(seed=0, peak=0.5)
+    result = TemperatureSearch(method=method).search(ramp_measure(cavity))
+    assert not result.found
+    assert result.acquisitions > 0
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from rpfit import PDHFitter
+from rploopmodel import LoopModel
+from rptuner import Tuner
+
+
+def test_detuning_measures_the_lock_point_not_the_regulated_error():
+    # the error is regulated to the setpoint either way, only the detuning tells the offset lock apart
+    model = LoopModel(duration=0.02)
+    centred = model.simulate(10, 1e4, setpoint_offset=0.)
+    offset = model.simulate(10, 1e4, setpoint_offset=0.3)
+    assert offset.detuning > centred.detuning
+    assert offset.rms <= centred.rms
+
+
+def test_setpoint_offset_compensates_the_error_offset():
+    model = LoopModel(duration=0.02, error_offset=0.3)
+    assert model.simulate(10, 1e4, setpoint_offset=0.3).detuning < model.simulate(10, 1e4).detuning
+
+
+def test_offset_is_only_tuned_for_an_error_offset():
+    assert not Tuner(LoopModel()).tune_offset
+    assert Tuner(LoopModel(error_offset=0.1)).tune_offset
+    tuner = Tuner(LoopModel(error_offset=0.1))
+    assert tuner.decode(tuner.encode(10., 1e4, setpoint_offset=0.1))['setpoint_offset'] == pytest.approx(0.1)
+
+
+def test_fit_peak_is_the_error_signal_extremum():
+    x = np.linspace(-1, 1, 4000)
+    A, B, g, x0 = 2e-4, 0.01, 0.05, 0.1
+    y = -2 * A * (x - x0) / ((x - x0) ** 2 + g ** 2) ** 2 + B
+    assert PDHFitter().fit(x, y).peak == pytest.approx(y.max() - B, rel=1e-3)